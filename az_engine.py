@@ -0,0 +1,242 @@
+# Движок ставок и роста банка AZ-Calculator: расчет ставки, целевого банка
+# по дням, режим Азамата, обработка выигрыша и проигрыша.
+#
+# Модуль чистый: импортирует только стандартную библиотеку, ничего не
+# запускает и не трогает базу, Telegram или логирование при импорте, поэтому
+# его можно использовать из бенчмарков и пакетных расчетов без запуска бота.
+# Функции работают с BankState (или его наследником bot.UserSession).
+import logging
+import math
+import time
+
+GOAL_PERCENTAGE = 0.015
+MAX_STAKE_PERCENTAGE = 0.20
+MAX_PLAN_DAYS = 300
+SPLIT_GOAL_PARTS = 4
+
+logger = logging.getLogger(__name__)
+
+def log_error(error_message, exc_info=None):
+    logger.error(error_message, exc_info=exc_info)
+
+# --- ДЕНЬГИ ---
+# Все суммы (банк, цели, ставки, проигрыши для отыгрыша) - целые копейки.
+# Сложение, вычитание и сравнение точные; округление до копейки происходит
+# только там, где сумма получается умножением или делением.
+KOPECKS_PER_RUBLE = 100
+
+def to_kopecks(rubles):
+    # round() без знаков дает int, а для nan/inf бросает ValueError/OverflowError.
+    return round(float(rubles) * KOPECKS_PER_RUBLE)
+
+def format_rubles(kopecks):
+    return f"{kopecks / KOPECKS_PER_RUBLE:.2f}"
+
+def calculate_profit(stake, coefficient):
+    return round(stake * (coefficient - 1))
+
+def calculate_max_stake(bank, max_stake_percentage=MAX_STAKE_PERCENTAGE):
+    return int(round(bank * max_stake_percentage, 6))
+
+def split_amount(amount, parts):
+    # Равные части, остаток от округления уходит в последнюю.
+    part = round(amount / parts)
+    return [part] * (parts - 1) + [amount - part * (parts - 1)]
+
+# Состояние текущего банка. Значения уже приведены к своим типам при чтении
+# из базы, поэтому расчеты берут атрибуты как есть, без .get() и float().
+# __slots__ вместо словаря: в кэше держатся тысячи таких объектов.
+class BankState:
+    __slots__ = (
+        'bank_id', 'bank_name', 'bank', 'day', 'initial_balance', 'daily_goal',
+        'current_target', 'current_coeff', 'current_stake', 'in_azamat_mode',
+        'loss_record', 'sub_goals', 'original_goal', 'total_bets', 'total_wins',
+        'awaiting_bet_result', 'pending_bets',
+    )
+
+    def __init__(self):
+        self.bank_id = None
+        self.bank_name = ''
+        self.bank = 0
+        self.day = 1
+        self.initial_balance = 0
+        self.daily_goal = 0
+        self.current_target = 0
+        self.current_coeff = 0.0
+        self.current_stake = 0
+        self.in_azamat_mode = False
+        self.loss_record = []
+        self.sub_goals = []
+        self.original_goal = 0
+        self.total_bets = 0
+        self.total_wins = 0
+        self.awaiting_bet_result = False
+        self.pending_bets = None
+
+def calculate_stake(target, coefficient):
+    try:
+        if coefficient <= 1.0 or target <= 0:
+            return 0
+        return round(target / (coefficient - 1))
+    except Exception as e:
+        log_error(f"Ошибка в calculate_stake: {e}", exc_info=True)
+        return 0
+
+# Множители роста (1 + GOAL_PERCENTAGE) ** day для всего плана: считаются
+# один раз и дают те же значения, что и прямое возведение в степень.
+GROWTH_RATE = 1 + GOAL_PERCENTAGE
+GROWTH_FACTORS = tuple(GROWTH_RATE ** day for day in range(MAX_PLAN_DAYS + 2))
+GROWTH_LOG = math.log(GROWTH_RATE)
+
+def calculate_target_bank(initial_balance, day, goal_percentage=GOAL_PERCENTAGE):
+    try:
+        if goal_percentage == GOAL_PERCENTAGE and 0 <= day < len(GROWTH_FACTORS):
+            return round(initial_balance * GROWTH_FACTORS[day])
+        return round(initial_balance * ((1 + goal_percentage) ** day))
+    except Exception as e:
+        log_error(f"Ошибка в calculate_target_bank: {e}", exc_info=True)
+        return 0
+
+def calculate_daily_goal(current_bank, target_bank):
+    try:
+        return target_bank - current_bank
+    except Exception as e:
+        log_error(f"Ошибка в calculate_daily_goal: {e}", exc_info=True)
+        return 0
+
+def get_target_day(current_bank, initial_balance):
+    try:
+        if initial_balance <= 0:
+            return 1
+        if current_bank < initial_balance:
+            return 1
+        # Оценка по логарифму, затем точная поправка на округление целевого банка
+        target_day = int(math.log(current_bank / initial_balance) / GROWTH_LOG)
+        target_day = max(1, min(target_day, MAX_PLAN_DAYS))
+        while target_day < MAX_PLAN_DAYS and current_bank >= calculate_target_bank(initial_balance, target_day + 1):
+            target_day += 1
+        while target_day > 1 and current_bank < calculate_target_bank(initial_balance, target_day):
+            target_day -= 1
+        return target_day
+    except Exception as e:
+        log_error(f"Ошибка в get_target_day: {e}", exc_info=True)
+        return 1
+
+def calculate_plan_goal(state):
+    # Цель по плану: сколько не хватает до целевого банка текущего дня.
+    return calculate_daily_goal(state.bank, calculate_target_bank(state.initial_balance, state.day))
+
+def check_and_advance_day(state):
+    try:
+        current_day = state.day
+        new_day = get_target_day(state.bank, state.initial_balance) + 1
+        if new_day > current_day:
+            state.day = new_day
+            state.in_azamat_mode = False
+            state.loss_record = []
+            state.sub_goals = []
+            state.original_goal = 0
+            state.current_target = calculate_plan_goal(state)
+            state.daily_goal = state.current_target
+            return new_day - current_day
+        return 0
+    except Exception as e:
+        log_error(f"Ошибка в check_and_advance_day: {e}", exc_info=True)
+        return 0
+
+def calculate_azamat_target(state):
+    try:
+        loss_record = state.loss_record
+        if len(loss_record) >= 2:
+            return loss_record[0] + loss_record[1]
+        return calculate_plan_goal(state)
+    except Exception as e:
+        log_error(f"Ошибка в calculate_azamat_target: {e}", exc_info=True)
+        return calculate_plan_goal(state)
+
+def split_goal(state, parts=SPLIT_GOAL_PARTS):
+    # Цель дня делится на равные части, которые отыгрываются как проигрыши
+    # в режиме Азамата: по две за ставку.
+    try:
+        goal = state.current_target
+        sub_goals = split_amount(goal, parts)
+        state.loss_record.extend(sub_goals)
+        state.in_azamat_mode = True
+        state.current_target = calculate_azamat_target(state)
+        state.sub_goals = sub_goals
+        state.original_goal = goal
+        return state
+    except Exception as e:
+        log_error(f"Ошибка в split_goal: {e}", exc_info=True)
+        return state
+
+def add_bet_to_history(state, coefficient, result):
+    try:
+        bet_record = {
+            'bank_id': state.bank_id,
+            'ts': time.time(),
+            'coefficient': coefficient,
+            'stake': state.current_stake,
+            'result': result,
+            'bank_after': state.bank
+        }
+        if state.pending_bets is None:
+            state.pending_bets = []
+        state.pending_bets.append(bet_record)
+        return state
+    except Exception as e:
+        log_error(f"Ошибка добавления ставки в историю: {e}", exc_info=True)
+        return state
+
+def process_win(state):
+    try:
+        coeff = state.current_coeff
+        profit = calculate_profit(state.current_stake, coeff)
+        state.bank += profit
+        state.total_wins += 1
+        state = add_bet_to_history(state, coeff, 'win')
+        state.awaiting_bet_result = False
+        if state.in_azamat_mode and state.loss_record:
+            remaining_profit = profit
+            new_loss_record = []
+            for goal_amount in state.loss_record:
+                if remaining_profit >= goal_amount:
+                    remaining_profit -= goal_amount
+                else:
+                    if remaining_profit > 0:
+                        new_loss_record.append(goal_amount - remaining_profit)
+                        remaining_profit = 0
+                    else:
+                        new_loss_record.append(goal_amount)
+            state.loss_record = new_loss_record
+            if not new_loss_record:
+                state.in_azamat_mode = False
+                state.current_target = calculate_plan_goal(state)
+            else:
+                state.current_target = calculate_azamat_target(state)
+                state.in_azamat_mode = True
+        else:
+            state.current_target = calculate_plan_goal(state)
+            state.in_azamat_mode = False
+        return state
+    except Exception as e:
+        log_error(f"Ошибка в process_win: {e}", exc_info=True)
+        return state
+
+def process_loss(state):
+    try:
+        stake = state.current_stake
+        state.bank -= stake
+        state = add_bet_to_history(state, state.current_coeff, 'loss')
+        state.awaiting_bet_result = False
+        state.loss_record.append(stake)
+        if len(state.loss_record) >= 2:
+            state.in_azamat_mode = True
+        if not state.in_azamat_mode:
+            state.current_target = calculate_plan_goal(state)
+        else:
+            state.current_target = calculate_azamat_target(state)
+        return state
+    except Exception as e:
+        log_error(f"Ошибка в process_loss: {e}", exc_info=True)
+        return state
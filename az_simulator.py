@@ -0,0 +1,335 @@
+# Монте-Карло симуляция банка по стратегии AZ: тысячи путей сразу, состояние
+# каждого пути - строка в массивах NumPy.
+#
+# Шаг симуляции - одна ставка по тем же правилам, что в боте: рекомендуемая
+# ставка calculate_stake с ограничением calculate_max_stake, затем
+# process_win / process_loss (отыгрыш проигрышей в режиме Азамата,
+# calculate_azamat_target) и check_and_advance_day. Суммы - целые копейки с
+# тем же округлением, что в az_engine, поэтому путь с теми же исходами ставок
+# совпадает с пошаговым расчетом через движок до копейки
+# (проверка: python benchmarks/simulate.py --check 2000).
+#
+# Путь идет, пока не остановится:
+#   - банк разорен: меньше ruin_bank или максимальная ставка меньше копейки;
+#   - план пройден: день больше MAX_PLAN_DAYS;
+#   - цель не положительная и ставить нечего (stalled).
+# max_bets - предел ставок на путь на случай, если путь не кончается: дошедшие
+# до него пути считаются незавершенными (unfinished). На один день плана
+# обычно уходит несколько ставок, поэтому предел намного больше MAX_PLAN_DAYS.
+#
+# goal_percentage и max_stake_percentage заменяют GOAL_PERCENTAGE и
+# MAX_STAKE_PERCENTAGE, split_parts > 1 включает разделение цели дня
+# (split_goal) всякий раз, когда бот его разрешает (см. az_sweep.py).
+import collections
+import time
+
+import numpy as np
+
+from az_engine import GOAL_PERCENTAGE, MAX_PLAN_DAYS, MAX_STAKE_PERCENTAGE, calculate_target_bank
+
+SimulationResult = collections.namedtuple('SimulationResult', (
+    'paths', 'max_bets', 'elapsed', 'days', 'final_banks', 'bets_made',
+    'ruined', 'completed', 'stalled', 'unfinished', 'max_stake_share', 'capped_bets', 'max_stake_percentage',
+))
+
+MAX_SIMULATION_BETS = 10000
+
+SUMMARY_PERCENTILES = (5, 25, 50, 75, 95)
+
+# Когда активных путей остается меньше этой доли, массивы ужимаются до них.
+COMPACT_RATIO = 0.75
+MIN_LOSS_CAPACITY = 8
+
+def get_win_probabilities(coefficients, win_probability=None):
+    # Без заданной вероятности - честные шансы 1/коэффициент.
+    if win_probability is None:
+        return 1.0 / coefficients
+    return np.full(coefficients.shape, float(win_probability))
+
+def draw_bets(rng, coefficients, probabilities, weights, paths):
+    # Коэффициент и исход очередной ставки для каждого пути.
+    if len(coefficients) == 1:
+        index = np.zeros(paths, dtype=np.intp)
+    else:
+        index = rng.choice(len(coefficients), size=paths, p=weights)
+    return coefficients[index], rng.random(paths) < probabilities[index]
+
+def get_stake_limits(bank, max_stake_percentage=MAX_STAKE_PERCENTAGE):
+    # Векторный calculate_max_stake: int(round(bank * max_stake_percentage, 6)).
+    return np.floor(np.round(bank * max_stake_percentage, 6)).astype(np.int64)
+
+def get_target_banks(initial_balance, goal_percentage=GOAL_PERCENTAGE):
+    # Целевой банк каждого дня плана, посчитанный самим движком.
+    return np.array([calculate_target_bank(initial_balance, day, goal_percentage)
+                     for day in range(MAX_PLAN_DAYS + 2)], dtype=np.int64)
+
+# Очереди loss_record всех путей: кольцевой буфер values[позиция, путь],
+# head - позиция первой цели, count - длина очереди. Методы принимают номера
+# строк (rows), чтобы трогать только пути, у которых очередь меняется.
+class LossQueues:
+    __slots__ = ('values', 'head', 'count')
+
+    def __init__(self, loss_record, paths):
+        self.values = np.zeros((max(MIN_LOSS_CAPACITY, 2 * len(loss_record)), paths), dtype=np.int64)
+        self.values[:len(loss_record)] = np.asarray(loss_record, dtype=np.int64)[:, None]
+        self.head = np.zeros(paths, dtype=np.int64)
+        self.count = np.full(paths, len(loss_record), dtype=np.int64)
+
+    def positions(self, rows, offset=0):
+        capacity, paths = self.values.shape
+        return (self.head[rows] + offset) % capacity * paths + rows
+
+    def peek(self, rows, offset=0):
+        return self.values.take(self.positions(rows, offset))
+
+    def pop(self, rows):
+        self.head[rows] = (self.head[rows] + 1) % self.values.shape[0]
+        self.count[rows] -= 1
+
+    def reduce_front(self, rows, amounts):
+        self.values.reshape(-1)[self.positions(rows)] -= amounts
+
+    def push(self, rows, amounts):
+        if (self.count[rows] >= self.values.shape[0]).any():
+            self.grow()
+        self.values.reshape(-1)[self.positions(rows, self.count[rows])] = amounts
+        self.count[rows] += 1
+
+    def clear(self, rows):
+        self.head[rows] = 0
+        self.count[rows] = 0
+
+    def grow(self):
+        # Разворачивает кольцо в начало и удваивает емкость.
+        capacity, paths = self.values.shape
+        order = (self.head + np.arange(capacity)[:, None]) % capacity
+        grown = np.zeros((capacity * 2, paths), dtype=np.int64)
+        grown[:capacity] = np.take_along_axis(self.values, order, axis=0)
+        self.values = grown
+        self.head = np.zeros(paths, dtype=np.int64)
+
+    def drop_zeros(self, rows):
+        # Нулевые цели (после разделения мелкой цели) process_win выбрасывает
+        # из списка целиком, где бы они ни стояли.
+        capacity = self.values.shape[0]
+        slots = np.arange(capacity)[:, None]
+        record = self.values[(self.head[rows] + slots) % capacity, rows]
+        keep = (slots < self.count[rows]) & (record != 0)
+        kept = keep.sum(axis=0)
+        record = np.take_along_axis(record, np.argsort(~keep, axis=0, kind='stable'), axis=0)
+        self.values[:, rows] = np.where(slots < kept, record, 0)
+        self.head[rows] = 0
+        self.count[rows] = kept
+
+    def compact(self, keep):
+        # Индекс по второй оси дает не C-непрерывный массив, а reshape(-1)
+        # в reduce_front/push должен быть представлением, не копией.
+        self.values = np.ascontiguousarray(self.values[:, keep])
+        self.head = self.head[keep]
+        self.count = self.count[keep]
+
+# Состояние всех путей: поля BankState массивами плюс итоги пути. ids -
+# номера путей, которые еще лежат в массивах после compact().
+class BankPaths:
+    __slots__ = (
+        'ids', 'bank', 'day', 'target', 'in_azamat_mode', 'losses', 'has_zero_losses',
+        'has_sub_goals', 'max_stakes', 'active', 'ruined', 'completed', 'stalled', 'bets_made',
+        'capped_bets', 'max_stake_share',
+    )
+    RESULT_FIELDS = ('day', 'bank', 'bets_made', 'ruined', 'completed', 'stalled', 'active',
+                     'max_stake_share', 'capped_bets')
+
+    def __init__(self, state, paths, ruin_bank, max_stake_percentage):
+        loss_record = list(state.loss_record)
+        self.ids = np.arange(paths)
+        self.bank = np.full(paths, state.bank, dtype=np.int64)
+        self.day = np.full(paths, min(state.day, MAX_PLAN_DAYS + 1), dtype=np.int64)
+        self.target = np.full(paths, state.current_target, dtype=np.int64)
+        self.in_azamat_mode = np.full(paths, bool(state.in_azamat_mode))
+        self.losses = LossQueues(loss_record, paths)
+        self.has_zero_losses = np.full(paths, 0 in loss_record)
+        self.has_sub_goals = np.full(paths, bool(state.sub_goals))
+        self.max_stakes = get_stake_limits(self.bank, max_stake_percentage)
+        self.ruined = (self.bank < ruin_bank) | (self.max_stakes <= 0)
+        self.completed = ~self.ruined & (self.day > MAX_PLAN_DAYS)
+        self.stalled = np.zeros(paths, dtype=bool)
+        self.active = ~(self.ruined | self.completed)
+        self.bets_made = np.zeros(paths, dtype=np.int64)
+        self.capped_bets = np.zeros(paths, dtype=np.int64)
+        self.max_stake_share = np.zeros(paths)
+
+    def store(self, results):
+        for name in self.RESULT_FIELDS:
+            results[name][self.ids] = getattr(self, name)
+
+    def compact(self, results):
+        # Остановившиеся пути больше не меняются: их итог уходит в results.
+        self.store(results)
+        keep = self.active
+        for name in self.__slots__:
+            if name != 'losses':
+                setattr(self, name, getattr(self, name)[keep])
+        self.losses.compact(keep)
+
+def split_goals(sim, active, parts):
+    # split_goal для путей, где бот разрешает разделить цель: не режим Азамата,
+    # цель дня еще не делилась и положительна. Цели из нескольких копеек, где
+    # часть вышла бы нулевой или отрицательной, не делятся.
+    rows = np.flatnonzero(active & ~sim.in_azamat_mode & ~sim.has_sub_goals & (sim.target > 0))
+    if not rows.size:
+        return
+    goal = sim.target[rows]
+    part = np.rint(goal / parts).astype(np.int64)
+    last = goal - part * (parts - 1)
+    valid = (part > 0) & (last > 0)
+    rows, part, last = rows[valid], part[valid], last[valid]
+    if not rows.size:
+        return
+    for _ in range(parts - 1):
+        sim.losses.push(rows, part)
+    sim.losses.push(rows, last)
+    sim.in_azamat_mode[rows] = True
+    sim.has_sub_goals[rows] = True
+    sim.target[rows] = sim.losses.peek(rows) + sim.losses.peek(rows, 1)
+
+def simulate_bankroll(state, coefficients, win_probability=None, weights=None,
+                      paths=10000, max_bets=MAX_SIMULATION_BETS, ruin_bank=0, seed=None,
+                      goal_percentage=GOAL_PERCENTAGE, max_stake_percentage=MAX_STAKE_PERCENTAGE,
+                      split_parts=0):
+    started = time.perf_counter()
+    coefficients = np.atleast_1d(np.asarray(coefficients, dtype=np.float64))
+    if coefficients.size == 0 or (coefficients <= 1.0).any():
+        raise ValueError("Коэффициенты должны быть больше 1")
+    if win_probability is not None and not 0.0 <= win_probability <= 1.0:
+        raise ValueError("Вероятность выигрыша должна быть от 0 до 1")
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+        weights = weights / weights.sum()
+    if state.initial_balance <= 0:
+        raise ValueError("Не задан начальный банк")
+    if paths <= 0 or max_bets < 0:
+        raise ValueError("Число путей должно быть положительным")
+    probabilities = get_win_probabilities(coefficients, win_probability)
+    rng = np.random.default_rng(seed)
+    target_banks = get_target_banks(state.initial_balance, goal_percentage)
+    sim = BankPaths(state, paths, ruin_bank, max_stake_percentage)
+    results = {name: np.zeros(paths, dtype=getattr(sim, name).dtype) for name in BankPaths.RESULT_FIELDS}
+
+    for _ in range(max_bets):
+        active = sim.active
+        if active.sum() < COMPACT_RATIO * len(active):
+            sim.compact(results)
+            active = sim.active
+        if not len(active):
+            break
+        # Исходы тянутся для всех путей, чтобы поток случайных чисел не
+        # зависел от того, какие пути уже остановились.
+        coeff, won = draw_bets(rng, coefficients, probabilities, weights, paths)
+        if len(sim.ids) < paths:
+            coeff, won = coeff[sim.ids], won[sim.ids]
+        losses = sim.losses
+        if split_parts > 1:
+            split_goals(sim, active, split_parts)
+
+        # Ставка: рекомендованная calculate_stake, но не больше максимальной.
+        stake = np.where(sim.target > 0, np.rint(sim.target / (coeff - 1)), 0).astype(np.int64)
+        stuck = active & (stake <= 0)
+        if stuck.any():
+            sim.stalled |= stuck
+            active &= ~stuck
+        np.maximum(sim.max_stake_share, np.where(active, stake / np.maximum(sim.bank, 1), 0.0), out=sim.max_stake_share)
+        sim.capped_bets += active & (stake > sim.max_stakes)
+        stake = np.minimum(stake, sim.max_stakes)
+        sim.bets_made += active
+        win = active & won
+        loss = active & ~won
+
+        # process_win / process_loss: банк.
+        profit = np.rint(stake * (coeff - 1)).astype(np.int64)
+        sim.bank += np.where(win, profit, 0) - np.where(loss, stake, 0)
+
+        # process_win в режиме Азамата: прибыль гасит цели по очереди, остаток
+        # уменьшает первую непогашенную.
+        repay = win & sim.in_azamat_mode & (losses.count > 0)
+        if repay.any():
+            rows = np.flatnonzero(repay)
+            remaining = profit[rows]
+            while rows.size:
+                front = losses.peek(rows)
+                paid = remaining >= front
+                partial = ~paid & (remaining > 0)
+                losses.reduce_front(rows[partial], remaining[partial])
+                rows, remaining = rows[paid], remaining[paid] - front[paid]
+                losses.pop(rows)
+                unpaid = losses.count[rows] > 0
+                rows, remaining = rows[unpaid], remaining[unpaid]
+            zero_rows = np.flatnonzero(repay & sim.has_zero_losses)
+            if zero_rows.size:
+                losses.drop_zeros(zero_rows)
+                sim.has_zero_losses[zero_rows] = False
+
+        # process_loss: ставка уходит в очередь отыгрыша.
+        loss_rows = np.flatnonzero(loss)
+        if loss_rows.size:
+            losses.push(loss_rows, stake[loss_rows])
+
+        # Новая цель: calculate_azamat_target в режиме Азамата, иначе план.
+        plan_goal = target_banks[sim.day] - sim.bank
+        azamat_target = plan_goal.copy()
+        rows = np.flatnonzero(active & (losses.count >= 2))
+        azamat_target[rows] = losses.peek(rows) + losses.peek(rows, 1)
+        sim.in_azamat_mode = np.where(win, repay & (losses.count > 0), sim.in_azamat_mode) | (loss & (losses.count >= 2))
+        sim.target = np.where(active, np.where(sim.in_azamat_mode, azamat_target, plan_goal), sim.target)
+
+        # check_and_advance_day: день сдвигается только с первого дня или когда
+        # банк дорос до целевого банка текущего дня; новый день (get_target_day
+        # + 1) ищется бинарным поиском по плану только для таких путей.
+        candidates = np.flatnonzero(active & ((sim.day <= 1) | (plan_goal <= 0)))
+        if candidates.size:
+            new_day = np.maximum(np.searchsorted(target_banks[1:MAX_PLAN_DAYS + 1], sim.bank[candidates],
+                                                 side='right'), 1) + 1
+            advanced = candidates[new_day > sim.day[candidates]]
+            new_day = new_day[new_day > sim.day[candidates]]
+            if advanced.size:
+                sim.day[advanced] = new_day
+                sim.in_azamat_mode[advanced] = False
+                losses.clear(advanced)
+                sim.has_zero_losses[advanced] = False
+                sim.has_sub_goals[advanced] = False
+                sim.target[advanced] = target_banks[new_day] - sim.bank[advanced]
+
+        sim.max_stakes = get_stake_limits(sim.bank, max_stake_percentage)
+        ruined_now = active & ((sim.bank < ruin_bank) | (sim.max_stakes <= 0))
+        completed_now = active & ~ruined_now & (sim.day > MAX_PLAN_DAYS)
+        sim.ruined |= ruined_now
+        sim.completed |= completed_now
+        sim.active = active & ~(ruined_now | completed_now)
+
+    sim.store(results)
+    return SimulationResult(
+        paths=paths, max_bets=max_bets, elapsed=time.perf_counter() - started,
+        days=results['day'], final_banks=results['bank'], bets_made=results['bets_made'],
+        ruined=results['ruined'], completed=results['completed'], stalled=results['stalled'],
+        unfinished=results['active'],
+        max_stake_share=results['max_stake_share'], capped_bets=results['capped_bets'],
+        max_stake_percentage=max_stake_percentage,
+    )
+
+def summarize_simulation(result):
+    days = result.days
+    stake_ratio = result.max_stake_share / result.max_stake_percentage
+    return {
+        'paths': result.paths,
+        'max_bets': result.max_bets,
+        'elapsed': result.elapsed,
+        'ruin_probability': float(result.ruined.mean()),
+        'completion_probability': float(result.completed.mean()),
+        'stalled_probability': float(result.stalled.mean()),
+        'unfinished_probability': float(result.unfinished.mean()),
+        'days_mean': float(days.mean()),
+        'days': dict(zip(SUMMARY_PERCENTILES, np.percentile(days, SUMMARY_PERCENTILES).tolist())),
+        'final_bank': dict(zip(SUMMARY_PERCENTILES, np.percentile(result.final_banks, SUMMARY_PERCENTILES).tolist())),
+        'bets_mean': float(result.bets_made.mean()),
+        'max_stake_ratio': dict(zip(SUMMARY_PERCENTILES, np.percentile(stake_ratio, SUMMARY_PERCENTILES).tolist())),
+        'stake_cap_probability': float((result.capped_bets > 0).mean()),
+    }
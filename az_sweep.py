@@ -0,0 +1,186 @@
+# Офлайн-подбор параметров стратегии: перебор по сетке GOAL_PERCENTAGE,
+# MAX_STAKE_PERCENTAGE и числа частей при разделении цели дня, для каждой
+# комбинации - Монте-Карло симуляция банка (az_simulator) в отдельном процессе.
+#
+#   python az_sweep.py --out sweep.csv
+#   python az_sweep.py --out sweep.csv --goal 0.01 0.015 0.02 --max-stake 0.1 0.2 --split 0 2 4
+#   python az_sweep.py --out sweep.csv --rank-only --top 20
+#
+# Каждая посчитанная комбинация сразу дописывается строкой в CSV, поэтому
+# прерванный перебор продолжается с того же места: при повторном запуске с
+# тем же --out уже посчитанные строки пропускаются. Строки с другими
+# исходными условиями (банк, коэффициенты, число путей, seed) в том же файле
+# не мешают: они не пропускаются и не попадают в рейтинг.
+#
+# Все комбинации считаются на одном и том же seed: разница между ними - от
+# параметров, а не от случайных чисел. Рейтинг - по вероятности не разориться,
+# затем по среднему дню плана.
+import argparse
+import concurrent.futures
+import csv
+import itertools
+import os
+import sys
+
+from az_engine import (
+    GOAL_PERCENTAGE, MAX_PLAN_DAYS, MAX_STAKE_PERCENTAGE, SPLIT_GOAL_PARTS, BankState,
+    calculate_daily_goal, calculate_target_bank, to_kopecks,
+)
+
+# Сетка по умолчанию: текущие значения бота и соседние.
+DEFAULT_GOALS = (0.01, 0.0125, GOAL_PERCENTAGE, 0.02, 0.025)
+DEFAULT_MAX_STAKES = (0.1, 0.15, MAX_STAKE_PERCENTAGE, 0.25, 0.3)
+DEFAULT_SPLITS = (0, 2, 3, SPLIT_GOAL_PARTS, 6)
+
+RUN_COLUMNS = ('bank', 'day', 'coefficients', 'win_probability', 'paths', 'max_bets', 'ruin_bank', 'seed')
+CONFIG_COLUMNS = ('goal_percentage', 'max_stake_percentage', 'split_parts')
+RESULT_COLUMNS = (
+    'survival_probability', 'completion_probability', 'unfinished_probability', 'days_mean', 'days_p5',
+    'days_p50', 'days_p95', 'final_bank_p50', 'stake_cap_probability', 'elapsed',
+)
+COLUMNS = RUN_COLUMNS + CONFIG_COLUMNS + RESULT_COLUMNS
+
+
+def make_run(args):
+    return {
+        'bank': to_kopecks(args.bank),
+        'day': args.day,
+        'coefficients': ' '.join(f'{coeff:g}' for coeff in args.coeff),
+        'win_probability': '' if args.probability is None else f'{args.probability:g}',
+        'paths': args.paths,
+        'max_bets': args.max_bets,
+        'ruin_bank': args.ruin_bank,
+        'seed': args.seed,
+    }
+
+
+def make_state(run, goal_percentage):
+    # Новый банк, как после первой "Сделать ставку": цель - план текущего дня.
+    state = BankState()
+    state.initial_balance = state.bank = run['bank']
+    state.day = run['day']
+    state.current_target = calculate_daily_goal(state.bank, calculate_target_bank(state.bank, state.day, goal_percentage))
+    return state
+
+
+def run_key(row):
+    return tuple(str(row[column]) for column in RUN_COLUMNS)
+
+
+def config_key(row):
+    return (float(row['goal_percentage']), float(row['max_stake_percentage']), int(row['split_parts']))
+
+
+# Выполняется в процессе пула: модули с NumPy грузятся там же.
+def simulate_config(run, config):
+    from az_simulator import simulate_bankroll, summarize_simulation
+    goal_percentage, max_stake_percentage, split_parts = config
+    probability = float(run['win_probability']) if run['win_probability'] else None
+    result = simulate_bankroll(
+        make_state(run, goal_percentage), [float(coeff) for coeff in run['coefficients'].split()], probability,
+        paths=run['paths'], max_bets=run['max_bets'], ruin_bank=run['ruin_bank'], seed=run['seed'],
+        goal_percentage=goal_percentage, max_stake_percentage=max_stake_percentage, split_parts=split_parts,
+    )
+    summary = summarize_simulation(result)
+    return dict(
+        run,
+        goal_percentage=goal_percentage,
+        max_stake_percentage=max_stake_percentage,
+        split_parts=split_parts,
+        survival_probability=round(1 - summary['ruin_probability'], 6),
+        completion_probability=round(summary['completion_probability'], 6),
+        unfinished_probability=round(summary['unfinished_probability'], 6),
+        days_mean=round(summary['days_mean'], 3),
+        days_p5=summary['days'][5],
+        days_p50=summary['days'][50],
+        days_p95=summary['days'][95],
+        final_bank_p50=round(summary['final_bank'][50]),
+        stake_cap_probability=round(summary['stake_cap_probability'], 6),
+        elapsed=round(summary['elapsed'], 3),
+    )
+
+
+def read_results(path):
+    if not os.path.exists(path):
+        return []
+    # Оборванная при остановке последняя строка отрезается, чтобы следующая
+    # дописанная не склеилась с ней.
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+    with open(path, newline='', encoding='utf-8') as f:
+        return [row for row in csv.DictReader(f) if all(row.get(column) for column in COLUMNS if column != 'win_probability')]
+
+
+def rank_results(rows, run):
+    rows = [row for row in rows if run_key(row) == run_key(run)]
+    return sorted(rows, key=lambda row: (-float(row['survival_probability']), -float(row['days_mean'])))
+
+
+def print_ranking(rows, top):
+    print(f"{'#':>3} {'цель':>7} {'макс.ставка':>11} {'частей':>6} {'выживание':>10} "
+          f"{'день ср.':>8} {'p5':>5} {'p50':>5} {'p95':>5} {'план':>7}")
+    for place, row in enumerate(rows[:top], 1):
+        print(f"{place:>3} {float(row['goal_percentage']):>7.2%} {float(row['max_stake_percentage']):>11.0%} "
+              f"{row['split_parts']:>6} {float(row['survival_probability']):>10.2%} {float(row['days_mean']):>8.1f} "
+              f"{float(row['days_p5']):>5.0f} {float(row['days_p50']):>5.0f} {float(row['days_p95']):>5.0f} "
+              f"{float(row['completion_probability']):>7.2%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Перебор параметров стратегии AZ-Calculator')
+    parser.add_argument('--out', default='sweep.csv')
+    parser.add_argument('--goal', type=float, nargs='+', default=DEFAULT_GOALS, help='цель дня, доля банка')
+    parser.add_argument('--max-stake', type=float, nargs='+', default=DEFAULT_MAX_STAKES,
+                        help='максимальная ставка, доля банка')
+    parser.add_argument('--split', type=int, nargs='+', default=DEFAULT_SPLITS,
+                        help='на сколько частей делить цель дня, 0 - не делить')
+    parser.add_argument('--coeff', type=float, nargs='+', default=[1.85])
+    parser.add_argument('--probability', type=float, default=None,
+                        help='вероятность выигрыша, по умолчанию 1/коэффициент')
+    parser.add_argument('--bank', type=float, default=1000.0, help='начальный банк, руб.')
+    parser.add_argument('--day', type=int, default=1)
+    parser.add_argument('--paths', type=int, default=20000)
+    # Как MAX_SIMULATION_BETS в az_simulator: сам он с numpy грузится только в процессах перебора.
+    parser.add_argument('--max-bets', type=int, default=10000,
+                        help=f'предел ставок на путь; путь идет до дня {MAX_PLAN_DAYS}')
+    parser.add_argument('--ruin-bank', type=int, default=1000, help='порог разорения, коп.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--rank-only', action='store_true', help='только рейтинг по уже посчитанному')
+    args = parser.parse_args()
+
+    run = make_run(args)
+    rows = read_results(args.out)
+    done = {config_key(row) for row in rows if run_key(row) == run_key(run)}
+    grid = [config for config in itertools.product(args.goal, args.max_stake, args.split) if config not in done]
+    if not args.rank_only and grid:
+        print(f"Комбинаций: {len(grid) + len(done)}, уже посчитано: {len(done)}, процессов: {args.workers}")
+        write_header = not os.path.exists(args.out) or not os.path.getsize(args.out)
+        with open(args.out, 'a', newline='', encoding='utf-8') as f, \
+                concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS)
+            if write_header:
+                writer.writeheader()
+            futures = [pool.submit(simulate_config, run, config) for config in grid]
+            try:
+                for finished, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                    row = future.result()
+                    writer.writerow(row)
+                    f.flush()
+                    rows.append(row)
+                    print(f"[{finished}/{len(grid)}] цель {row['goal_percentage']:.2%}, "
+                          f"макс. ставка {row['max_stake_percentage']:.0%}, частей {row['split_parts']}: "
+                          f"выживание {row['survival_probability']:.2%}, день {row['days_mean']:.1f} "
+                          f"({row['elapsed']:.1f} с)")
+            except KeyboardInterrupt:
+                pool.shutdown(wait=False, cancel_futures=True)
+                print(f"Остановлено, посчитанное сохранено в {args.out}: повторный запуск продолжит перебор")
+                sys.exit(1)
+    print_ranking(rank_results(rows, run), args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+# Микробенчмарки отдельных частей бота, чтобы настраивать их по одной:
+#
+#   python benchmarks/components.py              # все
+#   python benchmarks/components.py render state # выбранные
+#   python benchmarks/components.py --list
+#
+# Каждый бенчмарк работает с одноразовой базой и без сети (кроме "telegram",
+# который ходит в локальный поддельный Bot API).
+import argparse
+import json
+import random
+import time
+
+from harness import FIRST_CHAT_ID, FakeBotAPI, load_bot, make_callback
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def measure(label, func, repeat):
+    func()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = time.perf_counter() - started
+    per_op = elapsed / repeat * 1_000_000
+    print(f"  {label:<48} {per_op:10.2f} мкс/оп {repeat / elapsed:12.0f} оп/с")
+
+
+def make_state(B, chat_id):
+    B.add_authorized_user(chat_id)
+    B.get_user_state(chat_id)
+    B.create_bank(chat_id, f'Bench {chat_id}')
+    state = B.get_user_state(chat_id)
+    state.initial_balance = state.bank = 100000
+    state.day = 1
+    state.current_target = 1500
+    B.save_user_state(state)
+    return B.get_user_state(chat_id)
+
+
+@benchmark('engine')
+def bench_engine(B, repeat):
+    # Функции движка - прямо из az_engine: bot.py импортирует только то, что использует сам.
+    from az_engine import calculate_stake, calculate_target_bank, get_target_day, process_win
+    rng = random.Random(1)
+    banks = [rng.randint(50000, 5000000) for _ in range(1000)]
+    measure('calculate_stake', lambda: calculate_stake(1500, 1.85), repeat)
+    measure('calculate_target_bank', lambda: calculate_target_bank(100000, 150), repeat)
+    measure('get_target_day', lambda: get_target_day(banks[rng.randrange(1000)], 100000), repeat)
+    state = make_state(B, FIRST_CHAT_ID)
+
+    def win():
+        trial = B.copy_state(state)
+        trial.current_stake = 1000
+        trial.current_coeff = 2.0
+        process_win(trial)
+    measure('process_win (копия состояния)', win, repeat // 10)
+
+
+@benchmark('render')
+def bench_render(B, repeat):
+    def cold():
+        B.render_bank_movement_page.cache_clear()
+        B.get_growth_projection.cache_clear()
+        B.render_bank_movement_page(100000, 37, 3)
+    measure('render_bank_movement_page, холодный', cold, repeat // 10)
+    measure('render_bank_movement_page, из кэша', lambda: B.render_bank_movement_page(100000, 37, 3), repeat)
+    measure('format_bet_history', lambda: B.format_bet_history([]), repeat)
+
+
+@benchmark('keyboards')
+def bench_keyboards(B, repeat):
+    def cold():
+        B.bank_movement_keyboard.cache_clear()
+        B.bank_movement_keyboard(5).to_json()
+    measure('bank_movement_keyboard + to_json, холодный', cold, repeat // 10)
+    measure('bank_movement_keyboard + to_json, из кэша', lambda: B.bank_movement_keyboard(5).to_json(), repeat)
+    banks = [{'id': i, 'name': f'Bank {i}', 'day': i * 3} for i in range(1, 4)]
+    measure('banks_keyboard + to_json', lambda: B.banks_keyboard(banks).to_json(), repeat)
+
+
+@benchmark('router')
+def bench_router(B, repeat):
+    data = ['main_menu', 'statistics', 'select_bank_12', 'bank_movement_7', 'split_parts_1_3', 'unknown']
+    index = iter(range(10 ** 12))
+    measure('callback_router.resolve', lambda: B.callback_router.resolve(data[next(index) % len(data)]), repeat)
+
+
+@benchmark('state')
+def bench_state(B, repeat):
+    chat_id = FIRST_CHAT_ID + 1
+    make_state(B, chat_id)
+
+    def roundtrip():
+        state = B.get_user_state(chat_id)
+        state.current_coeff += 0.01
+        B.save_user_state(state)
+    measure('get_user_state + save_user_state', roundtrip, repeat // 10)
+
+    def flush():
+        roundtrip()
+        B.flush_state_cache()
+    measure('изменение + flush_state_cache', flush, repeat // 100)
+
+    def uncached():
+        B.invalidate_cached_state(chat_id)
+        B.get_user_state(chat_id)
+    measure('get_user_state из базы', uncached, repeat // 100)
+
+
+@benchmark('sessions')
+def bench_sessions(B, repeat):
+    # Память на одну сессию в кэше: копия UserSession вместе со списками.
+    import tracemalloc
+    state = make_state(B, FIRST_CHAT_ID + 3)
+    state.loss_record = [1250, 3000]
+    count = max(repeat // 10, 1)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    sessions = [B.copy_state(state) for _ in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    print(f"  {'UserSession в кэше':<48} {size / len(sessions):10.0f} байт/сессию")
+    measure('copy_state', lambda: B.copy_state(state), repeat)
+    measure('changed_fields', state.changed_fields, repeat)
+
+
+@benchmark('dispatcher')
+def bench_dispatcher(B, repeat):
+    dispatcher = B.ChatDispatcher(lambda update: None, B.DISPATCH_WORKERS, repeat)
+    dispatcher.start()
+    updates = [B.types.Update.de_json(json.dumps(dict(make_callback(FIRST_CHAT_ID + i % 100, 'main_menu', 1), update_id=i)))
+               for i in range(repeat)]
+    started = time.perf_counter()
+    for update in updates:
+        dispatcher.submit(update)
+    dispatcher.join()
+    elapsed = time.perf_counter() - started
+    stats = dispatcher.get_stats()
+    print(f"  {'ChatDispatcher submit -> обработка':<48} {elapsed / repeat * 1e6:10.2f} мкс/оп "
+          f"{repeat / elapsed:12.0f} оп/с, ожидание avg {stats['wait_avg'] * 1000:.2f} мс")
+
+
+@benchmark('telegram')
+def bench_telegram(B, repeat):
+    api = FakeBotAPI(port=0).start()
+    from telebot import apihelper
+    apihelper.API_URL = api.url + '/bot{0}/{1}'
+    chat_id = FIRST_CHAT_ID + 2
+    measure('bot.send_message через локальный API', lambda: B.bot.send_message(chat_id, 'ping'), repeat // 100)
+    outbox = B.OutboundQueue(B.bot, B.OUTBOX_WORKERS)
+    outbox.start()
+    count = repeat // 10
+    started = time.perf_counter()
+    for i in range(count):
+        outbox.send_message(FIRST_CHAT_ID + i % 50, f'ping {i}')
+    outbox.join()
+    elapsed = time.perf_counter() - started
+    print(f"  {'outbox.send_message до доставки':<48} {elapsed / count * 1e6:10.2f} мкс/оп {count / elapsed:12.0f} оп/с")
+    api.stop()
+
+
+@benchmark('metrics')
+def bench_metrics(B, repeat):
+    measure('Histogram.observe', lambda: B.HANDLER_LATENCY.observe(0.003, 'bench'), repeat)
+    measure('render_metrics', B.render_metrics, repeat // 100)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарки AZ-Calculator Bot')
+    parser.add_argument('names', nargs='*')
+    parser.add_argument('--repeat', type=int, default=20000)
+    parser.add_argument('--list', action='store_true')
+    args = parser.parse_args()
+    if args.list:
+        print('\n'.join(BENCHMARKS))
+        return
+    names = args.names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"неизвестные бенчмарки: {', '.join(unknown)}")
+    B = load_bot()
+    for name in names:
+        print(f"[{name}]")
+        BENCHMARKS[name](B, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+# Общая обвязка бенчмарков: локальный поддельный Bot API и загрузка bot.py
+# в одноразовом каталоге с собственной базой. Сеть к api.telegram.org не нужна.
+import collections
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'AZ', 'username': 'az_bench_bot'}
+FIRST_CHAT_ID = 10_000_000
+
+# Переменные окружения по умолчанию для прогонов: лимиты Telegram и запись
+# медленных трейсов в файл только мешают измерять сам бот.
+BENCH_ENV = {
+    'API_TOKEN': '123456:BENCH',
+    'OUTBOX_GLOBAL_RATE': '1000000',
+    'OUTBOX_CHAT_RATE': '1000000',
+    'OUTBOX_CHAT_BURST': '1000000',
+    'TRACE_SLOW_MS': '1000000000',
+    'TRACE_RECENT_SIZE': '1000000',
+    'HEALTH_PROBE_INTERVAL': '3600',
+    'LOG_LEVEL': 'WARNING',
+}
+
+
+class ReplyWaiter:
+    __slots__ = ('event', 'message_id')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.message_id = None
+
+    def wait(self, timeout):
+        return self.event.wait(timeout)
+
+
+# Минимальный Bot API: getUpdates (long polling), sendMessage,
+# editMessageText, answerCallbackQuery и служебные методы.
+class FakeBotAPI:
+    def __init__(self, host='127.0.0.1', port=8081, latency=0.0):
+        self.latency = latency
+        self.condition = threading.Condition()
+        self.updates = collections.deque()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000)
+        self.waiters = {}
+        self.callback_chats = {}
+        self.calls = collections.Counter()
+        self.app = Flask('fake_bot_api')
+        self.app.add_url_rule('/bot<token>/<method>', view_func=self.handle, methods=['GET', 'POST'])
+        # Без этого werkzeug пишет строку на каждый запрос и отчет теряется в логе.
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server = make_server(host, port, self.app, threaded=True)
+        self.url = f'http://{host}:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-bot-api', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    # --- сторона симулятора ---
+    def push_update(self, payload):
+        with self.condition:
+            update_id = next(self.update_ids)
+            payload = dict(payload, update_id=update_id)
+            if 'callback_query' in payload:
+                query = payload['callback_query']
+                query['id'] = str(update_id)
+                self.callback_chats[query['id']] = query['message']['chat']['id']
+            self.updates.append(payload)
+            self.condition.notify_all()
+        return update_id
+
+    def expect_reply(self, chat_id):
+        waiter = ReplyWaiter()
+        with self.condition:
+            self.waiters[chat_id] = waiter
+        return waiter
+
+    # --- сторона бота ---
+    def handle(self, token, method):
+        params = request.values.to_dict()
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if method == 'getUpdates':
+            return self.ok(self.get_updates(params))
+        if method == 'getMe':
+            return self.ok(BOT_USER)
+        if method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            message_id = next(self.message_ids)
+            self.reply(chat_id, message_id)
+            return self.ok(self.message(chat_id, message_id, params.get('text', '')))
+        if method == 'editMessageText':
+            chat_id = int(params['chat_id'])
+            message_id = int(params['message_id'])
+            self.reply(chat_id, message_id)
+            return self.ok(self.message(chat_id, message_id, params.get('text', '')))
+        if method == 'answerCallbackQuery':
+            with self.condition:
+                self.callback_chats.pop(params.get('callback_query_id'), None)
+        return self.ok(True)
+
+    def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self.condition:
+            while self.updates and self.updates[0]['update_id'] < offset:
+                self.updates.popleft()
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self.condition.wait(remaining)
+            return list(itertools.islice(self.updates, limit))
+
+    def reply(self, chat_id, message_id):
+        with self.condition:
+            waiter = self.waiters.pop(chat_id, None)
+        if waiter is not None:
+            waiter.message_id = message_id
+            waiter.event.set()
+
+    @staticmethod
+    def message(chat_id, message_id, text):
+        return {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': text}
+
+    @staticmethod
+    def ok(result):
+        return jsonify({'ok': True, 'result': result})
+
+
+def make_message(chat_id, text, message_id=1):
+    message = {'message_id': message_id, 'date': int(time.time()),
+               'chat': {'id': chat_id, 'type': 'private'},
+               'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+               'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'message': message}
+
+
+def make_callback(chat_id, data, message_id):
+    return {'callback_query': {
+        'id': '0', 'chat_instance': str(chat_id), 'data': data,
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+        'message': {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+                    'chat': {'id': chat_id, 'type': 'private'}, 'text': '...'},
+    }}
+
+
+# Импортирует bot.py в отдельном каталоге (там же создается база).
+def load_bot(api_url=None, workdir=None, env=None):
+    workdir = workdir or tempfile.mkdtemp(prefix='az-bench-')
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+    os.environ.update(env or {})
+    os.chdir(workdir)
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    from telebot import apihelper
+    import bot as bot_module
+    if api_url:
+        apihelper.API_URL = api_url + '/bot{0}/{1}'
+    bot_module.init_db()
+    return bot_module
+
+
+def start_bot_runtime(bot_module, polling=True):
+    bot_module.start_state_flusher()
+    bot_module.bot.dispatcher.start()
+    bot_module.outbox.start()
+    if polling:
+        thread = threading.Thread(
+            target=bot_module.bot.infinity_polling,
+            kwargs={'timeout': 5, 'long_polling_timeout': 1},
+            name='bench-polling', daemon=True)
+        thread.start()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def histogram_quantile(buckets, counts, q):
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q / 100 * total
+    cumulative = 0
+    for bound, count in zip(tuple(buckets) + (float('inf'),), counts):
+        cumulative += count
+        if cumulative >= rank:
+            return bound
+    return float('inf')
+
+
+def handler_latencies(bot_module):
+    # Время самого внешнего хендлера в каждом трейсе, мс.
+    latencies = []
+    for record in list(bot_module._recent_traces):
+        handlers = [span for span in record['spans'] if span['kind'] == 'handler']
+        if handlers:
+            latencies.append(max(span['duration_ms'] for span in handlers))
+    return latencies
@@ -0,0 +1,115 @@
+# Время холодного импорта движка (az_engine) и бота (bot) с бюджетами:
+#
+#   python benchmarks/import_time.py                    # медиана по 10 запускам
+#   python benchmarks/import_time.py --importtime 15    # самые тяжелые импорты bot
+#
+# Каждый замер идет в новом процессе python. Заодно проверяется, что импорт
+# ничего не запускает: az_engine и az_simulator не тянут telebot/flask/sqlite3,
+# bot не поднимает потоки и не импортирует flask и numpy. Код выхода 1, если
+# медиана вышла за бюджет или проверка не прошла.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from harness import BENCH_ENV, REPO_DIR, percentile
+
+PROBE = '''
+import json, sys, threading, time
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+print(json.dumps({{'ms': elapsed * 1000, 'threads': threading.active_count(),
+                  'modules': [name for name in {watched!r} if name in sys.modules]}}))
+'''
+
+# модуль -> (бюджет по умолчанию в мс, модули, которых не должно быть после импорта)
+TARGETS = {
+    'az_engine': (50.0, ('telebot', 'flask', 'sqlite3', 'requests', 'numpy')),
+    'az_simulator': (300.0, ('telebot', 'flask', 'sqlite3', 'requests')),
+    'bot': (500.0, ('flask', 'numpy')),
+}
+
+
+def probe_env():
+    env = dict(os.environ)
+    for key, value in BENCH_ENV.items():
+        env.setdefault(key, value)
+    env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    return env
+
+
+def run_probe(module, watched, workdir, env):
+    code = PROBE.format(module=module, watched=tuple(watched))
+    output = subprocess.run([sys.executable, '-c', code], cwd=workdir, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def print_importtime(module, top, workdir, env):
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=workdir, env=env, capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative_us), int(self_us), name.strip()))
+    print(f"Самые тяжелые импорты {module} (накопительно, мкс):")
+    for cumulative_us, self_us, name in sorted(rows, reverse=True)[:top]:
+        print(f"  {name:<40} {cumulative_us:>10} {self_us:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Холодный импорт AZ-Calculator Bot')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--budget-engine', type=float, default=TARGETS['az_engine'][0], help='мс')
+    parser.add_argument('--budget-simulator', type=float, default=TARGETS['az_simulator'][0], help='мс')
+    parser.add_argument('--budget-bot', type=float, default=TARGETS['bot'][0], help='мс')
+    parser.add_argument('--importtime', type=int, default=0, metavar='N',
+                        help='показать N самых тяжелых импортов bot (python -X importtime)')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    budgets = {'az_engine': args.budget_engine, 'az_simulator': args.budget_simulator, 'bot': args.budget_bot}
+
+    env = probe_env()
+    workdir = tempfile.mkdtemp(prefix='az-import-')
+    report = {}
+    failed = False
+    for module, (_, watched) in TARGETS.items():
+        runs = [run_probe(module, watched, workdir, env) for _ in range(args.repeat)]
+        times = [run['ms'] for run in runs]
+        problems = sorted({f"импортирован {name}" for run in runs for name in run['modules']})
+        if any(run['threads'] > 1 for run in runs):
+            problems.append('запущены потоки')
+        median = percentile(times, 50)
+        ok = median <= budgets[module] and not problems
+        failed = failed or not ok
+        report[module] = {
+            'median_ms': round(median, 2), 'min_ms': round(min(times), 2), 'max_ms': round(max(times), 2),
+            'budget_ms': budgets[module], 'problems': problems, 'ok': ok,
+        }
+    leftovers = os.listdir(workdir)
+    if leftovers:
+        report['bot']['problems'].append(f"созданы файлы: {', '.join(sorted(leftovers))}")
+        report['bot']['ok'] = False
+        failed = True
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        for module, stats in report.items():
+            status = 'OK' if stats['ok'] else 'ПРЕВЫШЕН' if not stats['problems'] else 'ОШИБКА'
+            print(f"{module:<12} медиана {stats['median_ms']:8.2f} мс (мин {stats['min_ms']}, макс {stats['max_ms']}), "
+                  f"бюджет {stats['budget_ms']} мс: {status}")
+            for problem in stats['problems']:
+                print(f"  - {problem}")
+        if args.importtime:
+            print_importtime('bot', args.importtime, workdir, env)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# Нагрузочный тест без сети: бот опрашивает локальный поддельный Bot API,
+# а симулированные пользователи проходят сценарий
+# /start -> создание банка -> начальный банк -> кф -> ставка -> выигрыш/проигрыш.
+#
+#   python benchmarks/load_test.py --users 2000 --concurrency 200 --bets 5
+#
+# Настройки бота (DISPATCH_WORKERS, DB_WAL_MODE, STATE_CACHE_ENABLED и т.д.)
+# передаются через окружение, как и в продакшене.
+import argparse
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from harness import (
+    FIRST_CHAT_ID, FakeBotAPI, handler_latencies, histogram_quantile, load_bot,
+    make_callback, make_message, percentile, start_bot_runtime,
+)
+
+
+class UserSimulator:
+    def __init__(self, api, bot_module, bets, reply_timeout, seed):
+        self.api = api
+        self.bot_module = bot_module
+        self.bets = bets
+        self.reply_timeout = reply_timeout
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.timeouts = 0
+        self.updates = 0
+
+    def step(self, chat_id, payload):
+        waiter = self.api.expect_reply(chat_id)
+        started = time.perf_counter()
+        self.api.push_update(payload)
+        replied = waiter.wait(self.reply_timeout)
+        elapsed = (time.perf_counter() - started) * 1000
+        with self.lock:
+            self.updates += 1
+            if replied:
+                self.latencies.append(elapsed)
+            else:
+                self.timeouts += 1
+        return waiter.message_id
+
+    def run_user(self, index):
+        rng = random.Random(self.seed + index)
+        chat_id = FIRST_CHAT_ID + index
+        self.bot_module.add_authorized_user(chat_id)
+        message_id = self.step(chat_id, make_message(chat_id, '/start'))
+        message_id = self.step(chat_id, make_callback(chat_id, 'manage_banks', message_id)) or message_id
+        message_id = self.step(chat_id, make_callback(chat_id, 'create_bank', message_id)) or message_id
+        self.step(chat_id, make_message(chat_id, f'Bank {index}'))
+        message_id = self.step(chat_id, make_message(chat_id, str(rng.choice((500, 1000, 2500, 10000)))))
+        for _ in range(self.bets):
+            message_id = self.step(chat_id, make_callback(chat_id, 'place_bet', message_id)) or message_id
+            self.step(chat_id, make_message(chat_id, f'{rng.uniform(1.5, 3.0):.2f}'))
+            message_id = self.step(chat_id, make_message(chat_id, '10'))
+            result = 'result_win' if rng.random() < 0.5 else 'result_loss'
+            message_id = self.step(chat_id, make_callback(chat_id, result, message_id)) or message_id
+
+
+def latency_summary(values):
+    return {name: round(percentile(values, q), 3) for name, q in (('p50', 50), ('p95', 95), ('p99', 99))}
+
+
+def lock_wait_report(bot_module):
+    report = {}
+    for (lock,), (counts, total) in bot_module.DB_LOCK_WAIT.snapshot().items():
+        acquisitions = sum(counts)
+        report[lock] = {
+            'acquisitions': acquisitions,
+            'contended': acquisitions - counts[0],
+            'total_wait_ms': round(total * 1000, 3),
+            'p99_wait_ms_upper_bound': histogram_quantile(bot_module.DB_LOCK_WAIT.buckets, counts, 99) * 1000,
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест AZ-Calculator Bot')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--bets', type=int, default=5)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--api-latency', type=float, default=0.0, help='задержка ответа поддельного API, сек')
+    parser.add_argument('--reply-timeout', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--json', action='store_true', help='вывести отчет в JSON')
+    args = parser.parse_args()
+
+    api = FakeBotAPI(port=args.port, latency=args.api_latency).start()
+    bot_module = load_bot(api.url, args.workdir)
+    start_bot_runtime(bot_module)
+    simulator = UserSimulator(api, bot_module, args.bets, args.reply_timeout, args.seed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(simulator.run_user, range(args.users)))
+    wall = time.perf_counter() - started
+    bot_module.outbox.join(timeout=30)
+    bot_module.flush_state_cache()
+
+    handler = handler_latencies(bot_module)
+    report = {
+        'users': args.users,
+        'updates': simulator.updates,
+        'timeouts': simulator.timeouts,
+        'wall_seconds': round(wall, 3),
+        'updates_per_second': round(simulator.updates / wall, 1) if wall else 0.0,
+        'reply_latency_ms': latency_summary(simulator.latencies),
+        'handler_latency_ms': latency_summary(handler),
+        'db_lock_wait': lock_wait_report(bot_module),
+        'api_calls': dict(api.calls),
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print(f"Пользователей: {report['users']}, апдейтов: {report['updates']}, таймаутов: {report['timeouts']}")
+    print(f"Время: {report['wall_seconds']} с, {report['updates_per_second']} апдейтов/с")
+    print("Задержка ответа, мс: " + ', '.join(f"{k} {v}" for k, v in report['reply_latency_ms'].items()))
+    print("Время хендлера, мс:  " + ', '.join(f"{k} {v}" for k, v in report['handler_latency_ms'].items()))
+    for lock, stats in report['db_lock_wait'].items():
+        print(f"Блокировка {lock}: захватов {stats['acquisitions']}, с ожиданием {stats['contended']}, "
+              f"суммарно {stats['total_wait_ms']} мс, p99 <= {stats['p99_wait_ms_upper_bound']} мс")
+    print("Вызовы API: " + ', '.join(f"{k} {v}" for k, v in sorted(report['api_calls'].items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# Повтор записанного потока апдейтов (RECORD_UPDATES_FILE) на чистой базе:
+#
+#   python benchmarks/replay.py capture.jsonl                 # максимальная скорость
+#   python benchmarks/replay.py capture.jsonl --speed 1       # в темпе записи
+#   python benchmarks/replay.py capture.jsonl --dispatcher    # через очереди чатов
+#
+# Апдейты проходят обычный путь bot.process_new_updates -> handle_all_callbacks /
+# handle_input, ответы уходят в локальный поддельный Bot API. В конце печатается
+# отчет по времени и контрольная сумма итогового состояния базы: при одинаковой
+# записи она должна совпадать между версиями, если поведение не менялось.
+import argparse
+import hashlib
+import json
+import sqlite3
+import time
+
+from harness import FakeBotAPI, load_bot, percentile, start_bot_runtime
+
+# Контрольная сумма не зависит от порядка, в котором разные чаты получили
+# AUTOINCREMENT id банков: строки упорядочены по (chat_id, имя банка), а
+# ссылки на банки заменены этой парой. Время ставок и создания не учитывается.
+CHECKSUM_QUERIES = (
+    ('users', 'SELECT users.*, banks.name AS current_bank_name FROM users '
+              'LEFT JOIN banks ON banks.id = users.current_bank_id ORDER BY users.chat_id'),
+    ('banks', 'SELECT * FROM banks ORDER BY chat_id, name, id'),
+    ('bets', 'SELECT banks.chat_id AS bank_chat_id, banks.name AS bank_name, bets.* FROM bets '
+             'JOIN banks ON banks.id = bets.bank_id ORDER BY banks.chat_id, banks.name, banks.id, bets.id'),
+    ('bank_stats', 'SELECT banks.chat_id AS bank_chat_id, banks.name AS bank_name, bank_stats.* FROM bank_stats '
+                   'JOIN banks ON banks.id = bank_stats.bank_id ORDER BY banks.chat_id, banks.name, banks.id'),
+)
+IGNORED_COLUMNS = {'id', 'bank_id', 'current_bank_id', 'ts', 'created_at'}
+
+
+def load_capture(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def capture_chat_ids(records):
+    chat_ids = set()
+    for record in records:
+        update = record['update']
+        for field in ('message', 'edited_message'):
+            if field in update:
+                chat_ids.add(update[field]['chat']['id'])
+        if 'callback_query' in update:
+            query = update['callback_query']
+            chat_ids.add(query['message']['chat']['id'] if 'message' in query else query['from']['id'])
+    return chat_ids
+
+
+def state_checksum(db_path):
+    digest = hashlib.sha256()
+    conn = sqlite3.connect(db_path)
+    try:
+        for table, query in CHECKSUM_QUERIES:
+            cursor = conn.execute(query)
+            columns = [column[0] for column in cursor.description]
+            keep = [i for i, name in enumerate(columns) if name not in IGNORED_COLUMNS]
+            digest.update(table.encode('utf-8'))
+            for row in cursor:
+                values = [round(row[i], 6) if isinstance(row[i], float) else row[i] for i in keep]
+                digest.update(json.dumps(values, ensure_ascii=False).encode('utf-8'))
+    finally:
+        conn.close()
+    return digest.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Повтор записанных апдейтов AZ-Calculator Bot')
+    parser.add_argument('capture')
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='0 - максимальная скорость, 1 - темп записи, 2 - вдвое быстрее и т.д.')
+    parser.add_argument('--dispatcher', action='store_true',
+                        help='обрабатывать через очереди чатов и исходящую очередь, как в продакшене')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    records = load_capture(args.capture)
+    api = FakeBotAPI(port=args.port).start()
+    B = load_bot(api.url, args.workdir)
+    for chat_id in capture_chat_ids(records):
+        B.add_authorized_user(chat_id)
+    if args.dispatcher:
+        start_bot_runtime(B, polling=False)
+
+    latencies = []
+    started = time.perf_counter()
+    for record in records:
+        if args.speed > 0:
+            delay = record['t'] / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+        update = B.types.Update.de_json(json.dumps(record['update']))
+        update_started = time.perf_counter()
+        B.bot.process_new_updates([update])
+        latencies.append((time.perf_counter() - update_started) * 1000)
+    if args.dispatcher:
+        B.bot.dispatcher.join()
+        B.outbox.join(timeout=30)
+    wall = time.perf_counter() - started
+    B.flush_state_cache()
+
+    handlers = {}
+    for (name,), (counts, total) in B.HANDLER_LATENCY.snapshot().items():
+        handlers[name] = {'calls': sum(counts), 'total_ms': round(total * 1000, 3)}
+    report = {
+        'updates': len(records),
+        'wall_seconds': round(wall, 3),
+        'updates_per_second': round(len(records) / wall, 1) if wall else 0.0,
+        'update_latency_ms': {name: round(percentile(latencies, q), 3)
+                              for name, q in (('p50', 50), ('p95', 95), ('p99', 99))},
+        'handlers': dict(sorted(handlers.items(), key=lambda item: -item[1]['total_ms'])),
+        'api_calls': dict(api.calls),
+        'state_checksum': state_checksum(B.DB_NAME),
+    }
+    api.stop()
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print(f"Апдейтов: {report['updates']}, время: {report['wall_seconds']} с, "
+          f"{report['updates_per_second']} апдейтов/с")
+    if not args.dispatcher:
+        print("Обработка апдейта, мс: " + ', '.join(f"{k} {v}" for k, v in report['update_latency_ms'].items()))
+    print("Хендлеры (вызовов, суммарно мс):")
+    for name, stats in report['handlers'].items():
+        print(f"  {name:<40} {stats['calls']:>7} {stats['total_ms']:>12.3f}")
+    print("Вызовы API: " + ', '.join(f"{k} {v}" for k, v in sorted(report['api_calls'].items())))
+    print(f"Контрольная сумма состояния: {report['state_checksum']}")
+
+
+if __name__ == '__main__':
+    main()
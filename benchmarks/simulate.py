@@ -0,0 +1,169 @@
+# Скорость и точность Монте-Карло симулятора банка (az_simulator):
+#
+#   python benchmarks/simulate.py                                   # 100k путей до дня 300
+#   python benchmarks/simulate.py --coeff 1.7 2.1 --probability 0.55
+#   python benchmarks/simulate.py --check 2000                      # сверка с az_engine
+#   python benchmarks/simulate.py --check 2000 --split 4 --max-stake 0.3
+#
+# --check повторяет те же случайные исходы пошагово через process_win /
+# process_loss / check_and_advance_day на BankState и сравнивает итог каждого
+# пути: день, банк, число ставок, причину остановки. Код выхода 1 при
+# расхождении или если симуляция дольше --budget секунд.
+import argparse
+import json
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+
+from az_engine import (
+    GOAL_PERCENTAGE, MAX_PLAN_DAYS, MAX_STAKE_PERCENTAGE, BankState, calculate_daily_goal,
+    calculate_max_stake, calculate_stake, calculate_target_bank, check_and_advance_day,
+    process_loss, process_win, split_amount, split_goal, to_kopecks,
+)
+from az_simulator import MAX_SIMULATION_BETS, draw_bets, get_win_probabilities, simulate_bankroll, summarize_simulation
+
+
+def make_start_state(args):
+    state = BankState()
+    state.initial_balance = state.bank = to_kopecks(args.bank)
+    state.day = args.day
+    state.loss_record = [int(amount) for amount in args.losses.split(',') if amount]
+    state.in_azamat_mode = len(state.loss_record) >= 2
+    state.current_target = calculate_daily_goal(state.bank, calculate_target_bank(state.bank, state.day, args.goal))
+    if state.in_azamat_mode:
+        state.current_target = state.loss_record[0] + state.loss_record[1]
+    return state
+
+
+def copy_bank_state(state):
+    copy = BankState()
+    for name in BankState.__slots__:
+        setattr(copy, name, getattr(state, name))
+    copy.loss_record = list(state.loss_record)
+    copy.sub_goals = list(state.sub_goals)
+    return copy
+
+
+# Пошаговый прогон тех же путей через движок: (день, банк, ставок, превышений, итог).
+def replay_with_engine(start, args, paths):
+    coefficients = np.asarray(args.coeff, dtype=np.float64)
+    probabilities = get_win_probabilities(coefficients, args.probability)
+    rng = np.random.default_rng(args.seed)
+    states = [copy_bank_state(start) for _ in range(paths)]
+    outcome = []
+    for state in states:
+        stopped = 'ruined' if state.bank < args.ruin_bank or calculate_max_stake(state.bank, args.max_stake) <= 0 else (
+            'completed' if state.day > MAX_PLAN_DAYS else None)
+        outcome.append([0, 0, stopped])
+    for _ in range(args.max_bets):
+        if all(result[2] for result in outcome):
+            break
+        coeffs, wins = draw_bets(rng, coefficients, probabilities, None, paths)
+        for state, result, coeff, won in zip(states, outcome, coeffs.tolist(), wins.tolist()):
+            if result[2]:
+                continue
+            if args.split > 1 and not state.in_azamat_mode and not state.sub_goals and state.current_target > 0 \
+                    and min(split_amount(state.current_target, args.split)) > 0:
+                split_goal(state, args.split)
+            stake = calculate_stake(state.current_target, coeff)
+            if stake <= 0:
+                result[2] = 'stalled'
+                continue
+            max_stake = calculate_max_stake(state.bank, args.max_stake)
+            if stake > max_stake:
+                result[1] += 1
+                stake = max_stake
+            state.current_stake = stake
+            state.current_coeff = coeff
+            result[0] += 1
+            process_win(state) if won else process_loss(state)
+            state.pending_bets = None
+            check_and_advance_day(state)
+            if state.bank < args.ruin_bank or calculate_max_stake(state.bank, args.max_stake) <= 0:
+                result[2] = 'ruined'
+            elif state.day > MAX_PLAN_DAYS:
+                result[2] = 'completed'
+    return [(state.day, state.bank, bets, capped, stopped)
+            for state, (bets, capped, stopped) in zip(states, outcome)]
+
+
+def run_simulation(start, args, paths):
+    return simulate_bankroll(start, args.coeff, args.probability, paths=paths, max_bets=args.max_bets,
+                             ruin_bank=args.ruin_bank, seed=args.seed, goal_percentage=args.goal,
+                             max_stake_percentage=args.max_stake, split_parts=args.split)
+
+
+def check_against_engine(start, args):
+    paths = args.check
+    result = run_simulation(start, args, paths)
+    stopped = np.where(result.ruined, 'ruined', np.where(result.completed, 'completed',
+                       np.where(result.stalled, 'stalled', 'None')))
+    simulated = [(int(day), int(bank), int(bets), int(capped), None if status == 'None' else str(status))
+                 for day, bank, bets, capped, status in zip(result.days, result.final_banks,
+                                                            result.bets_made, result.capped_bets, stopped)]
+    expected = replay_with_engine(start, args, paths)
+    return [(i, got, want) for i, (got, want) in enumerate(zip(simulated, expected)) if got != want]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Монте-Карло симулятор банка AZ-Calculator')
+    parser.add_argument('--paths', type=int, default=100_000)
+    parser.add_argument('--max-bets', type=int, default=MAX_SIMULATION_BETS,
+                        help=f'предел ставок на путь; путь идет до дня {MAX_PLAN_DAYS}')
+    parser.add_argument('--coeff', type=float, nargs='+', default=[1.85])
+    parser.add_argument('--probability', type=float, default=None,
+                        help='вероятность выигрыша, по умолчанию 1/коэффициент')
+    parser.add_argument('--bank', type=float, default=1000.0, help='начальный банк, руб.')
+    parser.add_argument('--day', type=int, default=1)
+    parser.add_argument('--losses', default='', help='цели для отыгрыша в копейках через запятую')
+    parser.add_argument('--ruin-bank', type=int, default=1000, help='порог разорения, коп.')
+    parser.add_argument('--goal', type=float, default=GOAL_PERCENTAGE, help='цель дня, доля банка')
+    parser.add_argument('--max-stake', type=float, default=MAX_STAKE_PERCENTAGE, help='макс. ставка, доля банка')
+    parser.add_argument('--split', type=int, default=0, help='делить цель дня на N частей')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--budget', type=float, default=30.0, help='секунд на --paths путей')
+    parser.add_argument('--check', type=int, default=0, metavar='N',
+                        help='сверить N путей с пошаговым расчетом через az_engine')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    if args.check and args.goal != GOAL_PERCENTAGE:
+        parser.error('--check сверяет с az_engine, где цель дня - GOAL_PERCENTAGE')
+
+    start = make_start_state(args)
+    result = run_simulation(start, args, args.paths)
+    report = summarize_simulation(result)
+    report['budget_ok'] = result.elapsed <= args.budget
+    if args.check:
+        mismatches = check_against_engine(start, args)
+        report['check'] = {'paths': args.check, 'mismatches': len(mismatches),
+                           'first': [list(map(str, mismatch)) for mismatch in mismatches[:5]]}
+    failed = not report['budget_ok'] or bool(args.check and report['check']['mismatches'])
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(f"Путей: {result.paths}, предел ставок на путь: {result.max_bets}, время: {result.elapsed:.2f} с "
+              f"({result.bets_made.sum() / result.elapsed / 1e6:.1f} млн ставок/с), "
+              f"бюджет {args.budget} с: {'OK' if report['budget_ok'] else 'ПРЕВЫШЕН'}")
+        print(f"Разорение: {report['ruin_probability']:.2%}, план пройден: {report['completion_probability']:.2%}, "
+              f"без цели: {report['stalled_probability']:.2%}, не дошли до конца: {report['unfinished_probability']:.2%}")
+        print(f"Ставок на путь в среднем: {report['bets_mean']:.1f}")
+        print("День (перцентили): " + ', '.join(f"p{q} {v:.0f}" for q, v in report['days'].items())
+              + f", среднее {report['days_mean']:.1f}")
+        print("Макс. ставка / лимит: " + ', '.join(f"p{q} {v:.2f}" for q, v in report['max_stake_ratio'].items())
+              + f", упирались в лимит: {report['stake_cap_probability']:.2%}")
+        if args.check:
+            check = report['check']
+            print(f"Сверка с az_engine: {check['paths']} путей, расхождений {check['mismatches']}")
+            for mismatch in check['first']:
+                print(f"  - {mismatch}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,29 +3,85 @@ import telebot
 from telebot import types
 import sqlite3
 import threading
+import contextlib
+import collections
+import signal
+import atexit
 import json
+import hashlib
+import hmac
+import array
+import functools
+import operator
+import bisect
 import logging
+import logging.handlers
+import gzip
+import shutil
 import time
 import sys
-import traceback
 from datetime import datetime
 import os
-import requests
+import queue
+import concurrent.futures
+
+from az_engine import (
+    MAX_STAKE_PERCENTAGE, MAX_PLAN_DAYS, SPLIT_GOAL_PARTS, GROWTH_RATE, GROWTH_FACTORS,
+    BankState, calculate_stake, calculate_target_bank, calculate_daily_goal,
+    check_and_advance_day, calculate_azamat_target, split_goal, process_win, process_loss,
+    to_kopecks, format_rubles, calculate_profit, calculate_max_stake, split_amount,
+)
 
 # === ДЛЯ СЕРВЕРА ===
-from flask import Flask
-app = Flask(__name__)
+# Flask импортируется и запускается только из start_web_server(): импорт
+# bot.py не поднимает веб-поток и не занимает порт.
+web_app = None
+web_thread = None
+
+def create_web_app():
+    from flask import Flask, request, jsonify
+    app = Flask(__name__)
+
+    @app.route('/')
+    def home():
+        return "🤖 AZ-Calculator Bot is RUNNING 24/7!"
 
-@app.route('/')
-def home():
-    return "🤖 AZ-Calculator Bot is RUNNING 24/7!"
+    # /webhook есть только в режиме webhook: при polling апдейты из сети не принимаются.
+    if BOT_MODE == 'webhook':
+        @app.route('/webhook', methods=['POST'])
+        def telegram_webhook():
+            if not is_webhook_secret_valid(request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')):
+                WEBHOOK_STATS['forbidden'] += 1
+                return "forbidden", 403
+            status = enqueue_webhook_update(request.get_data(as_text=True))
+            if status == 'bad_request':
+                return "bad request", 400
+            if status == 'busy':
+                return "busy", 503, {'Retry-After': str(WEBHOOK_RETRY_AFTER)}
+            return "ok", 200
 
-def run_web():
-    app.run(host='0.0.0.0', port=8080)
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
-web_thread = threading.Thread(target=run_web)
-web_thread.daemon = True
-web_thread.start()
+    @app.route('/health')
+    def health():
+        snapshot = get_health_snapshot()
+        payload = snapshot._asdict()
+        payload['checked_at'] = snapshot.checked_at.isoformat(timespec='seconds')
+        payload['uptime'] = get_bot_uptime()
+        return jsonify(payload), (200 if snapshot.api_ok and snapshot.db_ok else 503)
+
+    return app
+
+def start_web_server(host='0.0.0.0', port=8080):
+    global web_app, web_thread
+    if web_thread is None:
+        web_app = create_web_app()
+        web_thread = threading.Thread(target=web_app.run, kwargs={'host': host, 'port': port}, name='web')
+        web_thread.daemon = True
+        web_thread.start()
+    return web_thread
 # === КОНЕЦ ===
 
 # --- СИСТЕМА БЕЗОПАСНОСТИ ---
@@ -87,59 +143,1209 @@ def security_check(chat_id):
     return True
 
 # --- НАСТРОЙКА ЛОГИРОВАНИЯ ---
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot_errors.log', encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+# Хендлеры только кладут запись в очередь; в файл (с ротацией по размеру и
+# сжатием старых частей) и в stdout ее пишет отдельный поток QueueListener.
+# Настраивается в main(), а не при импорте.
+LOG_FILE = os.environ.get('LOG_FILE', 'bot_errors.log')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', str(5 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', '5'))
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.environ.get('LOG_LEVELS', 'TeleBot=INFO,urllib3=WARNING,werkzeug=WARNING')
+
+def parse_log_levels(spec):
+    levels = {}
+    for item in spec.split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+def setup_logging():
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.namer = lambda name: name + '.gz'
+    file_handler.rotator = gzip_rotator
+    stream_handler = logging.StreamHandler(sys.stdout)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+    log_queue = queue.Queue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in parse_log_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+    setup_trace_file()
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = None
 logger = logging.getLogger(__name__)
 
 def log_error(error_message, exc_info=None):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    if exc_info:
-        error_details = f"\n{traceback.format_exc()}"
-    else:
-        error_details = ""
-    full_error = f"[{timestamp}] ERROR: {error_message}{error_details}\n{'='*50}\n"
+    HANDLER_ERRORS.inc(get_current_handler())
+    logger.error(error_message, exc_info=exc_info)
+
+# --- МЕТРИКИ ---
+# Простой реестр в текстовом формате Prometheus, отдается Flask на /metrics.
+# Гистограммы хранят счетчики по корзинам и суммируются только при выгрузке.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_metric_labels(labelnames, labelvalues, extra=''):
+    parts = []
+    for name, value in zip(labelnames, labelvalues):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.lock:
+            values = list(self.values.items())
+        for labelvalues, value in sorted(values):
+            lines.append(f'{self.name}{format_metric_labels(self.labelnames, labelvalues)} {value}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labelvalues)
+            if series is None:
+                series = self.series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {labelvalues: (list(counts), total) for labelvalues, (counts, total) in self.series.items()}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = [(labelvalues, list(counts), total) for labelvalues, (counts, total) in self.series.items()]
+        for labelvalues, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                labels = format_metric_labels(self.labelnames, labelvalues, f'le="{le}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_metric_labels(self.labelnames, labelvalues)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+class GaugeFunction:
+    # Значение считается в момент выгрузки: func возвращает число или
+    # словарь {кортеж значений меток: число}.
+    def __init__(self, name, documentation, func, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.labelnames = labelnames
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        try:
+            values = self.func()
+        except Exception as e:
+            logger.warning(f"Не удалось посчитать метрику {self.name}: {e}")
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labelvalues, value in sorted(values.items()):
+            lines.append(f'{self.name}{format_metric_labels(self.labelnames, labelvalues)} {value}')
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.register(Histogram(
+    'bot_handler_duration_seconds', 'Время выполнения handle_* функций', ('handler',)))
+HANDLER_ERRORS = metrics.register(Counter(
+    'bot_handler_errors_total', 'Ошибки, залогированные внутри хендлера', ('handler',)))
+DB_QUERY_LATENCY = metrics.register(Histogram(
+    'bot_db_query_duration_seconds', 'Время выполнения SQL-запросов', ('statement',)))
+TELEGRAM_API_LATENCY = metrics.register(Histogram(
+    'bot_telegram_api_duration_seconds', 'Время вызовов Telegram Bot API', ('method',)))
+TELEGRAM_API_ERRORS = metrics.register(Counter(
+    'bot_telegram_api_errors_total', 'Ошибки вызовов Telegram Bot API', ('method',)))
+DB_LOCK_WAIT = metrics.register(Histogram(
+    'bot_db_lock_wait_seconds', 'Ожидание блокировок базы', ('lock',),
+    buckets=(0.0, 0.0001, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)))
+
+_handler_context = threading.local()
+
+def get_current_handler():
+    stack = getattr(_handler_context, 'stack', None)
+    return stack[-1] if stack else 'none'
+
+def observe_handler(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = getattr(_handler_context, 'stack', None)
+        if stack is None:
+            stack = _handler_context.stack = []
+        stack.append(name)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_LATENCY.observe(elapsed, name)
+            stack.pop()
+            trace = current_trace()
+            if trace is not None:
+                trace.add_span(name, 'handler', started, elapsed)
+    return wrapper
+
+@contextlib.contextmanager
+def observe_telegram_call(method, trace=None):
+    started = time.perf_counter()
     try:
-        with open('bot_errors.log', 'a', encoding='utf-8') as f:
-            f.write(full_error)
+        yield
     except Exception:
-        print("Не удалось записать лог в файл.")
-    print(full_error)
-    logger.error(full_error)
+        TELEGRAM_API_ERRORS.inc(method)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        TELEGRAM_API_LATENCY.observe(elapsed, method)
+        if trace is not None:
+            trace.add_span(method, 'telegram', started, elapsed)
+
+def sql_statement_kind(sql):
+    kind = sql.lstrip()[:8].split(None, 1)
+    return kind[0].upper() if kind else 'OTHER'
+
+def observe_db_query(sql, started):
+    elapsed = time.perf_counter() - started
+    DB_QUERY_LATENCY.observe(elapsed, sql_statement_kind(sql))
+    trace = current_trace()
+    if trace is not None:
+        trace.add_span(' '.join(sql.split())[:80], 'db', started, elapsed)
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            observe_db_query(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            observe_db_query(sql, started)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            observe_db_query('COMMIT', started)
+
+def register_runtime_gauges():
+    def lru_ratio(func):
+        info = func.cache_info()
+        total = info.hits + info.misses
+        return info.hits / total if total else 0.0
+
+    def cache_hit_ratios():
+        ratios = {
+            ('state_cache',): get_state_cache_stats()['hit_ratio'],
+            ('db_pool',): get_db_pool_stats()['hit_ratio'],
+            ('bank_movement_pages',): lru_ratio(render_bank_movement_page),
+            ('growth_projection',): lru_ratio(get_growth_projection),
+        }
+        for builder in KEYBOARD_BUILDERS:
+            ratios[(f'keyboard:{builder.__name__}',)] = lru_ratio(builder)
+        return ratios
+
+    def queue_depths():
+        depths = {('outbox',): get_outbox_stats()['queue_depth']}
+        for index, depth in enumerate(get_dispatcher_stats()['queue_depths']):
+            depths[(f'dispatcher:{index}',)] = depth
+        return depths
+
+    metrics.register(GaugeFunction('bot_active_sessions', 'Сессии в кэше состояний',
+                                   lambda: get_state_cache_stats()['size']))
+    metrics.register(GaugeFunction('bot_dirty_sessions', 'Сессии с несохраненными изменениями',
+                                   lambda: get_state_cache_stats()['dirty']))
+    metrics.register(GaugeFunction('bot_cache_hit_ratio', 'Доля попаданий в кэши',
+                                   cache_hit_ratios, ('cache',)))
+    metrics.register(GaugeFunction('bot_queue_depth', 'Глубина очередей', queue_depths, ('queue',)))
+    metrics.register(GaugeFunction('bot_uptime_seconds', 'Время работы бота',
+                                   lambda: (datetime.now() - BOT_START_TIME).total_seconds()))
+
+def render_metrics():
+    return metrics.render()
+
+# --- ТРАССИРОВКА ---
+# Один трейс на апдейт: спаны хендлеров, работы с состоянием, SQL-запросов и
+# вызовов Telegram API. Трейс закрывается, когда хендлер завершился и все
+# поставленные им в исходящую очередь запросы отправлены. Медленные трейсы
+# пишутся в JSONL, последние хранятся в памяти для команды /traces.
+# Ожидание в исходящей очереди (включая лимиты скорости) - спаны вида
+# 'queue': они видны в трейсе, но в порог TRACE_SLOW_MS не входят.
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '500'))
+TRACE_FILE = os.environ.get('TRACE_FILE', 'slow_traces.jsonl')
+TRACE_MAX_BYTES = int(os.environ.get('TRACE_MAX_BYTES', str(5 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = int(os.environ.get('TRACE_BACKUP_COUNT', '3'))
+TRACE_RECENT_SIZE = int(os.environ.get('TRACE_RECENT_SIZE', '200'))
+
+_trace_local = threading.local()
+_recent_traces = collections.deque(maxlen=TRACE_RECENT_SIZE)
+trace_logger = logging.getLogger('traces')
+trace_logger.propagate = False
+
+# Файл медленных трейсов ротируется и сжимается так же, как лог ошибок.
+def setup_trace_file():
+    handler = logging.handlers.RotatingFileHandler(
+        TRACE_FILE, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUP_COUNT, encoding='utf-8')
+    handler.namer = lambda name: name + '.gz'
+    handler.rotator = gzip_rotator
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    for old_handler in list(trace_logger.handlers):
+        trace_logger.removeHandler(old_handler)
+    trace_logger.addHandler(handler)
+    trace_logger.setLevel(logging.INFO)
+
+class Trace:
+    __slots__ = ('trace_id', 'name', 'started_at', 'started', 'spans', 'lock', 'pending', 'handler_done')
+
+    def __init__(self, trace_id, name):
+        self.trace_id = trace_id
+        self.name = name
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.handler_done = False
+
+    def add_span(self, name, kind, started, elapsed):
+        with self.lock:
+            self.spans.append((name, kind, started - self.started, elapsed))
+
+    def hold(self):
+        with self.lock:
+            self.pending += 1
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+            done = self.handler_done and self.pending == 0
+        if done:
+            finish_trace(self)
+
+    def finish_handler(self):
+        with self.lock:
+            self.handler_done = True
+            done = self.pending == 0
+        if done:
+            finish_trace(self)
+
+def current_trace():
+    return getattr(_trace_local, 'trace', None)
+
+def get_update_trace_name(update):
+    if update.callback_query is not None:
+        return f"callback:{update.callback_query.data}"
+    if update.message is not None and update.message.text and update.message.text.startswith('/'):
+        return f"command:{update.message.text.split()[0]}"
+    if update.message is not None:
+        return 'message'
+    return 'update'
+
+def start_trace(update):
+    trace = Trace(update.update_id, get_update_trace_name(update))
+    _trace_local.trace = trace
+    return trace
+
+def end_trace(trace):
+    _trace_local.trace = None
+    trace.finish_handler()
+
+# Время под спанами без ожидания в очереди; вложенные и параллельные спаны
+# считаются один раз.
+def get_busy_time(spans):
+    busy = 0.0
+    busy_until = float('-inf')
+    for start, elapsed in sorted((start, elapsed) for _, kind, start, elapsed in spans if kind != 'queue'):
+        if start + elapsed > busy_until:
+            busy += start + elapsed - max(start, busy_until)
+            busy_until = start + elapsed
+    return busy
+
+def finish_trace(trace):
+    duration = time.perf_counter() - trace.started
+    record = {
+        'trace_id': trace.trace_id,
+        'name': trace.name,
+        'at': trace.started_at.isoformat(timespec='seconds'),
+        'duration_ms': round(duration * 1000, 3),
+        'busy_ms': round(get_busy_time(trace.spans) * 1000, 3),
+        'spans': [
+            {'name': name, 'kind': kind, 'start_ms': round(start * 1000, 3), 'duration_ms': round(elapsed * 1000, 3)}
+            for name, kind, start, elapsed in sorted(trace.spans, key=lambda span: span[2])
+        ],
+    }
+    _recent_traces.append(record)
+    if record['busy_ms'] >= TRACE_SLOW_MS:
+        trace_logger.info(json.dumps(record, ensure_ascii=False))
+
+def get_slowest_traces(limit=10):
+    return sorted(list(_recent_traces), key=lambda record: record['busy_ms'], reverse=True)[:limit]
+
+def format_slowest_traces(limit=10):
+    traces = get_slowest_traces(limit)
+    if not traces:
+        return "🐢 Трейсов пока нет"
+    lines = [f"🐢 Самые медленные апдейты (из последних {len(_recent_traces)}):", ""]
+    for record in traces:
+        totals = {}
+        for span in record['spans']:
+            if span['kind'] != 'handler':
+                count, total = totals.get(span['kind'], (0, 0.0))
+                totals[span['kind']] = (count + 1, total + span['duration_ms'])
+        breakdown = ', '.join(f"{kind} {total:.1f} мс ×{count}" for kind, (count, total) in sorted(totals.items()))
+        lines.append(f"• {record['at'][11:]} {record['name']}: {record['busy_ms']:.1f} мс "
+                     f"(с очередью {record['duration_ms']:.1f} мс)")
+        if breakdown:
+            lines.append(f"   {breakdown}")
+    slowest = traces[0]
+    lines.append("")
+    lines.append(f"Самый медленный ({slowest['name']}):")
+    for span in sorted(slowest['spans'], key=lambda span: span['duration_ms'], reverse=True)[:10]:
+        lines.append(f"   +{span['start_ms']:.1f} мс [{span['kind']}] {span['name']}: {span['duration_ms']:.1f} мс")
+    return '\n'.join(lines)
+
+def traced_call(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        trace = current_trace()
+        if trace is None:
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            trace.add_span(name, 'state', started, time.perf_counter() - started)
+    return wrapper
 
 # --- КОНСТАНТЫ ---
 API_TOKEN = os.environ.get('API_TOKEN', '8242937436:AAEySDUKm1fjhraDeS3IzgHr9CPmqhDcGc0')
-GOAL_PERCENTAGE = 0.015
-MAX_STAKE_PERCENTAGE = 0.20
 MIN_BANK_AMOUNT = 10.0
 MAX_BANK_AMOUNT = 100000.0
+MIN_BANK_KOPECKS = to_kopecks(MIN_BANK_AMOUNT)
+MAX_BANK_KOPECKS = to_kopecks(MAX_BANK_AMOUNT)
 MIN_COEFF = 1.1
 MAX_COEFF = 9.9
 DB_NAME = 'bot_state.db'
 MAX_BANKS = 4
 MAX_BET_HISTORY = 10
+BANK_MOVEMENT_DAYS_PER_PAGE = 15
+BANK_MOVEMENT_PAGES = 20
+DB_CACHED_STATEMENTS = int(os.environ.get('DB_CACHED_STATEMENTS', '128'))
+DB_PRAGMAS = os.environ.get('DB_PRAGMAS', 'temp_store=MEMORY,cache_size=-8000')
+DB_WAL_MODE = os.environ.get('DB_WAL_MODE', '0') == '1'
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))
+STATE_CACHE_ENABLED = os.environ.get('STATE_CACHE_ENABLED', '1') == '1'
+STATE_CACHE_MAX_SIZE = int(os.environ.get('STATE_CACHE_MAX_SIZE', '1000'))
+STATE_CACHE_TTL = int(os.environ.get('STATE_CACHE_TTL', '1800'))
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', '2'))
+HEALTH_PROBE_INTERVAL = float(os.environ.get('HEALTH_PROBE_INTERVAL', '30'))
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+BOT_MODES = ('polling', 'webhook')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', '4'))
+DISPATCH_QUEUE_SIZE = int(os.environ.get('DISPATCH_QUEUE_SIZE', '250'))
+WEBHOOK_RETRY_AFTER = 1
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', '4'))
+OUTBOX_GLOBAL_RATE = float(os.environ.get('OUTBOX_GLOBAL_RATE', '30'))
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', '1'))
+OUTBOX_CHAT_BURST = int(os.environ.get('OUTBOX_CHAT_BURST', '5'))
+OUTBOX_MAX_RETRIES = 3
+RECORD_UPDATES_FILE = os.environ.get('RECORD_UPDATES_FILE', '')
+RECORD_SALT = os.environ.get('RECORD_SALT', '')
+MESSAGE_DIGEST_CACHE_SIZE = int(os.environ.get('MESSAGE_DIGEST_CACHE_SIZE', '5000'))
+SIMULATION_PATHS = int(os.environ.get('SIMULATION_PATHS', '10000'))
+SIMULATION_MAX_BETS = int(os.environ.get('SIMULATION_MAX_BETS', '10000'))
+SIMULATION_WORKERS = int(os.environ.get('SIMULATION_WORKERS', '1'))
+SIMULATION_QUEUE_SIZE = int(os.environ.get('SIMULATION_QUEUE_SIZE', '8'))
+SIMULATION_COOLDOWN = float(os.environ.get('SIMULATION_COOLDOWN', '30'))
+SIMULATION_MAX_COEFFS = 10
+
+# --- ДИСПЕТЧЕР АПДЕЙТОВ ---
+# Апдейты раскладываются по очередям по chat_id: разные пользователи
+# обрабатываются параллельно, а апдейты одного пользователя - строго по порядку.
+def get_update_chat_id(update):
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    for event in (update.inline_query, update.chosen_inline_result, update.shipping_query, update.pre_checkout_query):
+        if event is not None:
+            return event.from_user.id
+    return update.update_id
+
+class ChatDispatcher:
+    def __init__(self, process, workers, queue_size):
+        self.process = process
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self.threads = []
+        self.stats_lock = threading.Lock()
+        self.stats = {'submitted': 0, 'rejected': 0, 'processed': 0, 'errors': 0,
+                      'wait_total': 0.0, 'wait_max': 0.0}
+
+    def start(self):
+        if self.threads:
+            return
+        for index, worker_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self.worker_loop, args=(worker_queue,),
+                                      name=f'chat-worker-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    @property
+    def running(self):
+        return bool(self.threads)
+
+    def submit(self, update, block=True):
+        worker_queue = self.queues[hash(get_update_chat_id(update)) % len(self.queues)]
+        try:
+            worker_queue.put((time.perf_counter(), update), block=block)
+        except queue.Full:
+            with self.stats_lock:
+                self.stats['rejected'] += 1
+            return False
+        with self.stats_lock:
+            self.stats['submitted'] += 1
+        return True
+
+    def worker_loop(self, worker_queue):
+        while True:
+            enqueued_at, update = worker_queue.get()
+            wait = time.perf_counter() - enqueued_at
+            try:
+                self.process(update)
+                failed = False
+            except Exception as e:
+                failed = True
+                log_error(f"Ошибка обработки апдейта {update.update_id}: {e}", exc_info=True)
+            finally:
+                worker_queue.task_done()
+            with self.stats_lock:
+                self.stats['processed'] += 1
+                self.stats['errors'] += failed
+                self.stats['wait_total'] += wait
+                self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+
+    def join(self):
+        for worker_queue in self.queues:
+            worker_queue.join()
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        depths = [worker_queue.qsize() for worker_queue in self.queues]
+        stats['workers'] = len(self.queues)
+        stats['queue_depths'] = depths
+        stats['queue_depth'] = sum(depths)
+        stats['wait_avg'] = stats['wait_total'] / stats['processed'] if stats['processed'] else 0.0
+        return stats
+
+# --- ЗАПИСЬ АПДЕЙТОВ ---
+# При заданном RECORD_UPDATES_FILE входящие апдейты пишутся в JSONL для
+# benchmarks/replay.py. Идентификаторы чатов и пользователей заменяются
+# стабильным в пределах записи HMAC, имена и username удаляются.
+RECORDED_UPDATE_FIELDS = ('message', 'edited_message', 'callback_query')
+ANONYMOUS_ID_BASE = 10 ** 12
+
+class UpdateRecorder:
+    def __init__(self, path, salt=''):
+        self.path = path
+        self.salt = (salt or os.urandom(16).hex()).encode('utf-8')
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.file = None
+
+    def anonymize_id(self, value):
+        digest = hmac.new(self.salt, str(value).encode('utf-8'), hashlib.sha256).digest()
+        return ANONYMOUS_ID_BASE + int.from_bytes(digest[:8], 'big') % ANONYMOUS_ID_BASE
+
+    def anonymize(self, value):
+        if isinstance(value, dict):
+            result = {}
+            for field, item in value.items():
+                if field in ('first_name', 'last_name', 'username'):
+                    continue
+                if field in ('chat', 'from', 'sender_chat') and isinstance(item, dict):
+                    item = dict(self.anonymize(item), id=self.anonymize_id(item.get('id')))
+                    if field != 'chat' or item.get('type') == 'private':
+                        item.setdefault('first_name', 'user')
+                    result[field] = item
+                elif field == 'chat_instance':
+                    result[field] = str(self.anonymize_id(item))
+                else:
+                    result[field] = self.anonymize(item)
+            return result
+        if isinstance(value, list):
+            return [self.anonymize(item) for item in value]
+        return value
+
+    def record(self, update):
+        payload = {'update_id': update.update_id}
+        for field in RECORDED_UPDATE_FIELDS:
+            event = getattr(update, field)
+            if event is not None and isinstance(event.json, dict):
+                payload[field] = self.anonymize(event.json)
+        if len(payload) == 1:
+            return
+        line = json.dumps({'t': round(time.monotonic() - self.started, 6), 'update': payload}, ensure_ascii=False)
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(line + '\n')
+            self.file.flush()
+
+update_recorder = UpdateRecorder(RECORD_UPDATES_FILE, RECORD_SALT) if RECORD_UPDATES_FILE else None
+
+def record_update(update):
+    if update_recorder is not None:
+        try:
+            update_recorder.record(update)
+        except Exception as e:
+            log_error(f"Ошибка записи апдейта {update.update_id}: {e}")
+
+class ChatAffineTeleBot(telebot.TeleBot):
+    # Хендлеры выполняются синхронно внутри потока диспетчера (threaded=False),
+    # поэтому порядок апдейтов одного чата сохраняется.
+    def __init__(self, token, **kwargs):
+        kwargs.setdefault('threaded', False)
+        super().__init__(token, **kwargs)
+        self.dispatcher = ChatDispatcher(self.process_update, DISPATCH_WORKERS, DISPATCH_QUEUE_SIZE)
+
+    def process_update(self, update):
+        trace = start_trace(update)
+        try:
+            super().process_new_updates([update])
+        finally:
+            end_trace(trace)
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            record_update(update)
+        if not self.dispatcher.running:
+            for update in updates:
+                self.process_update(update)
+            return
+        for update in updates:
+            # Базовый process_new_updates сюда не попадает, поэтому offset для
+            # getUpdates сдвигаем сами, иначе апдейты придут повторно.
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            self.dispatcher.submit(update)
 
 # --- ИНИЦИАЛИЗАЦИЯ БОТА ---
 try:
-    bot = telebot.TeleBot(API_TOKEN)
-    print("✅ Бот инициализирован")
+    bot = ChatAffineTeleBot(API_TOKEN)
 except Exception as e:
     log_error(f"Ошибка инициализации бота: {e}", exc_info=True)
     sys.exit(1)
 
-db_lock = threading.Lock()
+def get_dispatcher_stats():
+    return bot.dispatcher.get_stats()
+
+# --- ИСХОДЯЩАЯ ОЧЕРЕДЬ ---
+# Хендлеры только кладут ответ в очередь, а отправкой занимаются отдельные
+# потоки. Сообщения одного чата идут по одной полосе в исходном порядке,
+# скорость ограничивается общим и початовым token bucket, ответ 429 ставит
+# отправку на паузу на retry_after, а несколько ожидающих правок одного
+# сообщения схлопываются в последнюю. Правка, совпадающая с тем, что уже
+# показано в сообщении, не отправляется вовсе.
+def message_digest(text, kwargs):
+    markup = kwargs.get('reply_markup')
+    if markup is not None and not isinstance(markup, str):
+        markup = markup.to_json()
+    payload = json.dumps([text, markup, kwargs.get('parse_mode')], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).digest()
+
+def is_not_modified_error(error):
+    return error.error_code == 400 and 'message is not modified' in (error.description or '')
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        # Забирает токен (возможно, в долг) и возвращает, сколько секунд ждать.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def is_idle(self):
+        with self.lock:
+            return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class OutboundJob:
+    __slots__ = ('method', 'chat_id', 'edit_key', 'args', 'kwargs', 'cancelled', 'digest', 'trace', 'enqueued')
+
+    def __init__(self, method, chat_id, edit_key, args, kwargs, digest=None):
+        self.method = method
+        self.chat_id = chat_id
+        self.edit_key = edit_key
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.digest = digest
+        self.trace = current_trace()
+        self.enqueued = time.perf_counter()
+
+class OutboundLane:
+    def __init__(self):
+        self.jobs = collections.deque()
+        self.condition = threading.Condition()
+        self.pending_edits = {}
+        self.chat_buckets = {}
+        self.busy = False
+
+class OutboundQueue:
+    def __init__(self, bot, workers):
+        self.bot = bot
+        self.lanes = [OutboundLane() for _ in range(max(1, workers))]
+        self.global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+        self.pause_until = 0.0
+        self.threads = []
+        self.stats_lock = threading.Lock()
+        self.stats = {'queued': 0, 'sent': 0, 'coalesced': 0, 'throttled': 0, 'failed': 0, 'unchanged': 0}
+        self.digests = collections.OrderedDict()
+        self.digests_lock = threading.Lock()
+
+    def start(self):
+        if self.threads:
+            return
+        for index, lane in enumerate(self.lanes):
+            thread = threading.Thread(target=self.worker_loop, args=(lane,),
+                                      name=f'outbox-worker-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.submit(OutboundJob('send_message', chat_id, None, (chat_id, text), kwargs,
+                                message_digest(text, kwargs)))
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        edit_key = (chat_id, message_id)
+        digest = message_digest(text, kwargs)
+        if not self.remember_digest(edit_key, digest):
+            with self.stats_lock:
+                self.stats['unchanged'] += 1
+            return
+        kwargs.update(chat_id=chat_id, message_id=message_id)
+        self.submit(OutboundJob('edit_message_text', chat_id, edit_key, (text,), kwargs, digest))
+
+    def remember_digest(self, key, digest):
+        # Возвращает False, если сообщение уже показывает именно это содержимое.
+        with self.digests_lock:
+            if self.digests.get(key) == digest:
+                self.digests.move_to_end(key)
+                return False
+            self.digests[key] = digest
+            self.digests.move_to_end(key)
+            while len(self.digests) > MESSAGE_DIGEST_CACHE_SIZE:
+                self.digests.popitem(last=False)
+            return True
+
+    def forget_digest(self, key, digest):
+        with self.digests_lock:
+            if self.digests.get(key) == digest:
+                del self.digests[key]
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self.submit(OutboundJob('answer_callback_query', None, None, (callback_query_id, text), kwargs))
+
+    def submit(self, job):
+        if not self.threads:
+            self.execute(job)
+            return
+        if job.trace is not None:
+            job.trace.hold()
+        lane_key = job.chat_id if job.chat_id is not None else job.args[0]
+        lane = self.lanes[hash(lane_key) % len(self.lanes)]
+        coalesced = False
+        with lane.condition:
+            if job.edit_key is not None:
+                previous = lane.pending_edits.get(job.edit_key)
+                if previous is not None:
+                    previous.cancelled = True
+                    coalesced = True
+                lane.pending_edits[job.edit_key] = job
+            lane.jobs.append(job)
+            lane.condition.notify()
+        with self.stats_lock:
+            self.stats['queued'] += 1
+            self.stats['coalesced'] += coalesced
+
+    def worker_loop(self, lane):
+        while True:
+            with lane.condition:
+                while not lane.jobs:
+                    lane.condition.wait()
+                job = lane.jobs.popleft()
+                if job.edit_key is not None and lane.pending_edits.get(job.edit_key) is job:
+                    del lane.pending_edits[job.edit_key]
+                lane.busy = not job.cancelled
+            if job.cancelled:
+                if job.trace is not None:
+                    job.trace.release()
+                continue
+            try:
+                self.wait_for_slot(lane, job)
+                if job.trace is not None:
+                    job.trace.add_span(job.method, 'queue', job.enqueued, time.perf_counter() - job.enqueued)
+                self.execute(job)
+            finally:
+                with lane.condition:
+                    lane.busy = False
+                    lane.condition.notify_all()
+                if job.trace is not None:
+                    job.trace.release()
+
+    def wait_for_slot(self, lane, job):
+        if job.chat_id is None:
+            delay = 0.0
+        else:
+            bucket = lane.chat_buckets.get(job.chat_id)
+            if bucket is None:
+                if len(lane.chat_buckets) > 10000:
+                    lane.chat_buckets = {chat_id: b for chat_id, b in lane.chat_buckets.items() if not b.is_idle()}
+                bucket = lane.chat_buckets[job.chat_id] = TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+            delay = max(self.global_bucket.reserve(), bucket.reserve())
+        delay = max(delay, self.pause_until - time.monotonic())
+        if delay > 0:
+            time.sleep(delay)
+
+    def execute(self, job):
+        method = getattr(self.bot, job.method)
+        for attempt in range(OUTBOX_MAX_RETRIES + 1):
+            try:
+                with observe_telegram_call(job.method, job.trace):
+                    result = method(*job.args, **job.kwargs)
+                if job.method == 'send_message' and result is not None:
+                    self.remember_digest((job.chat_id, result.message_id), job.digest)
+                with self.stats_lock:
+                    self.stats['sent'] += 1
+                return
+            except telebot.apihelper.ApiTelegramException as e:
+                if is_not_modified_error(e):
+                    with self.stats_lock:
+                        self.stats['unchanged'] += 1
+                    return
+                if e.error_code != 429 or attempt == OUTBOX_MAX_RETRIES:
+                    log_error(f"Ошибка отправки {job.method}: {e}")
+                    break
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                self.pause_until = max(self.pause_until, time.monotonic() + retry_after)
+                with self.stats_lock:
+                    self.stats['throttled'] += 1
+                time.sleep(retry_after)
+            except Exception as e:
+                log_error(f"Ошибка отправки {job.method}: {e}", exc_info=True)
+                break
+        if job.edit_key is not None:
+            self.forget_digest(job.edit_key, job.digest)
+        with self.stats_lock:
+            self.stats['failed'] += 1
+
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for lane in self.lanes:
+            with lane.condition:
+                while lane.jobs or lane.busy:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    lane.condition.wait(remaining)
+        return True
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['queue_depth'] = sum(len(lane.jobs) for lane in self.lanes)
+        return stats
+
+outbox = OutboundQueue(bot, OUTBOX_WORKERS)
+
+def get_outbox_stats():
+    return outbox.get_stats()
+
+# --- СИМУЛЯЦИИ ---
+# /simulate считается в своем пуле потоков: NumPy-расчет в потоке диспетчера
+# задержал бы все чаты, попавшие на тот же поток. На чат - одна симуляция за
+# раз и пауза SIMULATION_COOLDOWN секунд после нее, всего в работе и в
+# очереди не больше SIMULATION_QUEUE_SIZE. Отчет отправляет сама задача.
+class SimulationRunner:
+    def __init__(self, workers, queue_size, cooldown):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.cooldown = cooldown
+        self.executor = None
+        self.lock = threading.Lock()
+        self.running = set()
+        self.finished_at = {}
+
+    def start(self):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                                  thread_name_prefix='simulation')
+
+    # Возвращает None, если задача принята, иначе текст отказа для пользователя.
+    def submit(self, chat_id, job):
+        with self.lock:
+            if chat_id in self.running:
+                return "⏳ Предыдущая симуляция еще считается, отчет придет отдельным сообщением"
+            wait = self.finished_at.get(chat_id, 0.0) + self.cooldown - time.monotonic()
+            if wait > 0:
+                return f"⏳ Следующую симуляцию можно запустить через {int(wait) + 1} с"
+            if len(self.running) >= self.queue_size:
+                return "⏳ Сейчас считается много симуляций, попробуйте через минуту"
+            self.running.add(chat_id)
+        if self.executor is None:
+            self.run(chat_id, job)
+        else:
+            self.executor.submit(self.run, chat_id, job)
+        return None
+
+    def run(self, chat_id, job):
+        try:
+            job()
+        except Exception as e:
+            log_error(f"Ошибка симуляции для {chat_id}: {e}", exc_info=True)
+        finally:
+            with self.lock:
+                self.running.discard(chat_id)
+                now = time.monotonic()
+                if len(self.finished_at) > 10000:
+                    self.finished_at = {key: finished for key, finished in self.finished_at.items()
+                                        if now - finished < self.cooldown}
+                self.finished_at[chat_id] = now
+
+simulations = SimulationRunner(SIMULATION_WORKERS, SIMULATION_QUEUE_SIZE, SIMULATION_COOLDOWN)
+
+# --- WEBHOOK ---
+# Flask принимает апдейт, кладет его в очередь диспетчера и сразу отвечает.
+# При переполнении очереди отдаем 503, и Telegram повторит доставку позже.
+WEBHOOK_STATS = {'accepted': 0, 'rejected': 0, 'forbidden': 0, 'invalid': 0}
+
+def is_webhook_secret_valid(header):
+    if not WEBHOOK_SECRET:
+        return False
+    return hmac.compare_digest(header.encode('utf-8'), WEBHOOK_SECRET.encode('utf-8'))
+
+def enqueue_webhook_update(raw_update):
+    try:
+        update = types.Update.de_json(raw_update)
+    except Exception as e:
+        WEBHOOK_STATS['invalid'] += 1
+        log_error(f"Некорректный апдейт в webhook: {e}")
+        return 'bad_request'
+    if update is None:
+        WEBHOOK_STATS['invalid'] += 1
+        return 'bad_request'
+    if not bot.dispatcher.submit(update, block=False):
+        WEBHOOK_STATS['rejected'] += 1
+        return 'busy'
+    record_update(update)
+    WEBHOOK_STATS['accepted'] += 1
+    return 'ok'
+
+# Ошибки настройки, с которыми бот не запускается.
+def check_startup_config():
+    if BOT_MODE not in BOT_MODES:
+        raise SystemExit(f"❌ Неизвестный BOT_MODE={BOT_MODE!r}: допустимо {' или '.join(BOT_MODES)}")
+    if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+        raise SystemExit("❌ BOT_MODE=webhook требует WEBHOOK_SECRET: без него /webhook примет апдейт от кого угодно")
+
+def run_webhook_mode():
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + '/webhook', secret_token=WEBHOOK_SECRET)
+        print(f"🌐 Webhook установлен: {WEBHOOK_URL}")
+    else:
+        print("🌐 WEBHOOK_URL не задан: принимаем апдейты только локально на /webhook")
+    while web_thread.is_alive():
+        time.sleep(1)
+
+class TimedLock:
+    # Обычный Lock, который пишет время ожидания захвата в DB_LOCK_WAIT.
+    __slots__ = ('lock', 'name')
+
+    def __init__(self, name):
+        self.lock = threading.Lock()
+        self.name = name
+
+    def __enter__(self):
+        if self.lock.acquire(blocking=False):
+            DB_LOCK_WAIT.observe(0.0, self.name)
+            return self
+        started = time.perf_counter()
+        self.lock.acquire()
+        elapsed = time.perf_counter() - started
+        DB_LOCK_WAIT.observe(elapsed, self.name)
+        trace = current_trace()
+        if trace is not None:
+            trace.add_span(self.name, 'lock', started, elapsed)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.lock.release()
+
+db_lock = TimedLock('db')
+# Фиксированный набор блокировок вместо отдельной на каждый chat_id: память
+# не растет с числом чатов, а чаты на одной полосе просто делят блокировку.
+CHAT_LOCK_STRIPES = 64
+_chat_locks = tuple(TimedLock('chat') for _ in range(CHAT_LOCK_STRIPES))
+
+# В режиме WAL читатели не блокируют писателя, поэтому глобальный db_lock
+# заменяется блокировкой по chat_id, а чтения идут без блокировки.
+def chat_lock(chat_id):
+    if not DB_WAL_MODE:
+        return db_lock
+    return _chat_locks[hash(chat_id) % CHAT_LOCK_STRIPES]
+
+def read_lock():
+    if not DB_WAL_MODE:
+        return db_lock
+    return contextlib.nullcontext()
+
+# --- ПУЛ СОЕДИНЕНИЙ ---
+# Одно долгоживущее соединение на рабочий поток: без повторного открытия файла,
+# разбора схемы и с переиспользованием подготовленных запросов (cached_statements).
+_db_local = threading.local()
+_db_pool_lock = threading.Lock()
+_db_connections = []
+_db_generation = 0
+DB_POOL_STATS = {'hits': 0, 'misses': 0}
+
+def parse_db_pragmas(pragmas):
+    result = []
+    for item in (pragmas or '').split(','):
+        if '=' not in item:
+            continue
+        name, value = item.split('=', 1)
+        name, value = name.strip(), value.strip()
+        if name.replace('_', '').isalnum() and value:
+            result.append((name, value))
+    return result
+
+def get_db_connection():
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and _db_local.key == (DB_NAME, _db_generation):
+        with _db_pool_lock:
+            DB_POOL_STATS['hits'] += 1
+        return conn
+    conn = sqlite3.connect(
+        DB_NAME,
+        check_same_thread=False,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=DB_CACHED_STATEMENTS,
+        factory=TimedConnection
+    )
+    if DB_WAL_MODE:
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+    for name, value in parse_db_pragmas(DB_PRAGMAS):
+        conn.execute(f'PRAGMA {name} = {value}')
+    _db_local.conn = conn
+    _db_local.key = (DB_NAME, _db_generation)
+    with _db_pool_lock:
+        _db_connections.append(conn)
+        DB_POOL_STATS['misses'] += 1
+    return conn
+
+def close_db_connections():
+    global _db_generation
+    with _db_pool_lock:
+        connections = list(_db_connections)
+        _db_connections.clear()
+        _db_generation += 1
+    for conn in connections:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+def rollback_db_connection():
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+
+def get_db_pool_stats():
+    with _db_pool_lock:
+        stats = dict(DB_POOL_STATS)
+        stats['open'] = len(_db_connections)
+    total = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = (stats['hits'] / total) if total else 0.0
+    return stats
 
 # --- БАЗА ДАННЫХ ---
+# Версия схемы хранится в PRAGMA user_version:
+# 1 - денежные колонки banks, bets и bank_stats в целых копейках (INTEGER).
+DB_SCHEMA_VERSION = 1
+
+BANKS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        name TEXT,
+        balance INTEGER DEFAULT 0,
+        day INTEGER DEFAULT 1,
+        initial_balance INTEGER DEFAULT 0,
+        daily_goal INTEGER DEFAULT 0,
+        current_target INTEGER DEFAULT 0,
+        current_coeff REAL DEFAULT 0,
+        current_stake INTEGER DEFAULT 0,
+        in_azamat_mode INTEGER DEFAULT 0,
+        loss_record TEXT DEFAULT '[]',
+        sub_goals TEXT DEFAULT '[]',
+        original_goal INTEGER DEFAULT 0,
+        total_bets INTEGER DEFAULT 0,
+        total_wins INTEGER DEFAULT 0,
+        bet_history TEXT DEFAULT '[]',
+        awaiting_bet_result INTEGER DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (chat_id) REFERENCES users (chat_id)
+    )
+'''
+BETS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bank_id INTEGER NOT NULL,
+        ts REAL NOT NULL,
+        coefficient REAL,
+        stake INTEGER,
+        result TEXT,
+        bank_after INTEGER,
+        FOREIGN KEY (bank_id) REFERENCES banks (id)
+    )
+'''
+BANK_STATS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        bank_id INTEGER PRIMARY KEY,
+        bets INTEGER DEFAULT 0,
+        wins INTEGER DEFAULT 0,
+        staked INTEGER DEFAULT 0,
+        profit INTEGER DEFAULT 0,
+        coeff_sum REAL DEFAULT 0,
+        max_coeff REAL DEFAULT 0,
+        peak_balance INTEGER DEFAULT 0,
+        max_drawdown INTEGER DEFAULT 0,
+        win_streak INTEGER DEFAULT 0,
+        loss_streak INTEGER DEFAULT 0,
+        longest_win_streak INTEGER DEFAULT 0,
+        longest_loss_streak INTEGER DEFAULT 0,
+        FOREIGN KEY (bank_id) REFERENCES banks (id)
+    )
+'''
+# Таблица -> (DDL, денежные колонки, которые до версии 1 были REAL в рублях)
+MONEY_TABLES = {
+    'banks': (BANKS_TABLE_SQL, ('balance', 'initial_balance', 'daily_goal', 'current_target', 'current_stake', 'original_goal')),
+    'bets': (BETS_TABLE_SQL, ('stake', 'bank_after')),
+    'bank_stats': (BANK_STATS_TABLE_SQL, ('staked', 'profit', 'peak_balance', 'max_drawdown')),
+}
+
 def init_db():
     try:
         with db_lock:
-            conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+            conn = get_db_connection()
             cursor = conn.cursor()
+            # sqlite3 сам открывает транзакцию только перед INSERT/UPDATE/DELETE,
+            # а CREATE/ALTER без нее фиксируются сразу. Явный BEGIN делает всю
+            # схему, перенос данных и PRAGMA user_version одной транзакцией.
+            if not conn.in_transaction:
+                cursor.execute('BEGIN')
+            cursor.execute('PRAGMA user_version')
+            schema_version = cursor.fetchone()[0]
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'banks'")
+            needs_money_migration = schema_version < 1 and cursor.fetchone() is not None
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
                     chat_id INTEGER PRIMARY KEY,
@@ -148,35 +1354,12 @@ def init_db():
                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS banks (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER,
-                    name TEXT,
-                    balance REAL DEFAULT 0,
-                    day INTEGER DEFAULT 1,
-                    initial_balance REAL DEFAULT 0,
-                    daily_goal REAL DEFAULT 0,
-                    current_target REAL DEFAULT 0,
-                    current_coeff REAL DEFAULT 0,
-                    current_stake REAL DEFAULT 0,
-                    in_azamat_mode INTEGER DEFAULT 0,
-                    loss_record TEXT DEFAULT '[]',
-                    sub_goals TEXT DEFAULT '[]',
-                    original_goal REAL DEFAULT 0,
-                    total_bets INTEGER DEFAULT 0,
-                    total_wins INTEGER DEFAULT 0,
-                    bet_history TEXT DEFAULT '[]',
-                    awaiting_bet_result INTEGER DEFAULT 0,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (chat_id) REFERENCES users (chat_id)
-                )
-            ''')
+            cursor.execute(BANKS_TABLE_SQL.format(table='banks'))
             cursor.execute("PRAGMA table_info(banks)")
             columns = [column[1] for column in cursor.fetchall()]
             new_columns = [
                 ('sub_goals', "ALTER TABLE banks ADD COLUMN sub_goals TEXT DEFAULT '[]'"),
-                ('original_goal', "ALTER TABLE banks ADD COLUMN original_goal REAL DEFAULT 0"),
+                ('original_goal', "ALTER TABLE banks ADD COLUMN original_goal INTEGER DEFAULT 0"),
                 ('total_bets', "ALTER TABLE banks ADD COLUMN total_bets INTEGER DEFAULT 0"),
                 ('total_wins', "ALTER TABLE banks ADD COLUMN total_wins INTEGER DEFAULT 0"),
                 ('bet_history', "ALTER TABLE banks ADD COLUMN bet_history TEXT DEFAULT '[]'"),
@@ -186,131 +1369,659 @@ def init_db():
                 if col_name not in columns:
                     cursor.execute(sql)
                     print(f"✅ Добавлена колонка '{col_name}'")
+            cursor.execute(BETS_TABLE_SQL.format(table='bets'))
+            cursor.execute(BANK_STATS_TABLE_SQL.format(table='bank_stats'))
+            if needs_money_migration:
+                migrate_money_to_kopecks(cursor)
+            cursor.execute(f'PRAGMA user_version = {DB_SCHEMA_VERSION}')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_banks_chat_id ON banks(chat_id)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_chat_id ON users(chat_id)')
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS idx_bets_bank_ts '
+                'ON bets(bank_id, ts DESC, coefficient, stake, result, bank_after)'
+            )
+            migrate_bet_history(cursor)
+            rebuild_missing_bank_stats(cursor)
             conn.commit()
-            conn.close()
         print("✅ База данных инициализирована")
     except Exception as e:
+        rollback_db_connection()
         log_error(f"Ошибка инициализации БД: {e}", exc_info=True)
 
-def get_user_state(chat_id):
-    max_retries = 3
-    for attempt in range(max_retries):
+# REAL-колонку нельзя поменять на INTEGER через ALTER, поэтому таблицы
+# пересобираются: копия с новой схемой, перенос строк с переводом рублей в
+# копейки, замена старой таблицы. Вызывается внутри транзакции init_db.
+def migrate_money_to_kopecks(cursor):
+    cursor.execute("SELECT name, seq FROM sqlite_sequence WHERE name IN ('banks', 'bets')")
+    sequences = cursor.fetchall()
+    for table, (table_sql, money_columns) in MONEY_TABLES.items():
+        cursor.execute(f"PRAGMA table_info({table})")
+        columns = [column[1] for column in cursor.fetchall()]
+        values = [
+            f"CAST(ROUND({column} * 100) AS INTEGER)" if column in money_columns else column
+            for column in columns
+        ]
+        cursor.execute(table_sql.format(table=f'{table}_kopecks'))
+        cursor.execute(
+            f"INSERT INTO {table}_kopecks ({', '.join(columns)}) SELECT {', '.join(values)} FROM {table}"
+        )
+        cursor.execute(f"DROP TABLE {table}")
+        cursor.execute(f"ALTER TABLE {table}_kopecks RENAME TO {table}")
+    cursor.executemany("UPDATE sqlite_sequence SET seq = ? WHERE name = ?", [(seq, name) for name, seq in sequences])
+    cursor.execute("SELECT id, loss_record, sub_goals FROM banks")
+    for bank_id, loss_record, sub_goals in cursor.fetchall():
+        cursor.execute(
+            'UPDATE banks SET loss_record = ?, sub_goals = ? WHERE id = ?',
+            (rubles_json_to_kopecks(loss_record), rubles_json_to_kopecks(sub_goals), bank_id)
+        )
+    print("✅ Денежные суммы переведены в копейки")
+
+def rubles_json_to_kopecks(value):
+    try:
+        return json.dumps([to_kopecks(amount) for amount in json.loads(value or '[]')])
+    except (TypeError, ValueError, OverflowError):
+        return '[]'
+
+def migrate_bet_history(cursor):
+    cursor.execute("SELECT id, bet_history FROM banks WHERE bet_history IS NOT NULL AND bet_history NOT IN ('', '[]')")
+    rows = cursor.fetchall()
+    for bank_id, bet_history in rows:
         try:
-            with db_lock:
-                conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+            history = json.loads(bet_history)
+        except ValueError:
+            history = []
+        # Старая история хранилась от новых к старым и без времени ставки
+        cursor.executemany(
+            'INSERT INTO bets (bank_id, ts, coefficient, result) VALUES (?, ?, ?, ?)',
+            [
+                (bank_id, float(len(history) - i), bet.get('coefficient', 0), bet.get('result', ''))
+                for i, bet in enumerate(history)
+            ]
+        )
+        cursor.execute("UPDATE banks SET bet_history = '[]' WHERE id = ?", (bank_id,))
+    if rows:
+        print(f"✅ История ставок перенесена в таблицу bets: {len(rows)} банк(ов)")
+
+# Агрегаты обновляются в той же транзакции, что и вставка ставки: суммы,
+# максимумы и счетчики серий пересчитываются из старых значений строки.
+BANK_STATS_UPDATE_SQL = '''
+    UPDATE bank_stats SET
+    bets = bets + 1,
+    wins = wins + :is_win,
+    staked = staked + :stake,
+    profit = profit + :profit,
+    coeff_sum = coeff_sum + :coefficient,
+    max_coeff = MAX(max_coeff, :coefficient),
+    peak_balance = MAX(peak_balance, :bank_after),
+    max_drawdown = MAX(max_drawdown, MAX(peak_balance, :bank_after) - :bank_after),
+    win_streak = CASE WHEN :is_win THEN win_streak + 1 ELSE 0 END,
+    loss_streak = CASE WHEN :is_win THEN 0 ELSE loss_streak + 1 END,
+    longest_win_streak = MAX(longest_win_streak, CASE WHEN :is_win THEN win_streak + 1 ELSE 0 END),
+    longest_loss_streak = MAX(longest_loss_streak, CASE WHEN :is_win THEN 0 ELSE loss_streak + 1 END)
+    WHERE bank_id = :bank_id
+'''
+
+def bet_stats_params(bank_id, coefficient, stake, result, bank_after):
+    coefficient = float(coefficient or 0.0)
+    stake = int(stake or 0)
+    is_win = 1 if result == 'win' else 0
+    profit = calculate_profit(stake, coefficient) if is_win else -stake
+    return {
+        'bank_id': bank_id,
+        'is_win': is_win,
+        'stake': stake,
+        'profit': profit,
+        'coefficient': coefficient,
+        'bank_after': int(bank_after) if bank_after is not None else None
+    }
+
+def update_bank_stats(cursor, stats_params):
+    for params in stats_params:
+        bank_after = params['bank_after']
+        if bank_after is None:
+            bank_after = 0
+            params = dict(params, bank_after=0)
+        cursor.execute(
+            'INSERT OR IGNORE INTO bank_stats (bank_id, peak_balance) VALUES (?, ?)',
+            (params['bank_id'], bank_after - params['profit'])
+        )
+        cursor.execute(BANK_STATS_UPDATE_SQL, params)
+
+def insert_bet_rows(cursor, bets):
+    if bets:
+        cursor.executemany(
+            'INSERT INTO bets (bank_id, ts, coefficient, stake, result, bank_after) VALUES (?, ?, ?, ?, ?, ?)',
+            [
+                (bet['bank_id'], bet['ts'], bet['coefficient'], bet['stake'], bet['result'], bet['bank_after'])
+                for bet in bets
+            ]
+        )
+        update_bank_stats(cursor, [
+            bet_stats_params(bet['bank_id'], bet['coefficient'], bet['stake'], bet['result'], bet['bank_after'])
+            for bet in bets
+        ])
+
+def rebuild_missing_bank_stats(cursor):
+    cursor.execute('''
+        SELECT DISTINCT bank_id FROM bets
+        WHERE bank_id NOT IN (SELECT bank_id FROM bank_stats)
+    ''')
+    bank_ids = [row[0] for row in cursor.fetchall()]
+    for bank_id in bank_ids:
+        cursor.execute(
+            'SELECT coefficient, stake, result, bank_after FROM bets WHERE bank_id = ? ORDER BY ts, id',
+            (bank_id,)
+        )
+        update_bank_stats(cursor, [bet_stats_params(bank_id, *row) for row in cursor.fetchall()])
+    if bank_ids:
+        print(f"✅ Агрегаты статистики пересчитаны: {len(bank_ids)} банк(ов)")
+
+@traced_call
+def get_bank_stats(chat_id, bank_id):
+    try:
+        if STATE_CACHE_ENABLED:
+            flush_state_cache({chat_id})
+        with read_lock():
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT bets, wins, staked, profit, coeff_sum, max_coeff,
+                max_drawdown, longest_win_streak, longest_loss_streak
+                FROM bank_stats WHERE bank_id = ?
+            ''', (bank_id,))
+            row = cursor.fetchone()
+        if not row:
+            return None
+        bets, wins, staked, profit, coeff_sum, max_coeff, max_drawdown, longest_win_streak, longest_loss_streak = row
+        return {
+            'bets': bets,
+            'wins': wins,
+            'staked': staked,
+            'profit': profit,
+            'roi': (profit / staked * 100) if staked > 0 else 0.0,
+            'avg_coeff': (coeff_sum / bets) if bets > 0 else 0.0,
+            'max_coeff': max_coeff,
+            'max_drawdown': max_drawdown,
+            'longest_win_streak': longest_win_streak,
+            'longest_loss_streak': longest_loss_streak
+        }
+    except Exception as e:
+        log_error(f"Ошибка загрузки агрегатов банка {bank_id}: {e}", exc_info=True)
+        return None
+
+@traced_call
+def get_bet_history(chat_id, bank_id, limit=MAX_BET_HISTORY):
+    try:
+        history = []
+        if STATE_CACHE_ENABLED:
+            with _state_cache_lock:
+                entry = _state_cache.get(chat_id)
+                if entry is not None:
+                    history = [bet for bet in reversed(entry['bets']) if bet['bank_id'] == bank_id][:limit]
+        if len(history) < limit:
+            with read_lock():
+                conn = get_db_connection()
                 cursor = conn.cursor()
-                cursor.execute('SELECT * FROM users WHERE chat_id = ?', (chat_id,))
-                user_data = cursor.fetchone()
-                if not user_data:
-                    cursor.execute(
-                        'INSERT INTO users (chat_id, current_bank_id, awaiting_input) VALUES (?, NULL, "")',
-                        (chat_id,)
-                    )
-                    conn.commit()
-                    user_data = (chat_id, None, '', None)
-                state = {
-                    'chat_id': user_data[0],
-                    'current_bank_id': user_data[1],
-                    'awaiting_input': user_data[2] or ''
-                }
-                if state['current_bank_id']:
-                    cursor.execute('SELECT * FROM banks WHERE id = ?', (state['current_bank_id'],))
-                    bank_data = cursor.fetchone()
-                    if bank_data:
-                        columns = [description[0] for description in cursor.description]
-                        bank_dict = dict(zip(columns, bank_data))
-                        state.update({
-                            'bank_id': bank_dict['id'],
-                            'bank_name': bank_dict['name'],
-                            'bank': float(bank_dict['balance'] or 0.0),
-                            'day': int(bank_dict['day'] or 1),
-                            'initial_balance': float(bank_dict['initial_balance'] or 0.0),
-                            'daily_goal': float(bank_dict['daily_goal'] or 0.0),
-                            'current_target': float(bank_dict['current_target'] or 0.0),
-                            'current_coeff': float(bank_dict['current_coeff'] or 0.0),
-                            'current_stake': float(bank_dict['current_stake'] or 0.0),
-                            'in_azamat_mode': bool(bank_dict['in_azamat_mode']),
-                            'loss_record': json.loads(bank_dict['loss_record']) if bank_dict['loss_record'] else [],
-                            'sub_goals': json.loads(bank_dict.get('sub_goals', '[]')) if bank_dict.get('sub_goals') else [],
-                            'original_goal': float(bank_dict.get('original_goal', 0) or 0.0),
-                            'total_bets': int(bank_dict.get('total_bets', 0) or 0),
-                            'total_wins': int(bank_dict.get('total_wins', 0) or 0),
-                            'bet_history': json.loads(bank_dict.get('bet_history', '[]')) if bank_dict.get('bet_history') else [],
-                            'awaiting_bet_result': bool(bank_dict.get('awaiting_bet_result', 0))
-                        })
-                conn.close()
-                return state
+                cursor.execute(
+                    'SELECT coefficient, result FROM bets WHERE bank_id = ? ORDER BY ts DESC LIMIT ?',
+                    (bank_id, limit - len(history))
+                )
+                history.extend({'coefficient': row[0], 'result': row[1]} for row in cursor.fetchall())
+        return history
+    except Exception as e:
+        log_error(f"Ошибка загрузки истории ставок банка {bank_id}: {e}", exc_info=True)
+        return []
+
+# Поля сессии -> колонки banks: (колонка, из БД, в БД). Значения приводятся
+# к типам только здесь, при чтении строки и при записи; дальше код работает
+# с атрибутами UserSession как есть.
+def db_bool(value):
+    return 1 if value else 0
+
+def load_amounts(value):
+    amounts = json.loads(value) if value else []
+    if not isinstance(amounts, list):
+        raise ValueError(f"ожидался список сумм, получено {value!r}")
+    return [int(amount) for amount in amounts]
+
+BANK_STATE_COLUMNS = {
+    'bank': ('balance', lambda value: int(value or 0), int),
+    'day': ('day', lambda value: int(value or 1), int),
+    'initial_balance': ('initial_balance', lambda value: int(value or 0), int),
+    'daily_goal': ('daily_goal', lambda value: int(value or 0), int),
+    'current_target': ('current_target', lambda value: int(value or 0), int),
+    'current_coeff': ('current_coeff', lambda value: float(value or 0.0), float),
+    'current_stake': ('current_stake', lambda value: int(value or 0), int),
+    'in_azamat_mode': ('in_azamat_mode', bool, db_bool),
+    'loss_record': ('loss_record', load_amounts, json.dumps),
+    'sub_goals': ('sub_goals', load_amounts, json.dumps),
+    'original_goal': ('original_goal', lambda value: int(value or 0), int),
+    'total_bets': ('total_bets', lambda value: int(value or 0), int),
+    'total_wins': ('total_wins', lambda value: int(value or 0), int),
+    'awaiting_bet_result': ('awaiting_bet_result', bool, db_bool)
+}
+
+# Сессия пользователя: поля users плюс текущий банк (BankState) и временные
+# значения редактирования ставки. Помнит значения на момент загрузки или
+# сохранения, чтобы писать в базу только изменившиеся поля.
+class UserSession(BankState):
+    __slots__ = ('chat_id', 'current_bank_id', 'awaiting_input',
+                 'edit_original_coeff', 'edit_original_stake', '_snapshot')
+
+    def __init__(self, chat_id):
+        super().__init__()
+        self.chat_id = chat_id
+        self.current_bank_id = None
+        self.awaiting_input = ''
+        self.edit_original_coeff = 0.0
+        self.edit_original_stake = 0
+        self._snapshot = None
+
+    @classmethod
+    def from_row(cls, values):
+        session = cls(values['chat_id'])
+        session.current_bank_id = values['current_bank_id']
+        session.awaiting_input = values['awaiting_input'] or ''
+        if values['id'] is not None:
+            session.bank_id = values['id']
+            session.bank_name = values['name']
+            for key, (column, from_db, _) in BANK_STATE_COLUMNS.items():
+                setattr(session, key, from_db(values[column]))
+        session.mark_clean()
+        return session
+
+    def values(self):
+        return tuple(tuple(value) if isinstance(value, list) else value for value in get_state_fields(self))
+
+    def is_loaded(self):
+        return self._snapshot is not None
+
+    def mark_clean(self):
+        self._snapshot = self.values()
+
+    def changed_fields(self, other=None):
+        # Поля, отличающиеся от снимка (или от другой сессии, если передана).
+        before = self._snapshot if other is None else other.values()
+        if before is None:
+            return set(STATE_FIELDS)
+        return {name for name, old, new in zip(STATE_FIELDS, before, self.values()) if old != new}
+
+    def copy(self):
+        copied = UserSession.__new__(UserSession)
+        for name in SESSION_SLOTS:
+            setattr(copied, name, getattr(self, name))
+        copied.loss_record = list(self.loss_record)
+        copied.sub_goals = list(self.sub_goals)
+        if self.pending_bets is not None:
+            copied.pending_bets = list(self.pending_bets)
+        return copied
+
+SESSION_SLOTS = BankState.__slots__ + UserSession.__slots__
+STATE_FIELDS = tuple(name for name in SESSION_SLOTS if name not in ('pending_bets', '_snapshot'))
+get_state_fields = operator.attrgetter(*STATE_FIELDS)
+
+def user_session_factory(cursor, row):
+    return UserSession.from_row({description[0]: value for description, value in zip(cursor.description, row)})
+
+# Колонки users идут после banks.*, чтобы chat_id не перекрывался NULL из
+# LEFT JOIN, когда банка нет.
+USER_SESSION_SQL = '''
+    SELECT banks.*, users.chat_id, users.current_bank_id, users.awaiting_input
+    FROM users LEFT JOIN banks ON banks.id = users.current_bank_id
+    WHERE users.chat_id = ?
+'''
+
+# Без WAL база на время чужой записи заблокирована целиком, поэтому запрос
+# повторяется до DB_LOCKED_RETRIES раз. В WAL занятую базу дожидается
+# busy_timeout, и load_user_state/write_user_state выполняются один раз.
+DB_LOCKED_RETRIES = 3
+
+def retry_on_locked(func, *args):
+    for attempt in range(DB_LOCKED_RETRIES):
+        try:
+            return func(*args)
         except sqlite3.OperationalError as e:
-            if "locked" in str(e) and attempt < max_retries - 1:
-                time.sleep(0.1)
-                continue
-            else:
-                log_error(f"Ошибка БД после {attempt + 1} попыток: {e}", exc_info=True)
-                return {'chat_id': chat_id, 'awaiting_input': ''}
-        except Exception as e:
-            log_error(f"Неожиданная ошибка в get_user_state для {chat_id}: {e}", exc_info=True)
-            return {'chat_id': chat_id, 'awaiting_input': ''}
+            rollback_db_connection()
+            if "locked" not in str(e) or attempt == DB_LOCKED_RETRIES - 1:
+                raise
+            time.sleep(0.1)
+
+def query_user_state(chat_id):
+    with chat_lock(chat_id):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.row_factory = user_session_factory
+        cursor.execute(USER_SESSION_SQL, (chat_id,))
+        state = cursor.fetchone()
+        if state is None:
+            cursor.execute(
+                'INSERT INTO users (chat_id, current_bank_id, awaiting_input) VALUES (?, NULL, "")',
+                (chat_id,)
+            )
+            conn.commit()
+            state = UserSession(chat_id)
+            state.mark_clean()
+        return state
+
+def load_user_state(chat_id):
+    try:
+        if DB_WAL_MODE:
+            return query_user_state(chat_id)
+        return retry_on_locked(query_user_state, chat_id)
+    except sqlite3.OperationalError as e:
+        rollback_db_connection()
+        log_error(f"Ошибка БД при загрузке состояния {chat_id}: {e}", exc_info=True)
+        return None
+    except Exception as e:
+        rollback_db_connection()
+        log_error(f"Неожиданная ошибка в load_user_state для {chat_id}: {e}", exc_info=True)
+        return None
+
+def write_state_rows(cursor, state, fields=None):
+    if fields is None or fields & {'bank_id', 'current_bank_id', 'awaiting_input'}:
+        assignments = []
+        params = []
+        if fields is None or fields & {'bank_id', 'current_bank_id'}:
+            current_bank_id = state.bank_id
+            if current_bank_id is None:
+                current_bank_id = state.current_bank_id
+            assignments.append('current_bank_id = ?')
+            params.append(current_bank_id)
+        if fields is None or 'awaiting_input' in fields:
+            assignments.append('awaiting_input = ?')
+            params.append(state.awaiting_input)
+        params.append(state.chat_id)
+        cursor.execute(f"UPDATE users SET {', '.join(assignments)} WHERE chat_id = ?", params)
+    if state.bank_id is not None:
+        assignments = []
+        params = []
+        for key, (column, _, to_db) in BANK_STATE_COLUMNS.items():
+            if fields is None or key in fields:
+                assignments.append(f'{column} = ?')
+                params.append(to_db(getattr(state, key)))
+        if assignments:
+            params.append(state.bank_id)
+            cursor.execute(f"UPDATE banks SET {', '.join(assignments)} WHERE id = ?", params)
+
+def store_user_state(state):
+    with chat_lock(state.chat_id):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        fields = state.changed_fields() if state.is_loaded() else None
+        bets = state.pending_bets
+        if fields is not None and not fields and not bets:
+            return True
+        write_state_rows(cursor, state, fields)
+        insert_bet_rows(cursor, bets)
+        conn.commit()
+        state.pending_bets = None
+        state.mark_clean()
+        return True
+
+def write_user_state(state):
+    try:
+        if DB_WAL_MODE:
+            return store_user_state(state)
+        return retry_on_locked(store_user_state, state)
+    except sqlite3.OperationalError as e:
+        rollback_db_connection()
+        log_error(f"Ошибка БД при сохранении состояния {state.chat_id}: {e}", exc_info=True)
+        return False
+    except Exception as e:
+        rollback_db_connection()
+        log_error(f"Ошибка сохранения состояния пользователя {state.chat_id}: {e}", exc_info=True)
+        return False
+
+# --- КЭШ СОСТОЯНИЙ (WRITE-BEHIND) ---
+# Состояние читается из памяти, изменения копятся и сбрасываются в БД пачкой
+# по таймеру, при вытеснении и при остановке процесса.
+_state_cache = collections.OrderedDict()
+_state_cache_lock = threading.RLock()
+_state_flush_lock = threading.Lock()
+_state_flusher_stop = threading.Event()
+STATE_CACHE_STATS = {'hits': 0, 'misses': 0, 'flushes': 0, 'flushed_states': 0, 'evictions': 0}
+
+def copy_state(state):
+    return state.copy()
+
+@traced_call
+def get_user_state(chat_id):
+    if STATE_CACHE_ENABLED:
+        with _state_cache_lock:
+            entry = _state_cache.get(chat_id)
+            if entry is not None:
+                _state_cache.move_to_end(chat_id)
+                entry['touched'] = time.monotonic()
+                STATE_CACHE_STATS['hits'] += 1
+                return copy_state(entry['state'])
+            STATE_CACHE_STATS['misses'] += 1
+    state = load_user_state(chat_id)
+    if state is None:
+        return UserSession(chat_id)
+    if STATE_CACHE_ENABLED:
+        with _state_cache_lock:
+            if chat_id not in _state_cache:
+                _state_cache[chat_id] = {
+                    'state': copy_state(state),
+                    'dirty': set(),
+                    'bets': [],
+                    'touched': time.monotonic()
+                }
+        evict_cached_states()
+    return state
 
+@traced_call
 def save_user_state(state):
-    max_retries = 3
-    for attempt in range(max_retries):
+    if not STATE_CACHE_ENABLED:
+        return write_user_state(state)
+    try:
+        chat_id = state.chat_id
+        with _state_cache_lock:
+            entry = _state_cache.get(chat_id)
+            if entry is None:
+                if not state.is_loaded():
+                    return write_user_state(state)
+                entry = {'state': None, 'dirty': set(), 'bets': [], 'touched': 0}
+                _state_cache[chat_id] = entry
+            entry['bets'].extend(state.pending_bets or [])
+            state.pending_bets = None
+            cached = entry['state']
+            entry['dirty'].update(state.changed_fields(cached) if cached is not None else STATE_FIELDS)
+            entry['state'] = copy_state(state)
+            entry['touched'] = time.monotonic()
+            _state_cache.move_to_end(chat_id)
+        evict_cached_states()
+        return True
+    except Exception as e:
+        log_error(f"Ошибка кэширования состояния пользователя {state.chat_id}: {e}", exc_info=True)
+        return write_user_state(state)
+
+def is_entry_dirty(entry):
+    return bool(entry['dirty'] or entry['bets'])
+
+@traced_call
+def flush_state_cache(chat_ids=None):
+    with _state_flush_lock:
+        with _state_cache_lock:
+            pending = []
+            for chat_id, entry in _state_cache.items():
+                if is_entry_dirty(entry) and (chat_ids is None or chat_id in chat_ids):
+                    pending.append((copy_state(entry['state']), entry['dirty'], entry['bets']))
+                    entry['dirty'] = set()
+                    entry['bets'] = []
+        if not pending:
+            return 0
         try:
-            with db_lock:
-                conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+            with (contextlib.nullcontext() if DB_WAL_MODE else db_lock):
+                conn = get_db_connection()
                 cursor = conn.cursor()
-                current_bank_id = state.get('bank_id')
-                if current_bank_id is None:
-                    current_bank_id = state.get('current_bank_id')
-                cursor.execute('''
-                    UPDATE users SET 
-                    current_bank_id = ?, awaiting_input = ?
-                    WHERE chat_id = ?
-                ''', (
-                    current_bank_id,
-                    state.get('awaiting_input', ''),
-                    state['chat_id']
-                ))
-                if 'bank_id' in state:
-                    cursor.execute('''
-                        UPDATE banks SET
-                        balance = ?, day = ?, initial_balance = ?, daily_goal = ?, 
-                        current_target = ?, current_coeff = ?, current_stake = ?, 
-                        in_azamat_mode = ?, loss_record = ?, sub_goals = ?, original_goal = ?,
-                        total_bets = ?, total_wins = ?, bet_history = ?, awaiting_bet_result = ?
-                        WHERE id = ?
-                    ''', (
-                        float(state.get('bank', 0.0)),
-                        int(state.get('day', 1)),
-                        float(state.get('initial_balance', 0.0)),
-                        float(state.get('daily_goal', 0.0)),
-                        float(state.get('current_target', 0.0)),
-                        float(state.get('current_coeff', 0.0)),
-                        float(state.get('current_stake', 0.0)),
-                        1 if state.get('in_azamat_mode', False) else 0,
-                        json.dumps(state.get('loss_record', [])),
-                        json.dumps(state.get('sub_goals', [])),
-                        float(state.get('original_goal', 0.0)),
-                        int(state.get('total_bets', 0)),
-                        int(state.get('total_wins', 0)),
-                        json.dumps(state.get('bet_history', [])),
-                        1 if state.get('awaiting_bet_result', False) else 0,
-                        int(state['bank_id'])
-                    ))
+                for state, fields, bets in pending:
+                    write_state_rows(cursor, state, fields)
+                    insert_bet_rows(cursor, bets)
                 conn.commit()
-                conn.close()
-                return True
-        except sqlite3.OperationalError as e:
-            if "locked" in str(e) and attempt < max_retries - 1:
-                time.sleep(0.1)
-                continue
-            else:
-                log_error(f"Ошибка БД при сохранении после {attempt + 1} попыток: {e}", exc_info=True)
-                return False
+            with _state_cache_lock:
+                STATE_CACHE_STATS['flushes'] += 1
+                STATE_CACHE_STATS['flushed_states'] += len(pending)
+            return len(pending)
         except Exception as e:
-            log_error(f"Ошибка сохранения состояния пользователя {state.get('chat_id')}: {e}", exc_info=True)
-            return False
+            rollback_db_connection()
+            log_error(f"Ошибка сброса кэша состояний ({len(pending)} записей): {e}", exc_info=True)
+            with _state_cache_lock:
+                for state, fields, bets in pending:
+                    entry = _state_cache.get(state.chat_id)
+                    if entry is None:
+                        _state_cache[state.chat_id] = {'state': state, 'dirty': fields, 'bets': bets, 'touched': time.monotonic()}
+                    else:
+                        entry['dirty'].update(fields)
+                        entry['bets'][:0] = bets
+            return 0
+
+def evict_cached_states(now=None):
+    now = time.monotonic() if now is None else now
+    with _state_cache_lock:
+        overflow = len(_state_cache) - STATE_CACHE_MAX_SIZE
+        expired = [
+            chat_id for chat_id, entry in _state_cache.items()
+            if now - entry['touched'] > STATE_CACHE_TTL
+        ]
+        victims = set(list(_state_cache)[:max(overflow, 0)])
+        victims.update(expired)
+        if not victims:
+            return 0
+        dirty_victims = {chat_id for chat_id in victims if is_entry_dirty(_state_cache[chat_id])}
+    if dirty_victims:
+        flush_state_cache(dirty_victims)
+    evicted = 0
+    with _state_cache_lock:
+        for chat_id in victims:
+            entry = _state_cache.get(chat_id)
+            if entry is not None and not is_entry_dirty(entry):
+                del _state_cache[chat_id]
+                evicted += 1
+        STATE_CACHE_STATS['evictions'] += evicted
+    return evicted
+
+def invalidate_cached_state(chat_id):
+    if not STATE_CACHE_ENABLED:
+        return
+    flush_state_cache({chat_id})
+    with _state_cache_lock:
+        _state_cache.pop(chat_id, None)
+
+def get_cached_bank_state(chat_id):
+    with _state_cache_lock:
+        entry = _state_cache.get(chat_id)
+        if entry is None or entry['state'].bank_id is None:
+            return None
+        return entry['state'].bank_id, entry['state'].bank, entry['state'].day
+
+def get_state_cache_stats():
+    with _state_cache_lock:
+        stats = dict(STATE_CACHE_STATS)
+        stats['size'] = len(_state_cache)
+        stats['dirty'] = sum(1 for entry in _state_cache.values() if is_entry_dirty(entry))
+    total = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = (stats['hits'] / total) if total else 0.0
+    return stats
+
+def state_flusher_loop():
+    while not _state_flusher_stop.wait(STATE_FLUSH_INTERVAL):
+        try:
+            flush_state_cache()
+            evict_cached_states()
+        except Exception as e:
+            log_error(f"Ошибка в фоновом сбросе состояний: {e}", exc_info=True)
+
+def start_state_flusher():
+    if not STATE_CACHE_ENABLED:
+        return None
+    flusher = threading.Thread(target=state_flusher_loop, name='state-flusher', daemon=True)
+    flusher.start()
+    return flusher
+
+def shutdown_state_cache():
+    _state_flusher_stop.set()
+    try:
+        flushed = flush_state_cache()
+        if flushed:
+            print(f"💾 Сохранено состояний при остановке: {flushed}")
+    except Exception as e:
+        log_error(f"Ошибка сохранения состояний при остановке: {e}", exc_info=True)
+
+atexit.register(shutdown_state_cache)
+
+def handle_sigterm(signum, frame):
+    print("🛑 Получен SIGTERM, сохраняем состояния...")
+    shutdown_state_cache()
+    sys.exit(0)
+
+# --- ПРОВЕРКА ЗДОРОВЬЯ ---
+# Telegram API, база и размеры файлов проверяются в фоновом потоке; экраны
+# статуса и /health показывают последний готовый снимок без сетевых вызовов.
+HealthSnapshot = collections.namedtuple('HealthSnapshot', (
+    'checked_at', 'api_ok', 'api_error', 'api_latency', 'db_ok', 'db_error',
+    'db_latency', 'users_count', 'db_size', 'log_size',
+))
+
+_health_snapshot = None
+_health_prober_stop = threading.Event()
+
+def get_file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def probe_health():
+    started = time.perf_counter()
+    try:
+        with observe_telegram_call('get_me'):
+            bot.get_me()
+        api_ok, api_error = True, None
+    except Exception as e:
+        api_ok, api_error = False, str(e)
+    api_latency = time.perf_counter() - started
+    started = time.perf_counter()
+    users_count = None
+    try:
+        with read_lock():
+            users_count = get_db_connection().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        db_ok, db_error = True, None
+    except Exception as e:
+        db_ok, db_error = False, str(e)
+    db_latency = time.perf_counter() - started
+    return HealthSnapshot(
+        checked_at=datetime.now(),
+        api_ok=api_ok, api_error=api_error, api_latency=api_latency,
+        db_ok=db_ok, db_error=db_error, db_latency=db_latency,
+        users_count=users_count,
+        db_size=get_file_size(DB_NAME), log_size=get_file_size(LOG_FILE),
+    )
+
+def refresh_health_snapshot():
+    global _health_snapshot
+    _health_snapshot = probe_health()
+    return _health_snapshot
+
+def get_health_snapshot():
+    snapshot = _health_snapshot
+    if snapshot is None:
+        snapshot = refresh_health_snapshot()
+    return snapshot
+
+def health_prober_loop():
+    while True:
+        try:
+            refresh_health_snapshot()
+        except Exception as e:
+            log_error(f"Ошибка в фоновой проверке здоровья: {e}", exc_info=True)
+        if _health_prober_stop.wait(HEALTH_PROBE_INTERVAL):
+            break
+
+def start_health_prober():
+    prober = threading.Thread(target=health_prober_loop, name='health-prober', daemon=True)
+    prober.start()
+    return prober
 
 def create_bank(chat_id, bank_name):
     try:
@@ -319,13 +2030,13 @@ def create_bank(chat_id, bank_name):
             return None, "❌ Название банка не может быть пустым!"
         if len(bank_name) > 30:
             return None, "❌ Название банка слишком длинное (макс. 30 символов)"
-        with db_lock:
-            conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+        invalidate_cached_state(chat_id)
+        with chat_lock(chat_id):
+            conn = get_db_connection()
             cursor = conn.cursor()
             cursor.execute('SELECT COUNT(*) FROM banks WHERE chat_id = ?', (chat_id,))
             bank_count = cursor.fetchone()[0]
             if bank_count >= MAX_BANKS:
-                conn.close()
                 return None, f"❌ Максимум {MAX_BANKS} банка!"
             cursor.execute('''
                 INSERT INTO banks (chat_id, name, balance, day, initial_balance, daily_goal, sub_goals, original_goal, total_bets, total_wins, bet_history, awaiting_bet_result)
@@ -337,284 +2048,132 @@ def create_bank(chat_id, bank_name):
                 (bank_id, chat_id)
             )
             conn.commit()
-            conn.close()
-            return bank_id, f"✅ Банк '{bank_name}' создан!"
+        invalidate_cached_state(chat_id)
+        return bank_id, f"✅ Банк '{bank_name}' создан!"
     except Exception as e:
+        rollback_db_connection()
         log_error(f"Ошибка создания банка для пользователя {chat_id}: {e}", exc_info=True)
         return None, "❌ Ошибка при создании банка"
 
+@traced_call
 def get_user_banks(chat_id):
     try:
-        with db_lock:
-            conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+        with read_lock():
+            conn = get_db_connection()
             cursor = conn.cursor()
             cursor.execute('SELECT id, name, balance, day FROM banks WHERE chat_id = ? ORDER BY created_at DESC', (chat_id,))
             banks = cursor.fetchall()
-            bank_list = []
-            for row in banks:
-                bank_list.append({
-                    'id': row[0], 
-                    'name': row[1], 
-                    'balance': float(row[2] or 0.0), 
-                    'day': int(row[3] or 1)
-                })
-            conn.close()
-            return bank_list
+        cached_bank = get_cached_bank_state(chat_id) if STATE_CACHE_ENABLED else None
+        bank_list = []
+        for row in banks:
+            bank = {
+                'id': row[0], 
+                'name': row[1], 
+                'balance': int(row[2] or 0), 
+                'day': int(row[3] or 1)
+            }
+            if cached_bank and cached_bank[0] == bank['id']:
+                bank['balance'] = cached_bank[1]
+                bank['day'] = int(cached_bank[2] or 1)
+            bank_list.append(bank)
+        return bank_list
     except Exception as e:
         log_error(f"Ошибка получения банков пользователя {chat_id}: {e}", exc_info=True)
         return []
 
 def switch_bank(chat_id, bank_id):
     try:
-        with db_lock:
-            conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+        invalidate_cached_state(chat_id)
+        with chat_lock(chat_id):
+            conn = get_db_connection()
             cursor = conn.cursor()
             cursor.execute(
                 'UPDATE users SET current_bank_id = ? WHERE chat_id = ?',
                 (bank_id, chat_id)
             )
             conn.commit()
-            conn.close()
-            return True
+        invalidate_cached_state(chat_id)
+        return True
     except Exception as e:
+        rollback_db_connection()
         log_error(f"Ошибка переключения банка {bank_id} для пользователя {chat_id}: {e}", exc_info=True)
         return False
 
-def reset_bank_stats(bank_id):
+def reset_bank_stats(chat_id, bank_id):
     try:
-        with db_lock:
-            conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+        flush_state_cache({chat_id})
+        with chat_lock(chat_id):
+            conn = get_db_connection()
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE banks SET 
                 total_bets = 0, total_wins = 0, bet_history = '[]'
-                WHERE id = ?
-            ''', (bank_id,))
+                WHERE id = ? AND chat_id = ?
+            ''', (bank_id, chat_id))
+            if not cursor.rowcount:
+                conn.rollback()
+                return False
+            cursor.execute('DELETE FROM bets WHERE bank_id = ?', (bank_id,))
+            cursor.execute('DELETE FROM bank_stats WHERE bank_id = ?', (bank_id,))
             conn.commit()
-            conn.close()
             return True
     except Exception as e:
+        rollback_db_connection()
         log_error(f"Ошибка очистки статистики банка {bank_id}: {e}", exc_info=True)
         return False
 
 def delete_bank(chat_id, bank_id):
     try:
-        with db_lock:
-            conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+        invalidate_cached_state(chat_id)
+        with chat_lock(chat_id):
+            conn = get_db_connection()
             cursor = conn.cursor()
             cursor.execute('SELECT name FROM banks WHERE id = ? AND chat_id = ?', (bank_id, chat_id))
             bank_info = cursor.fetchone()
             if not bank_info:
-                conn.close()
                 return False, "❌ Банк не найден"
             bank_name = bank_info[0]
             cursor.execute('DELETE FROM banks WHERE id = ? AND chat_id = ?', (bank_id, chat_id))
+            cursor.execute('DELETE FROM bets WHERE bank_id = ?', (bank_id,))
+            cursor.execute('DELETE FROM bank_stats WHERE bank_id = ?', (bank_id,))
             cursor.execute('SELECT current_bank_id FROM users WHERE chat_id = ?', (chat_id,))
             user_data = cursor.fetchone()
             if user_data and user_data[0] == bank_id:
                 cursor.execute('UPDATE users SET current_bank_id = NULL WHERE chat_id = ?', (chat_id,))
             conn.commit()
-            conn.close()
-            return True, f"✅ Банк '{bank_name}' удален"
+        invalidate_cached_state(chat_id)
+        return True, f"✅ Банк '{bank_name}' удален"
     except Exception as e:
+        rollback_db_connection()
         log_error(f"Ошибка удаления банка {bank_id} для пользователя {chat_id}: {e}", exc_info=True)
         return False, "❌ Ошибка при удалении банка"
 
-# --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
-def calculate_stake(target, coefficient):
-    try:
-        if coefficient <= 1.0 or target <= 0:
-            return 0.0
-        stake = target / (coefficient - 1)
-        return round(stake, 2)
-    except Exception as e:
-        log_error(f"Ошибка в calculate_stake: {e}", exc_info=True)
-        return 0.0
-
-def calculate_target_bank(initial_balance, day):
-    try:
-        return round(float(initial_balance) * (1.015 ** day), 2)
-    except Exception as e:
-        log_error(f"Ошибка в calculate_target_bank: {e}", exc_info=True)
-        return 0.0
-
-def calculate_daily_goal(current_bank, target_bank):
-    try:
-        return round(float(target_bank) - float(current_bank), 2)
-    except Exception as e:
-        log_error(f"Ошибка в calculate_daily_goal: {e}", exc_info=True)
-        return 0.0
-
-def get_target_day(current_bank, initial_balance):
-    try:
-        current_bank = float(current_bank or 0.0)
-        initial_balance = float(initial_balance or 0.0)
-        if initial_balance <= 0:
-            return 1
-        if current_bank < initial_balance:
-            return 1
-        target_day = 1
-        for day in range(1, 301):
-            target_bank = calculate_target_bank(initial_balance, day)
-            if current_bank >= target_bank:
-                target_day = day
-            else:
-                break
-        return target_day
-    except Exception as e:
-        log_error(f"Ошибка в get_target_day: {e}", exc_info=True)
-        return 1
-
-def check_and_advance_day(state):
-    try:
-        initial = state.get('initial_balance', 0)
-        current_bank = state.get('bank', 0)
-        current_day = state.get('day', 1)
-        target_day = get_target_day(current_bank, initial)
-        new_day = target_day + 1
-        if new_day > current_day:
-            state['day'] = new_day
-            state['in_azamat_mode'] = False
-            state['loss_record'] = []
-            state['sub_goals'] = []
-            state['original_goal'] = 0
-            target_bank_new = calculate_target_bank(initial, new_day)
-            state['current_target'] = calculate_daily_goal(current_bank, target_bank_new)
-            state['daily_goal'] = state['current_target']
-            save_user_state(state)
-            return True
-        return False
-    except Exception as e:
-        log_error(f"Ошибка в check_and_advance_day: {e}", exc_info=True)
-        return False
-
-def calculate_azamat_target(state):
-    try:
-        loss_record = state.get('loss_record', [])
-        if not loss_record:
-            initial = state.get('initial_balance', 0)
-            current_day = state.get('day', 1)
-            target_bank = calculate_target_bank(initial, current_day)
-            current_bank = state.get('bank', 0)
-            return calculate_daily_goal(current_bank, target_bank)
-        if len(loss_record) >= 2:
-            return sum(loss_record[:2])
-        else:
-            initial = state.get('initial_balance', 0)
-            current_day = state.get('day', 1)
-            target_bank = calculate_target_bank(initial, current_day)
-            current_bank = state.get('bank', 0)
-            return calculate_daily_goal(current_bank, target_bank)
-    except Exception as e:
-        log_error(f"Ошибка в calculate_azamat_target: {e}", exc_info=True)
-        initial = state.get('initial_balance', 0)
-        current_day = state.get('day', 1)
-        target_bank = calculate_target_bank(initial, current_day)
-        current_bank = state.get('bank', 0)
-        return calculate_daily_goal(current_bank, target_bank)
-
-def add_bet_to_history(state, coefficient, result):
-    try:
-        bet_history = state.get('bet_history', [])
-        bet_record = {
-            'coefficient': coefficient,
-            'result': result
-        }
-        bet_history.insert(0, bet_record)
-        if len(bet_history) > MAX_BET_HISTORY:
-            bet_history = bet_history[:MAX_BET_HISTORY]
-        state['bet_history'] = bet_history
-        return state
-    except Exception as e:
-        log_error(f"Ошибка добавления ставки в историю: {e}", exc_info=True)
-        return state
-
-def process_win(state):
-    try:
-        stake = float(state.get('current_stake', 0) or 0.0)
-        coeff = float(state.get('current_coeff', 0) or 0.0)
-        profit = stake * (coeff - 1)
-        state['bank'] = round(float(state.get('bank', 0) or 0.0) + profit, 2)
-        state['total_wins'] = int(state.get('total_wins', 0)) + 1
-        state = add_bet_to_history(state, coeff, 'win')
-        state['awaiting_bet_result'] = False
-        if state.get('in_azamat_mode') and state.get('loss_record'):
-            loss_record = state.get('loss_record', [])
-            remaining_profit = profit
-            new_loss_record = []
-            for goal_amount in loss_record:
-                if remaining_profit >= goal_amount:
-                    remaining_profit -= goal_amount
-                else:
-                    if remaining_profit > 0:
-                        new_goal_amount = goal_amount - remaining_profit
-                        new_loss_record.append(round(new_goal_amount, 2))
-                        remaining_profit = 0
-                    else:
-                        new_loss_record.append(goal_amount)
-            state['loss_record'] = new_loss_record
-            if not new_loss_record:
-                state['in_azamat_mode'] = False
-                initial = state.get('initial_balance', 0)
-                current_day = state.get('day', 1)
-                target_bank = calculate_target_bank(initial, current_day)
-                current_bank = state.get('bank', 0)
-                state['current_target'] = calculate_daily_goal(current_bank, target_bank)
-            else:
-                state['current_target'] = calculate_azamat_target(state)
-                state['in_azamat_mode'] = True
-        else:
-            initial = state.get('initial_balance', 0)
-            current_day = state.get('day', 1)
-            target_bank = calculate_target_bank(initial, current_day)
-            current_bank = state.get('bank', 0)
-            state['current_target'] = calculate_daily_goal(current_bank, target_bank)
-            state['in_azamat_mode'] = False
-        return state
-    except Exception as e:
-        log_error(f"Ошибка в process_win: {e}", exc_info=True)
-        return state
-
-def process_loss(state):
-    try:
-        stake = float(state.get('current_stake', 0) or 0.0)
-        state['bank'] = round(float(state.get('bank', 0) or 0.0) - stake, 2)
-        state = add_bet_to_history(state, state.get('current_coeff', 0), 'loss')
-        state['awaiting_bet_result'] = False
-        if 'loss_record' not in state or state['loss_record'] is None:
-            state['loss_record'] = []
-        state['loss_record'].append(stake)
-        if len(state['loss_record']) >= 2:
-            state['in_azamat_mode'] = True
-        if not state.get('in_azamat_mode'):
-            initial = state.get('initial_balance', 0)
-            current_day = state.get('day', 1)
-            target_bank = calculate_target_bank(initial, current_day)
-            current_bank = state.get('bank', 0)
-            state['current_target'] = calculate_daily_goal(current_bank, target_bank)
-        else:
-            state['current_target'] = calculate_azamat_target(state)
-        return state
-    except Exception as e:
-        log_error(f"Ошибка в process_loss: {e}", exc_info=True)
-        return state
-
 # --- ФОРМАТИРОВАНИЕ ---
+# "на 1 часть", "на 2 части", "на 5 частей"
+def format_parts(count):
+    if count % 10 == 1 and count % 100 != 11:
+        noun = "часть"
+    elif 2 <= count % 10 <= 4 and not 12 <= count % 100 <= 14:
+        noun = "части"
+    else:
+        noun = "частей"
+    return f"{count} {noun}"
+
 def format_loss_record(loss_record):
     if not loss_record:
         return ""
     text = "\n📋 *Проигрыши для отыгрыша:*\n"
     for i, loss in enumerate(loss_record, 1):
-        text += f"• Цель {i}) {loss:.2f} руб.\n"
+        text += f"• Цель {i}) {format_rubles(loss)} руб.\n"
     return text
 
 def format_azamat_mode_info(state):
-    if not state.get('in_azamat_mode') or not state.get('loss_record'):
+    if not state.in_azamat_mode or not state.loss_record:
         return ""
-    loss_record = state.get('loss_record', [])
+    loss_record = state.loss_record
     text = format_loss_record(loss_record)
     total_loss = sum(loss_record)
-    text += f"💰 *Общая сумма отыгрыша:* {total_loss:.2f} руб.\n"
+    text += f"💰 *Общая сумма отыгрыша:* {format_rubles(total_loss)} руб.\n"
     return text
 
 def get_bot_status_header():
@@ -634,7 +2193,7 @@ def format_bet_history(bet_history):
     if not bet_history:
         return "📊 *История ставок:*\nНет данных"
     history_text = "📊 *Последние ставки:*\n"
-    for i, bet in enumerate(bet_history[:10], 1):
+    for i, bet in enumerate(bet_history[:MAX_BET_HISTORY], 1):
         coeff = bet.get('coefficient', 0)
         result = bet.get('result', '')
         if result == 'win':
@@ -643,44 +2202,136 @@ def format_bet_history(bet_history):
             history_text += f"{i}) Кф {coeff} - 🔴 проигрыш\n"
     return history_text
 
-def simple_input_keyboard():
-    markup = types.InlineKeyboardMarkup()
-    markup.row(types.InlineKeyboardButton("🔄 Главное меню", callback_data='main_menu'))
-    return markup
+def format_bank_stats(bank_stats):
+    if not bank_stats or not bank_stats['bets']:
+        return ""
+    profit_sign = "+" if bank_stats['profit'] >= 0 else ""
+    return (
+        "📐 *Доходность:*\n"
+        f"• Оборот ставок: **{format_rubles(bank_stats['staked'])} руб.**\n"
+        f"• Чистая прибыль: **{profit_sign}{format_rubles(bank_stats['profit'])} руб.**\n"
+        f"• ROI: **{bank_stats['roi']:.1f}%**\n"
+        f"• Средний коэффициент: **{bank_stats['avg_coeff']:.2f}** (макс. {bank_stats['max_coeff']:.2f})\n"
+        f"• Макс. просадка: **{format_rubles(bank_stats['max_drawdown'])} руб.**\n"
+        f"• Серии: выигрышей до **{bank_stats['longest_win_streak']}**, проигрышей до **{bank_stats['longest_loss_streak']}**\n\n"
+    )
+
+def format_simulation_report(state, coefficients, win_probability, summary):
+    if win_probability is None:
+        probability_text = "честная (1 / коэффициент)"
+    else:
+        probability_text = f"{win_probability:.0%}"
+    days = summary['days']
+    final_bank = summary['final_bank']
+    stake_ratio = summary['max_stake_ratio']
+    if summary['unfinished_probability'] > 0:
+        unfinished_text = f"⏳ *Не дошли до конца за {summary['max_bets']} ставок:* {summary['unfinished_probability']:.1%}\n"
+    else:
+        unfinished_text = ""
+    return (
+        f"🎲 *СИМУЛЯЦИЯ БАНКА*\n"
+        f"_{summary['paths']} путей до дня {MAX_PLAN_DAYS}, в среднем {summary['bets_mean']:.0f} ставок на путь_\n\n"
+        f"💵 *Текущий банк:* **{format_rubles(state.bank)} руб.**, день #{state.day}\n"
+        f"⚙️ *Коэффициенты:* {', '.join(f'{coeff:.2f}' for coeff in coefficients)}\n"
+        f"🎯 *Вероятность выигрыша:* {probability_text}\n\n"
+        f"💀 *Разорение:* **{summary['ruin_probability']:.1%}**\n"
+        f"🏁 *План пройден:* **{summary['completion_probability']:.1%}**\n"
+        f"{unfinished_text}"
+        f"📅 *День в конце:* медиана **{days[50]:.0f}**, 5%: {days[5]:.0f}, 95%: {days[95]:.0f}\n"
+        f"💰 *Банк в конце:* медиана **{format_rubles(round(final_bank[50]))} руб.**, "
+        f"5%: {format_rubles(round(final_bank[5]))}, 95%: {format_rubles(round(final_bank[95]))}\n"
+        f"📏 *Макс. рекомендованная ставка:* медиана **{stake_ratio[50]:.1f}×** лимита "
+        f"({MAX_STAKE_PERCENTAGE:.0%} банка), выше лимита в {summary['stake_cap_probability']:.0%} путей\n\n"
+        f"_Расчет: {summary['elapsed']:.2f} с_"
+    )
+
+# Таблица плана по дням для пары (начальный банк, множитель): индекс = день
+@functools.lru_cache(maxsize=256)
+def get_growth_projection(initial_balance, rate=GROWTH_RATE):
+    if rate == GROWTH_RATE:
+        factors = GROWTH_FACTORS
+    else:
+        factors = [rate ** day for day in range(MAX_PLAN_DAYS + 2)]
+    return array.array('q', [round(initial_balance * factor) for factor in factors])
+
+# Готовый текст страницы зависит только от начального банка, дня и номера
+# страницы, поэтому кэш сам устаревает при смене initial_balance или day.
+@functools.lru_cache(maxsize=1024)
+def render_bank_movement_page(initial, current_day, page):
+    projection = get_growth_projection(initial)
+    start_day = (page - 1) * BANK_MOVEMENT_DAYS_PER_PAGE + 1
+    end_day = min(page * BANK_MOVEMENT_DAYS_PER_PAGE, MAX_PLAN_DAYS)
+    lines = [
+        f"📈 *Движение Банка - Страница {page}/{BANK_MOVEMENT_PAGES}*\n\n",
+        f"🏁 *Начальный банк:* {format_rubles(initial)} руб.\n",
+        f"📅 *Текущий день:* #{current_day}\n\n",
+        "*План по дням:*\n"
+    ]
+    for day in range(start_day, end_day + 1):
+        target_bank = projection[day]
+        if day == current_day:
+            lines.append(f"🔴 *День {day}: {format_rubles(target_bank)} руб.*\n")
+        else:
+            lines.append(f"• День {day}: {format_rubles(target_bank)} руб.\n")
+    if current_day <= MAX_PLAN_DAYS:
+        current_target = projection[current_day]
+        final_target = projection[MAX_PLAN_DAYS]
+        progress_percent = (current_target / final_target * 100) if final_target > 0 else 0
+        lines.append(f"\n📊 *Прогресс:* {progress_percent:.1f}%\n")
+        lines.append(f"🎯 *Цель 300 дней:* {format_rubles(final_target)} руб.")
+    return ''.join(lines)
 
 def format_bank_movement(state, page=1):
     try:
-        initial = state.get('initial_balance', 0)
-        current_day = state.get('day', 1)
+        initial = state.initial_balance
+        current_day = state.day
         if initial <= 0:
             return "❌ *Начальный банк не установлен!*"
-        days_per_page = 15
-        start_day = (page - 1) * days_per_page + 1
-        end_day = min(page * days_per_page, 300)
-        text = f"📈 *Движение Банка - Страница {page}/20*\n\n"
-        text += f"🏁 *Начальный банк:* {initial:.2f} руб.\n"
-        text += f"📅 *Текущий день:* #{current_day}\n\n"
-        text += "*План по дням:*\n"
-        for day in range(start_day, end_day + 1):
-            target_bank = calculate_target_bank(initial, day)
-            if day == current_day:
-                text += f"🔴 *День {day}: {target_bank:.2f} руб.*\n"
-            else:
-                text += f"• День {day}: {target_bank:.2f} руб.\n"
-        if current_day <= 300:
-            current_target = calculate_target_bank(initial, current_day)
-            final_target = calculate_target_bank(initial, 300)
-            progress_percent = (current_target / final_target * 100) if final_target > 0 else 0
-            text += f"\n📊 *Прогресс:* {progress_percent:.1f}%\n"
-            text += f"🎯 *Цель 300 дней:* {final_target:.2f} руб."
-        return text
+        return render_bank_movement_page(initial, current_day, int(page))
     except Exception as e:
         log_error(f"Ошибка в format_bank_movement: {e}", exc_info=True)
         return "❌ Ошибка при формировании движения банка"
 
 # --- КЛАВИАТУРЫ ---
+# Клавиатуры не меняются после сборки, поэтому каждая раскладка собирается
+# один раз на набор аргументов, а ее JSON для reply_markup сериализуется
+# при первой отправке и дальше берется готовым.
+class KeyboardMarkup(types.InlineKeyboardMarkup):
+    _json = None
+
+    def to_json(self):
+        if self._json is None:
+            self._json = super().to_json()
+        return self._json
+
+KEYBOARD_BUILDERS = []
+
+def cached_keyboard(maxsize=None):
+    def decorator(builder):
+        cached = functools.lru_cache(maxsize=maxsize)(builder)
+        KEYBOARD_BUILDERS.append(cached)
+        return cached
+    return decorator
+
+def get_keyboard_cache_stats():
+    stats = {}
+    for builder in KEYBOARD_BUILDERS:
+        info = builder.cache_info()
+        stats[builder.__name__] = {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
+    return stats
+
+@cached_keyboard()
+def simple_input_keyboard():
+    markup = KeyboardMarkup()
+    markup.row(types.InlineKeyboardButton("🔄 Главное меню", callback_data='main_menu'))
+    return markup
+
 def main_menu_keyboard_security(chat_id):
-    markup = types.InlineKeyboardMarkup()
+    return main_menu_keyboard(chat_id == ADMIN_ID)
+
+@cached_keyboard()
+def main_menu_keyboard(is_admin):
+    markup = KeyboardMarkup()
     markup.row(
         types.InlineKeyboardButton("📊 Статистика", callback_data='statistics'),
         types.InlineKeyboardButton("🎯 Заключить пари", callback_data='place_bet')
@@ -689,18 +2340,20 @@ def main_menu_keyboard_security(chat_id):
         types.InlineKeyboardButton("💰 Мои Банки", callback_data='manage_banks'),
         types.InlineKeyboardButton("🎰 Изменить Цель", callback_data='change_goal')
     )
-    if chat_id == ADMIN_ID:
+    if is_admin:
         markup.row(types.InlineKeyboardButton("👥 Управление пользователями", callback_data='manage_users'))
     markup.row(types.InlineKeyboardButton("📊 Статус бота", callback_data='bot_status'))
     return markup
 
+@cached_keyboard()
 def back_to_menu_keyboard():
-    markup = types.InlineKeyboardMarkup()
+    markup = KeyboardMarkup()
     markup.row(types.InlineKeyboardButton("🔄 Главное меню", callback_data='main_menu'))
     return markup
 
+@cached_keyboard()
 def statistics_keyboard():
-    markup = types.InlineKeyboardMarkup()
+    markup = KeyboardMarkup()
     markup.row(
         types.InlineKeyboardButton("📈 Движение Банка", callback_data='bank_movement'),
         types.InlineKeyboardButton("🗑️ Очистить статистику", callback_data='clear_stats')
@@ -708,8 +2361,9 @@ def statistics_keyboard():
     markup.row(types.InlineKeyboardButton("🔄 Главное меню", callback_data='main_menu'))
     return markup
 
+@cached_keyboard(maxsize=64)
 def bank_movement_keyboard(page=1):
-    markup = types.InlineKeyboardMarkup()
+    markup = KeyboardMarkup()
     row_buttons = []
     if page > 1:
         row_buttons.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=f'bank_movement_{page-1}'))
@@ -721,8 +2375,9 @@ def bank_movement_keyboard(page=1):
     markup.row(types.InlineKeyboardButton("↩️ Назад к статистике", callback_data='statistics'))
     return markup
 
+@cached_keyboard()
 def bet_confirmation_keyboard():
-    markup = types.InlineKeyboardMarkup()
+    markup = KeyboardMarkup()
     markup.row(
         types.InlineKeyboardButton("✅ Выигрыш", callback_data='result_win'),
         types.InlineKeyboardButton("❌ Проигрыш", callback_data='result_loss')
@@ -731,8 +2386,9 @@ def bet_confirmation_keyboard():
     markup.row(types.InlineKeyboardButton("🔄 Главное меню", callback_data='main_menu'))
     return markup
 
+@cached_keyboard()
 def edit_bet_keyboard():
-    markup = types.InlineKeyboardMarkup()
+    markup = KeyboardMarkup()
     markup.row(
         types.InlineKeyboardButton("↩️ Назад к ставке", callback_data='back_to_bet'),
         types.InlineKeyboardButton("🔄 Главное меню", callback_data='main_menu')
@@ -740,12 +2396,16 @@ def edit_bet_keyboard():
     return markup
 
 def banks_keyboard(banks):
-    markup = types.InlineKeyboardMarkup()
-    for bank in banks:
+    return build_banks_keyboard(tuple((bank['id'], bank['name'], bank['day']) for bank in banks))
+
+@cached_keyboard(maxsize=1024)
+def build_banks_keyboard(banks):
+    markup = KeyboardMarkup()
+    for bank_id, name, day in banks:
         markup.row(
             types.InlineKeyboardButton(
-                f"🏦 {bank['name']} (День #{bank['day']})",
-                callback_data=f'select_bank_{bank["id"]}'
+                f"🏦 {name} (День #{day})",
+                callback_data=f'select_bank_{bank_id}'
             )
         )
     if len(banks) < MAX_BANKS:
@@ -756,19 +2416,24 @@ def banks_keyboard(banks):
     return markup
 
 def delete_bank_keyboard(banks):
-    markup = types.InlineKeyboardMarkup()
-    for bank in banks:
+    return build_delete_bank_keyboard(tuple((bank['id'], bank['name']) for bank in banks))
+
+@cached_keyboard(maxsize=1024)
+def build_delete_bank_keyboard(banks):
+    markup = KeyboardMarkup()
+    for bank_id, name in banks:
         markup.row(
             types.InlineKeyboardButton(
-                f"🗑️ {bank['name']}",
-                callback_data=f'delete_bank_{bank["id"]}'
+                f"🗑️ {name}",
+                callback_data=f'delete_bank_{bank_id}'
             )
         )
     markup.row(types.InlineKeyboardButton("↩️ Назад к банкам", callback_data='manage_banks'))
     return markup
 
+@cached_keyboard()
 def change_goal_keyboard():
-    markup = types.InlineKeyboardMarkup()
+    markup = KeyboardMarkup()
     markup.row(
         types.InlineKeyboardButton("🔄 Меняем цель", callback_data='modify_goal'),
         types.InlineKeyboardButton("✂️ Разделить цель", callback_data='split_goal')
@@ -776,40 +2441,52 @@ def change_goal_keyboard():
     markup.row(types.InlineKeyboardButton("🔄 Главное меню", callback_data='main_menu'))
     return markup
 
+@cached_keyboard()
 def confirm_split_goal_keyboard():
-    markup = types.InlineKeyboardMarkup()
+    markup = KeyboardMarkup()
     markup.row(
         types.InlineKeyboardButton("✅ Да, разделить", callback_data='confirm_split'),
         types.InlineKeyboardButton("❌ Отмена", callback_data='main_menu')
     )
     return markup
 
+@cached_keyboard(maxsize=64)
 def split_goal_parts_keyboard(goal_index):
-    markup = types.InlineKeyboardMarkup()
-    markup.row(
-        types.InlineKeyboardButton("2 части", callback_data=f'split_parts_{goal_index}_2'),
-        types.InlineKeyboardButton("3 части", callback_data=f'split_parts_{goal_index}_3')
-    )
-    markup.row(
-        types.InlineKeyboardButton("4 части", callback_data=f'split_parts_{goal_index}_4'),
-        types.InlineKeyboardButton("5 части", callback_data=f'split_parts_{goal_index}_5')
-    )
-    markup.row(
-        types.InlineKeyboardButton("6 частей", callback_data=f'split_parts_{goal_index}_6')
-    )
+    markup = KeyboardMarkup()
+    for row in ((2, 3), (4, 5), (6,)):
+        markup.row(*(
+            types.InlineKeyboardButton(format_parts(parts), callback_data=f'split_parts_{goal_index}_{parts}')
+            for parts in row
+        ))
     markup.row(types.InlineKeyboardButton("↩️ Назад", callback_data='split_goal_azamat'))
     return markup
 
+def loss_goals_keyboard(loss_record):
+    return build_loss_goals_keyboard(tuple(loss_record))
+
+@cached_keyboard(maxsize=1024)
+def build_loss_goals_keyboard(loss_record):
+    markup = KeyboardMarkup()
+    for i, goal in enumerate(loss_record):
+        markup.row(types.InlineKeyboardButton(
+            f"Цель {i+1}: {format_rubles(goal)} руб.", 
+            callback_data=f'select_goal_{i}'
+        ))
+    markup.row(types.InlineKeyboardButton("↩️ Назад", callback_data='change_goal'))
+    return markup
+
+@cached_keyboard()
 def confirm_clear_stats_keyboard():
-    markup = types.InlineKeyboardMarkup()
+    markup = KeyboardMarkup()
     markup.row(
         types.InlineKeyboardButton("✅ Да, очистить", callback_data='confirm_clear_stats'),
         types.InlineKeyboardButton("❌ Отмена", callback_data='statistics')
     )
     return markup
 
+@cached_keyboard()
 def users_management_keyboard():
-    markup = types.InlineKeyboardMarkup()
+    markup = KeyboardMarkup()
     markup.row(
         types.InlineKeyboardButton("➕ Добавить пользователя", callback_data='add_user'),
         types.InlineKeyboardButton("➖ Удалить пользователя", callback_data='remove_user')
@@ -820,25 +2497,93 @@ def users_management_keyboard():
     )
     return markup
 
+@cached_keyboard()
 def bot_status_keyboard():
-    markup = types.InlineKeyboardMarkup()
+    markup = KeyboardMarkup()
     markup.row(
         types.InlineKeyboardButton("🔄 Обновить статус", callback_data='bot_status'),
         types.InlineKeyboardButton("🔄 Главное меню", callback_data='main_menu')
     )
     return markup
 
+# --- МАРШРУТИЗАЦИЯ CALLBACK ---
+# Точные маршруты ищутся в словаре, параметризованные (select_bank_<id> и т.п.)
+# по префиксному дереву с выбором самого длинного совпадения.
+class CallbackRouter:
+    def __init__(self):
+        self.exact_routes = {}
+        self.prefix_trie = {}
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def route(self, *names):
+        def decorator(handler):
+            for name in names:
+                self.exact_routes[name] = (name, handler)
+            return handler
+        return decorator
+
+    def prefix(self, prefix):
+        def decorator(handler):
+            node = self.prefix_trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[None] = (prefix + '*', handler)
+            return handler
+        return decorator
+
+    def resolve(self, data):
+        route = self.exact_routes.get(data)
+        if route is not None:
+            return route
+        node = self.prefix_trie
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                route = node[None]
+        return route
+
+    def dispatch(self, call):
+        route = self.resolve(call.data or '')
+        if route is None:
+            return False
+        name, handler = route
+        started = time.perf_counter()
+        try:
+            handler(call)
+        finally:
+            self.record(name, time.perf_counter() - started)
+        return True
+
+    def record(self, name, elapsed):
+        with self.stats_lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = {'calls': 0, 'total_time': 0.0, 'max_time': 0.0}
+            stats['calls'] += 1
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+
+    def get_stats(self):
+        with self.stats_lock:
+            return {name: dict(stats) for name, stats in self.stats.items()}
+
+callback_router = CallbackRouter()
+
 # --- ОСНОВНЫЕ ХЕНДЛЕРЫ ---
 @bot.message_handler(commands=['start', 'menu'])
+@observe_handler
 def handle_start(message):
     try:
         chat_id = message.chat.id
         update_bot_status()
         if not security_check(chat_id):
-            bot.send_message(chat_id, "🚫 *ДОСТУП ЗАПРЕЩЕН*\n\nБот недоступен для вашего аккаунта.", parse_mode='Markdown')
+            outbox.send_message(chat_id, "🚫 *ДОСТУП ЗАПРЕЩЕН*\n\nБот недоступен для вашего аккаунта.", parse_mode='Markdown')
             return
         state = get_user_state(chat_id)
-        state['awaiting_input'] = ''
+        state.awaiting_input = ''
         save_user_state(state)
         welcome_text = (
             f"{get_bot_status_header()}\n\n"
@@ -851,13 +2596,14 @@ def handle_start(message):
             "• 🛡️ Стратегия Азамата при 2+ проигрышах\n\n"
             "_Выберите действия:_"
         )
-        bot.send_message(chat_id, welcome_text, 
+        outbox.send_message(chat_id, welcome_text, 
                         reply_markup=main_menu_keyboard_security(chat_id), 
                         parse_mode='Markdown')
     except Exception as e:
         log_error(f"Ошибка в handle_start: {e}", exc_info=True)
 
 @bot.message_handler(commands=['status'])
+@observe_handler
 def handle_status_command(message):
     try:
         chat_id = message.chat.id
@@ -868,183 +2614,192 @@ def handle_status_command(message):
     except Exception as e:
         log_error(f"Ошибка в handle_status_command: {e}", exc_info=True)
 
-def handle_bot_status_manual(message):
+def format_bot_status():
+    status_info = get_bot_status_info()
+    snapshot = get_health_snapshot()
+    pool_stats = get_db_pool_stats()
+    cache_stats = get_state_cache_stats()
+    dispatch_stats = get_dispatcher_stats()
+    outbox_stats = get_outbox_stats()
+    if snapshot.api_ok:
+        api_status = f"🟢 Доступно ({snapshot.api_latency * 1000:.0f} мс)"
+    else:
+        api_status = f"🔴 Ошибка: {snapshot.api_error}"
+    if snapshot.db_ok:
+        db_status = f"🟢 Доступна ({snapshot.db_latency * 1000:.1f} мс)"
+    else:
+        db_status = f"🔴 Ошибка: {snapshot.db_error}"
+    return (
+        f"🤖 *СТАТУС БОТА*\n\n"
+        f"📊 *Состояние:* {status_info['status']}\n"
+        f"⏱️ *Время работы:* {status_info['uptime']}\n"
+        f"🕐 *Запущен:* {status_info['start_time']}\n"
+        f"📅 *Последняя активность:* {status_info['last_update']}\n\n"
+        f"🔧 *Системные компоненты:*\n"
+        f"• Telegram API: {api_status}\n"
+        f"• База данных: {db_status}\n"
+        f"• Пул соединений: {pool_stats['open']} откр., попаданий {pool_stats['hits']}, промахов {pool_stats['misses']}\n"
+        f"• Кэш состояний: {cache_stats['size']} сессий, попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}\n"
+        f"• Очереди чатов: {dispatch_stats['queue_depth']} в очереди, ожидание {dispatch_stats['wait_avg'] * 1000:.1f} мс (макс. {dispatch_stats['wait_max'] * 1000:.1f} мс)\n"
+        f"• Исходящие: {outbox_stats['queue_depth']} в очереди, отправлено {outbox_stats['sent']}, схлопнуто {outbox_stats['coalesced']}, без изменений {outbox_stats['unchanged']}, 429: {outbox_stats['throttled']}\n"
+        f"• Авторизованных пользователей: {len(AUTHORIZED_USERS)}\n\n"
+        f"💾 *Память и ресурсы:*\n"
+        f"• Файл БД: {snapshot.db_size / 1024:.1f} КБ\n"
+        f"• Файл логов: {snapshot.log_size / 1024:.1f} КБ\n\n"
+        f"_Статус обновлен: {snapshot.checked_at.strftime('%H:%M:%S')}_"
+    )
+
+@bot.message_handler(commands=['traces'])
+@observe_handler
+def handle_traces_command(message):
+    try:
+        chat_id = message.chat.id
+        if not security_check(chat_id) or chat_id != ADMIN_ID:
+            return
+        outbox.send_message(chat_id, format_slowest_traces())
+    except Exception as e:
+        log_error(f"Ошибка в handle_traces_command: {e}", exc_info=True)
+
+# Выполняется в пуле simulations, а не в потоке диспетчера.
+def send_simulation_report(chat_id, state, coefficients, win_probability):
+    try:
+        # NumPy нужен только здесь: импорт bot.py его не тянет
+        from az_simulator import simulate_bankroll, summarize_simulation
+        result = simulate_bankroll(state, coefficients, win_probability, paths=SIMULATION_PATHS,
+                                   max_bets=SIMULATION_MAX_BETS, ruin_bank=MIN_BANK_KOPECKS)
+        outbox.send_message(chat_id,
+                            format_simulation_report(state, coefficients, win_probability, summarize_simulation(result)),
+                            parse_mode='Markdown')
+    except Exception as e:
+        log_error(f"Ошибка в send_simulation_report: {e}", exc_info=True)
+        outbox.send_message(chat_id, "❌ Ошибка при расчете симуляции")
+
+@bot.message_handler(commands=['simulate'])
+@observe_handler
+def handle_simulate_command(message):
     try:
         chat_id = message.chat.id
-        status_info = get_bot_status_info()
-        api_status = "🟢 Доступно"
+        if not security_check(chat_id):
+            return
+        update_bot_status()
+        state = copy_state(get_user_state(chat_id))
+        if not state.bank_id or state.bank < MIN_BANK_KOPECKS:
+            outbox.send_message(chat_id, "❌ Сначала создайте банк и установите сумму банка")
+            return
+        usage = (
+            "🎲 *Симуляция банка*\n\n"
+            "`/simulate 1.85` - коэффициент, вероятность 1/коэффициент\n"
+            "`/simulate 1.7 2.1 55%` - несколько коэффициентов и вероятность выигрыша\n"
+            f"Не больше {SIMULATION_MAX_COEFFS} коэффициентов"
+        )
+        coefficients = []
+        win_probability = None
         try:
-            bot.get_me()
-        except Exception as e:
-            api_status = f"🔴 Ошибка: {str(e)}"
-        db_status = "🟢 Доступна"
+            for arg in (message.text or '').split()[1:]:
+                value = arg.replace(',', '.')
+                if value.endswith('%'):
+                    win_probability = float(value[:-1]) / 100
+                elif float(value) < 1:
+                    win_probability = float(value)
+                else:
+                    coefficients.append(float(value))
+        except ValueError:
+            outbox.send_message(chat_id, usage, parse_mode='Markdown')
+            return
+        if not coefficients and state.current_coeff > 1:
+            coefficients.append(state.current_coeff)
+        if not coefficients or len(coefficients) > SIMULATION_MAX_COEFFS \
+                or any(coeff < MIN_COEFF or coeff > MAX_COEFF for coeff in coefficients) \
+                or (win_probability is not None and not 0 < win_probability < 1):
+            outbox.send_message(chat_id, usage, parse_mode='Markdown')
+            return
+        if not state.initial_balance:
+            state.initial_balance = state.bank
+            state.current_target = calculate_daily_goal(state.bank, calculate_target_bank(state.bank, state.day))
+        rejection = simulations.submit(
+            chat_id, functools.partial(send_simulation_report, chat_id, state, coefficients, win_probability))
+        if rejection:
+            outbox.send_message(chat_id, rejection)
+    except Exception as e:
+        log_error(f"Ошибка в handle_simulate_command: {e}", exc_info=True)
         try:
-            conn = sqlite3.connect(DB_NAME, check_same_thread=False)
-            cursor = conn.cursor()
-            cursor.execute('SELECT COUNT(*) FROM users')
-            conn.close()
-        except Exception as e:
-            db_status = f"🔴 Ошибка: {str(e)}"
-        status_text = (
-            f"🤖 *СТАТУС БОТА*\n\n"
-            f"📊 *Состояние:* {status_info['status']}\n"
-            f"⏱️ *Время работы:* {status_info['uptime']}\n"
-            f"🕐 *Запущен:* {status_info['start_time']}\n"
-            f"📅 *Последняя активность:* {status_info['last_update']}\n\n"
-            f"🔧 *Системные компоненты:*\n"
-            f"• Telegram API: {api_status}\n"
-            f"• База данных: {db_status}\n"
-            f"• Авторизованных пользователей: {len(AUTHORIZED_USERS)}\n\n"
-            f"💾 *Память и ресурсы:*\n"
-            f"• Файл БД: {os.path.getsize(DB_NAME) / 1024:.1f} КБ\n"
-            f"• Файл логов: {os.path.getsize('bot_errors.log') / 1024:.1f} КБ\n\n"
-            f"_Статус обновлен: {datetime.now().strftime('%H:%M:%S')}_"
-        )
-        bot.send_message(chat_id, status_text, 
+            outbox.send_message(chat_id, "❌ Ошибка при расчете симуляции")
+        except Exception:
+            pass
+
+@observe_handler
+def handle_bot_status_manual(message):
+    try:
+        chat_id = message.chat.id
+        outbox.send_message(chat_id, format_bot_status(), 
                         reply_markup=bot_status_keyboard(),
                         parse_mode='Markdown')
     except Exception as e:
         log_error(f"Ошибка в handle_bot_status_manual: {e}", exc_info=True)
         try:
-            bot.send_message(chat_id, "❌ Ошибка при получении статуса бота")
+            outbox.send_message(chat_id, "❌ Ошибка при получении статуса бота")
         except Exception:
             pass
 
 @bot.callback_query_handler(func=lambda call: True)
+@observe_handler
 def handle_all_callbacks(call):
     try:
         chat_id = call.message.chat.id
         update_bot_status()
         if not security_check(chat_id):
-            bot.answer_callback_query(call.id, "🚫 Доступ запрещен", show_alert=True)
+            outbox.answer_callback_query(call.id, "🚫 Доступ запрещен", show_alert=True)
             return
         print(f"📨 Получен callback: {call.data}")
-        if call.data == 'main_menu':
-            handle_main_menu(call)
-        elif call.data == 'statistics':
-            handle_statistics(call)
-        elif call.data == 'place_bet':
-            handle_place_bet(call)
-        elif call.data == 'manage_banks':
-            handle_manage_banks(call)
-        elif call.data == 'create_bank':
-            handle_create_bank(call)
-        elif call.data == 'delete_bank':
-            handle_delete_bank_menu(call)
-        elif call.data.startswith('select_bank_'):
-            handle_select_bank(call)
-        elif call.data.startswith('delete_bank_'):
-            handle_delete_bank_confirm(call)
-        elif call.data in ['result_win', 'result_loss']:
-            handle_bet_result(call)
-        elif call.data == 'change_goal':
-            handle_change_goal(call)
-        elif call.data == 'modify_goal':
-            handle_modify_goal(call)
-        elif call.data == 'split_goal':
-            handle_split_goal(call)
-        elif call.data == 'split_goal_azamat':
-            handle_split_goal_azamat(call)
-        elif call.data.startswith('select_goal_'):
-            handle_select_goal(call)
-        elif call.data.startswith('split_parts_'):
-            handle_split_parts(call)
-        elif call.data == 'confirm_split':
-            handle_confirm_split(call)
-        elif call.data == 'clear_stats':
-            handle_clear_stats(call)
-        elif call.data == 'confirm_clear_stats':
-            handle_confirm_clear_stats(call)
-        elif call.data == 'manage_users':
-            handle_manage_users(call)
-        elif call.data == 'add_user':
-            handle_add_user(call)
-        elif call.data == 'remove_user':
-            handle_remove_user(call)
-        elif call.data == 'list_users':
-            handle_list_users(call)
-        elif call.data == 'bot_status':
-            handle_bot_status(call)
-        elif call.data == 'edit_bet':
-            handle_edit_bet(call)
-        elif call.data == 'back_to_bet':
-            handle_back_to_bet(call)
-        elif call.data == 'bank_movement':
-            handle_bank_movement(call)
-        elif call.data.startswith('bank_movement_'):
-            handle_bank_movement_page(call)
-        else:
+        if not callback_router.dispatch(call):
             print(f"❌ Неизвестный callback: {call.data}")
-            bot.answer_callback_query(call.id, "❌ Неизвестная команда")
+            outbox.answer_callback_query(call.id, "❌ Неизвестная команда")
     except Exception as e:
         error_msg = f"Ошибка в обработчике callback {getattr(call, 'data', '')}: {e}"
         log_error(error_msg, exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Произошла ошибка")
+            outbox.answer_callback_query(call.id, "❌ Произошла ошибка")
         except Exception:
             pass
 
+@callback_router.route('bot_status')
+@observe_handler
 def handle_bot_status(call):
     try:
         chat_id = call.message.chat.id
-        status_info = get_bot_status_info()
-        api_status = "🟢 Доступно"
-        try:
-            bot.get_me()
-        except Exception as e:
-            api_status = f"🔴 Ошибка: {str(e)}"
-        db_status = "🟢 Доступна"
-        try:
-            conn = sqlite3.connect(DB_NAME, check_same_thread=False)
-            cursor = conn.cursor()
-            cursor.execute('SELECT COUNT(*) FROM users')
-            conn.close()
-        except Exception as e:
-            db_status = f"🔴 Ошибка: {str(e)}"
-        status_text = (
-            f"🤖 *СТАТУС БОТА*\n\n"
-            f"📊 *Состояние:* {status_info['status']}\n"
-            f"⏱️ *Время работы:* {status_info['uptime']}\n"
-            f"🕐 *Запущен:* {status_info['start_time']}\n"
-            f"📅 *Последняя активность:* {status_info['last_update']}\n\n"
-            f"🔧 *Системные компоненты:*\n"
-            f"• Telegram API: {api_status}\n"
-            f"• База данных: {db_status}\n"
-            f"• Авторизованных пользователей: {len(AUTHORIZED_USERS)}\n\n"
-            f"💾 *Память и ресурсы:*\n"
-            f"• Файл БД: {os.path.getsize(DB_NAME) / 1024:.1f} КБ\n"
-            f"• Файл логов: {os.path.getsize('bot_errors.log') / 1024:.1f} КБ\n\n"
-            f"_Статус обновлен: {datetime.now().strftime('%H:%M:%S')}_"
-        )
-        bot.edit_message_text(
-            status_text,
+        outbox.edit_message_text(
+            format_bot_status(),
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=bot_status_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id, "✅ Статус обновлен")
+        outbox.answer_callback_query(call.id, "✅ Статус обновлен")
     except Exception as e:
         log_error(f"Ошибка в handle_bot_status: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при получении статуса")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при получении статуса")
         except Exception:
             pass
 
+@callback_router.route('main_menu')
+@observe_handler
 def handle_main_menu(call):
     try:
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
         chat_id = call.message.chat.id
         handle_start(call.message)
     except Exception as e:
         log_error(f"Ошибка в handle_main_menu: {e}", exc_info=True)
 
+@callback_router.route('statistics')
+@observe_handler
 def handle_statistics(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        if not state.get('bank_id'):
-            bot.edit_message_text(
+        if not state.bank_id:
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n"
                 "❌ *Нет активного банка*\n\nСоздайте банк в разделе 'Мои Банки'",
                 chat_id=chat_id,
@@ -1052,59 +2807,63 @@ def handle_statistics(call):
                 reply_markup=main_menu_keyboard_security(chat_id),
                 parse_mode='Markdown'
             )
-            bot.answer_callback_query(call.id)
+            outbox.answer_callback_query(call.id)
             return
-        total_bets = int(state.get('total_bets', 0) or 0)
-        total_wins = int(state.get('total_wins', 0) or 0)
+        total_bets = state.total_bets
+        total_wins = state.total_wins
         total_losses = total_bets - total_wins
         success_rate = (total_wins / total_bets * 100) if total_bets > 0 else 0.0
         loss_rate = (total_losses / total_bets * 100) if total_bets > 0 else 0.0
-        initial = float(state.get('initial_balance', 0) or 0.0)
-        current_bank = state.get('bank', 0)
-        current_day = state.get('day', 1)
+        initial = state.initial_balance
+        current_bank = state.bank
+        current_day = state.day
         target_bank = calculate_target_bank(initial, current_day)
         daily_goal = calculate_daily_goal(current_bank, target_bank)
-        bet_history_text = format_bet_history(state.get('bet_history', []))
+        bank_stats_text = format_bank_stats(get_bank_stats(chat_id, state.bank_id))
+        bet_history_text = format_bet_history(get_bet_history(chat_id, state.bank_id))
         text = (
             f"{get_bot_status_header()}\n\n"
-            f"📊 *Статистика банка:* **{state.get('bank_name', 'Неизвестно')}**\n\n"
-            f"🏁 *Начальный банк:* **{initial:.2f} руб.**\n"
-            f"💵 *Текущий банк:* **{current_bank:.2f} руб.**\n"
-            f"🎯 *Цель дня:* **+{daily_goal:.2f} руб.**\n"
+            f"📊 *Статистика банка:* **{state.bank_name or 'Неизвестно'}**\n\n"
+            f"🏁 *Начальный банк:* **{format_rubles(initial)} руб.**\n"
+            f"💵 *Текущий банк:* **{format_rubles(current_bank)} руб.**\n"
+            f"🎯 *Цель дня:* **+{format_rubles(daily_goal)} руб.**\n"
             f"📅 *Текущий день:* **#{current_day}**\n"
-            f"🏆 *Целевой банк дня:* **{target_bank:.2f} руб.**\n\n"
+            f"🏆 *Целевой банк дня:* **{format_rubles(target_bank)} руб.**\n\n"
             f"📈 *Общая статистика:*\n"
             f"• Всего ставок: **{total_bets}**\n"
             f"• Выигрышей: **{total_wins}** ({success_rate:.1f}%)\n"
             f"• Проигрышей: **{total_losses}** ({loss_rate:.1f}%)\n\n"
+            f"{bank_stats_text}"
             f"{bet_history_text}"
         )
         azamat_info = format_azamat_mode_info(state)
         if azamat_info:
             text += f"\n\n{azamat_info}"
-        if state.get('sub_goals'):
-            text += f"\n• Разделенных целей: **{len(state['sub_goals'])}**"
-        bot.edit_message_text(
+        if state.sub_goals:
+            text += f"\n• Разделенных целей: **{len(state.sub_goals)}**"
+        outbox.edit_message_text(
             text,
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=statistics_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_statistics: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при загрузке статистики")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при загрузке статистики")
         except Exception:
             pass
 
+@callback_router.route('bank_movement')
+@observe_handler
 def handle_bank_movement(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        if not state.get('bank_id'):
-            bot.edit_message_text(
+        if not state.bank_id:
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n"
                 "❌ *Нет активного банка*\n\nСоздайте банк в разделе 'Мои Банки'",
                 chat_id=chat_id,
@@ -1112,11 +2871,11 @@ def handle_bank_movement(call):
                 reply_markup=main_menu_keyboard_security(chat_id),
                 parse_mode='Markdown'
             )
-            bot.answer_callback_query(call.id)
+            outbox.answer_callback_query(call.id)
             return
-        initial = state.get('initial_balance', 0)
+        initial = state.initial_balance
         if initial <= 0:
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n"
                 "❌ *Начальный банк не установлен!*\n\nСначала установите начальный банк.",
                 chat_id=chat_id,
@@ -1124,100 +2883,108 @@ def handle_bank_movement(call):
                 reply_markup=statistics_keyboard(),
                 parse_mode='Markdown'
             )
-            bot.answer_callback_query(call.id)
+            outbox.answer_callback_query(call.id)
             return
         text = format_bank_movement(state, 1)
-        bot.edit_message_text(
+        outbox.edit_message_text(
             text,
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=bank_movement_keyboard(1),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_bank_movement: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при загрузке движения банка")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при загрузке движения банка")
         except Exception:
             pass
 
+@callback_router.prefix('bank_movement_')
+@observe_handler
 def handle_bank_movement_page(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        if not state.get('bank_id'):
-            bot.answer_callback_query(call.id, "❌ Нет активного банка")
+        if not state.bank_id:
+            outbox.answer_callback_query(call.id, "❌ Нет активного банка")
             return
         page = int(call.data.replace('bank_movement_', ''))
-        initial = state.get('initial_balance', 0)
+        if not 1 <= page <= BANK_MOVEMENT_PAGES:
+            outbox.answer_callback_query(call.id, "❌ Нет такой страницы")
+            return
+        initial = state.initial_balance
         if initial <= 0:
-            bot.answer_callback_query(call.id, "❌ Начальный банк не установлен")
+            outbox.answer_callback_query(call.id, "❌ Начальный банк не установлен")
             return
         text = format_bank_movement(state, page)
-        bot.edit_message_text(
+        outbox.edit_message_text(
             text,
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=bank_movement_keyboard(page),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id, f"📄 Страница {page}")
+        outbox.answer_callback_query(call.id, f"📄 Страница {page}")
     except Exception as e:
         log_error(f"Ошибка в handle_bank_movement_page: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при переключении страницы")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при переключении страницы")
         except Exception:
             pass
 
+@callback_router.route('clear_stats')
+@observe_handler
 def handle_clear_stats(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        if not state.get('bank_id'):
-            bot.answer_callback_query(call.id, "❌ Нет активного банка")
+        if not state.bank_id:
+            outbox.answer_callback_query(call.id, "❌ Нет активного банка")
             return
-        bot.edit_message_text(
+        outbox.edit_message_text(
             f"{get_bot_status_header()}\n\n"
             f"🗑️ *Очистка статистики*\n\n"
-            f"Вы уверены, что хотите очистить всю статистику банка *{state.get('bank_name', 'Неизвестно')}*?\n\n"
+            f"Вы уверены, что хотите очистить всю статистику банка *{state.bank_name or 'Неизвестно'}*?\n\n"
             f"Это действие нельзя отменить!",
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=confirm_clear_stats_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_clear_stats: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при очистке статистики")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при очистке статистики")
         except Exception:
             pass
 
+@callback_router.route('confirm_clear_stats')
+@observe_handler
 def handle_confirm_clear_stats(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        if not state.get('bank_id'):
-            bot.answer_callback_query(call.id, "❌ Нет активного банка")
+        if not state.bank_id:
+            outbox.answer_callback_query(call.id, "❌ Нет активного банка")
             return
-        if reset_bank_stats(state['bank_id']):
-            state['total_bets'] = 0
-            state['total_wins'] = 0
-            state['bet_history'] = []
+        if reset_bank_stats(chat_id, state.bank_id):
+            state.total_bets = 0
+            state.total_wins = 0
             save_user_state(state)
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n"
                 f"✅ *Статистика очищена!*\n\n"
-                f"Все данные статистики банка *{state.get('bank_name', 'Неизвестно')}* были удалены.",
+                f"Все данные статистики банка *{state.bank_name or 'Неизвестно'}* были удалены.",
                 chat_id=chat_id,
                 message_id=call.message.message_id,
                 reply_markup=main_menu_keyboard_security(chat_id),
                 parse_mode='Markdown'
             )
         else:
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n"
                 "❌ *Ошибка очистки статистики*",
                 chat_id=chat_id,
@@ -1225,14 +2992,16 @@ def handle_confirm_clear_stats(call):
                 reply_markup=main_menu_keyboard_security(chat_id),
                 parse_mode='Markdown'
             )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_confirm_clear_stats: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при очистке статистики")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при очистке статистики")
         except Exception:
             pass
 
+@callback_router.route('manage_banks')
+@observe_handler
 def handle_manage_banks(call):
     try:
         chat_id = call.message.chat.id
@@ -1241,137 +3010,147 @@ def handle_manage_banks(call):
             text = f"{get_bot_status_header()}\n\n💼 *Управление банками*\n\nУ вас пока нет банков. Создайте первый банк!"
         else:
             text = f"{get_bot_status_header()}\n\n💼 *Ваши банки* ({len(banks)}/{MAX_BANKS}):\n\nВыберите банк:"
-        bot.edit_message_text(
+        outbox.edit_message_text(
             text,
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=banks_keyboard(banks),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         error_msg = f"Ошибка в handle_manage_banks: {e}"
         log_error(error_msg, exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при загрузке банков")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при загрузке банков")
         except Exception:
             pass
 
+@callback_router.route('create_bank')
+@observe_handler
 def handle_create_bank(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        state['awaiting_input'] = 'bank_name'
+        state.awaiting_input = 'bank_name'
         save_user_state(state)
-        bot.edit_message_text(
+        outbox.edit_message_text(
             f"{get_bot_status_header()}\n\n💼 *Создание банка*\n\nВведите название для нового банка:",
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=back_to_menu_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         error_msg = f"Ошибка в handle_create_bank: {e}"
         log_error(error_msg, exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при создании банка")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при создании банка")
         except Exception:
             pass
 
+@callback_router.route('delete_bank')
+@observe_handler
 def handle_delete_bank_menu(call):
     try:
         chat_id = call.message.chat.id
         banks = get_user_banks(chat_id)
         if not banks:
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n❌ У вас нет банков для удаления",
                 chat_id=chat_id,
                 message_id=call.message.message_id,
                 reply_mukup=main_menu_keyboard_security(chat_id)
             )
-            bot.answer_callback_query(call.id)
+            outbox.answer_callback_query(call.id)
             return
-        bot.edit_message_text(
+        outbox.edit_message_text(
             f"{get_bot_status_header()}\n\n🗑️ *Удаление банка*\n\nВыберите банк для удаления:",
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=delete_bank_keyboard(banks),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         error_msg = f"Ошибка в handle_delete_bank_menu: {e}"
         log_error(error_msg, exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при загрузке меню удаления")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при загрузке меню удаления")
         except Exception:
             pass
 
+@callback_router.prefix('delete_bank_')
+@observe_handler
 def handle_delete_bank_confirm(call):
     try:
         chat_id = call.message.chat.id
         bank_id = int(call.data.replace('delete_bank_', ''))
         success, message = delete_bank(chat_id, bank_id)
         if success:
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n{message}",
                 chat_id=chat_id,
                 message_id=call.message.message_id,
                 reply_markup=main_menu_keyboard_security(chat_id)
             )
         else:
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n{message}",
                 chat_id=chat_id,
                 message_id=call.message.message_id,
                 reply_markup=main_menu_keyboard_security(chat_id)
             )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         error_msg = f"Ошибка в handle_delete_bank_confirm: {e}"
         log_error(error_msg, exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при удалении банка")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при удалении банка")
         except Exception:
             pass
 
+@callback_router.prefix('select_bank_')
+@observe_handler
 def handle_select_bank(call):
     try:
         chat_id = call.message.chat.id
         bank_id = int(call.data.replace('select_bank_', ''))
         if switch_bank(chat_id, bank_id):
             state = get_user_state(chat_id)
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n"
-                f"✅ *Банк активирован!*\n\n🏦 **{state.get('bank_name', 'Неизвестно')}**\n💵 Баланс: **{state.get('bank', 0):.2f} руб.**\n📅 День: **#{state.get('day', 1)}**",
+                f"✅ *Банк активирован!*\n\n🏦 **{state.bank_name or 'Неизвестно'}**\n💵 Баланс: **{format_rubles(state.bank)} руб.**\n📅 День: **#{state.day}**",
                 chat_id=chat_id,
                 message_id=call.message.message_id,
                 reply_markup=main_menu_keyboard_security(chat_id),
                 parse_mode='Markdown'
             )
         else:
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n❌ Ошибка при активации банка",
                 chat_id=chat_id,
                 message_id=call.message.message_id,
                 reply_markup=main_menu_keyboard_security(chat_id)
             )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         error_msg = f"Ошибка в handle_select_bank: {e}"
         log_error(error_msg, exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при выборе банка")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при выборе банка")
         except Exception:
             pass
 
+@callback_router.route('place_bet')
+@observe_handler
 def handle_place_bet(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        if not state.get('bank_id'):
-            bot.edit_message_text(
+        if not state.bank_id:
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n"
                 "❌ *Нет активного банка*\n\nСоздайте банк в разделе 'Мои Банки'",
                 chat_id=chat_id,
@@ -1379,32 +3158,32 @@ def handle_place_bet(call):
                 reply_markup=main_menu_keyboard_security(chat_id),
                 parse_mode='Markdown'
             )
-            bot.answer_callback_query(call.id)
+            outbox.answer_callback_query(call.id)
             return
-        if state.get('awaiting_bet_result') and state.get('current_coeff', 0) != 0 and state.get('current_stake', 0) != 0:
-            stake = state.get('current_stake', 0)
-            coeff = state.get('current_coeff', 0)
-            potential_profit = stake * (coeff - 1)
+        if state.awaiting_bet_result and state.current_coeff != 0 and state.current_stake != 0:
+            stake = state.current_stake
+            coeff = state.current_coeff
+            potential_profit = calculate_profit(stake, coeff)
             confirmation_text = (
                 f"{get_bot_status_header()}\n\n"
                 f"💾 *СОХРАНЕННАЯ СТАВКА*\n\n"
-                f"💰 *Сумма:* **{stake:.2f} руб.**\n"
+                f"💰 *Сумма:* **{format_rubles(stake)} руб.**\n"
                 f"⚙️ *Коэффициент:* **{coeff:.2f}**\n"
-                f"🎯 *Цель:* **{state.get('current_target', 0):.2f} руб.**\n"
-                f"💵 *Прибыль:* **+{potential_profit:.2f} руб.**\n\n"
+                f"🎯 *Цель:* **{format_rubles(state.current_target)} руб.**\n"
+                f"💵 *Прибыль:* **+{format_rubles(potential_profit)} руб.**\n\n"
                 f"🎲 *Зафиксируйте результат события:*"
             )
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 confirmation_text,
                 chat_id=chat_id,
                 message_id=call.message.message_id,
                 reply_markup=bet_confirmation_keyboard(),
                 parse_mode='Markdown'
             )
-            bot.answer_callback_query(call.id)
+            outbox.answer_callback_query(call.id)
             return
-        if state.get('bank', 0) < MIN_BANK_AMOUNT:
-            state['awaiting_input'] = 'set_bank'
+        if state.bank < MIN_BANK_KOPECKS:
+            state.awaiting_input = 'set_bank'
             save_user_state(state)
             text = (
                 f"{get_bot_status_header()}\n\n"
@@ -1413,325 +3192,330 @@ def handle_place_bet(call):
                 f"_Диапазон: {MIN_BANK_AMOUNT}-{MAX_BANK_AMOUNT} руб._"
                 f"{format_input_prompt('set_bank')}"
             )
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 text,
                 chat_id=chat_id,
                 message_id=call.message.message_id,
                 reply_markup=simple_input_keyboard(),
                 parse_mode='Markdown'
             )
-            bot.answer_callback_query(call.id)
+            outbox.answer_callback_query(call.id)
             return
-        if not state.get('initial_balance') or state.get('initial_balance', 0) == 0:
-            state['initial_balance'] = state['bank']
-            current_day = state.get('day', 1)
-            target_bank = calculate_target_bank(state['bank'], current_day)
-            state['current_target'] = calculate_daily_goal(state['bank'], target_bank)
-            state['daily_goal'] = state['current_target']
+        if not state.initial_balance:
+            state.initial_balance = state.bank
+            current_day = state.day
+            target_bank = calculate_target_bank(state.bank, current_day)
+            state.current_target = calculate_daily_goal(state.bank, target_bank)
+            state.daily_goal = state.current_target
             save_user_state(state)
-        initial = state.get('initial_balance', 0)
-        current_bank = state.get('bank', 0)
-        current_day = state.get('day', 1)
+        initial = state.initial_balance
+        current_bank = state.bank
+        current_day = state.day
         target_bank = calculate_target_bank(initial, current_day)
-        daily_goal = calculate_daily_goal(current_bank, target_bank)
-        status = "🛡️ АЗАМАТ РЕЖИМ" if state.get('in_azamat_mode') else "🎯 ОСНОВНОЙ РЕЖИМ"
+        status = "🛡️ АЗАМАТ РЕЖИМ" if state.in_azamat_mode else "🎯 ОСНОВНОЙ РЕЖИМ"
         text = (
             f"{get_bot_status_header()}\n\n"
             f"*{status}*\n\n"
-            f"🏁 *Начальный банк:* **{initial:.2f} руб.**\n"
-            f"💵 *Текущий банк:* **{current_bank:.2f} руб.**\n"
-            f"🎯 *Текущая цель:* **{state.get('current_target', daily_goal):.2f} руб.**\n"
+            f"🏁 *Начальный банк:* **{format_rubles(initial)} руб.**\n"
+            f"💵 *Текущий банк:* **{format_rubles(current_bank)} руб.**\n"
+            f"🎯 *Текущая цель:* **{format_rubles(state.current_target)} руб.**\n"
             f"📅 *День:* **#{current_day}**\n"
-            f"🏆 *Целевой банк дня:* **{target_bank:.2f} руб.**\n"
+            f"🏆 *Целевой банк дня:* **{format_rubles(target_bank)} руб.**\n"
         )
         azamat_info = format_azamat_mode_info(state)
         if azamat_info:
             text += azamat_info
-        if state.get('sub_goals'):
-            text += f"\n✂️ *Разделенные цели:* **{len(state['sub_goals'])} часть(и)**\n"
+        if state.sub_goals:
+            text += f"\n✂️ *Разделенные цели:* **{format_parts(len(state.sub_goals))}**\n"
         text += format_input_prompt('set_coeff')
-        state['awaiting_input'] = 'set_coeff'
+        state.awaiting_input = 'set_coeff'
         save_user_state(state)
-        bot.edit_message_text(
+        outbox.edit_message_text(
             text,
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=simple_input_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_place_bet: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при заключении пари")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при заключении пари")
         except Exception:
             pass
 
+@callback_router.route('result_win', 'result_loss')
+@observe_handler
 def handle_bet_result(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        if state.get('current_stake', 0) <= 0:
-            bot.edit_message_text(
+        if state.current_stake <= 0:
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n❌ Ошибка: ставка не рассчитана",
                 chat_id=chat_id,
                 message_id=call.message.message_id,
                 reply_markup=main_menu_keyboard_security(chat_id),
                 parse_mode='Markdown'
             )
-            bot.answer_callback_query(call.id)
+            outbox.answer_callback_query(call.id)
             return
-        state['total_bets'] = int(state.get('total_bets', 0)) + 1
+        state.total_bets += 1
         if call.data == 'result_win':
             state = process_win(state)
-            stake = state.get('current_stake', 0)
-            coeff = state.get('current_coeff', 0)
-            profit = stake * (coeff - 1)
-            text = f"✅ *ВЫИГРЫШ!*\n+{profit:.2f} руб. (ставка: {stake:.2f} руб.)"
+            stake = state.current_stake
+            coeff = state.current_coeff
+            profit = calculate_profit(stake, coeff)
+            text = f"✅ *ВЫИГРЫШ!*\n+{format_rubles(profit)} руб. (ставка: {format_rubles(stake)} руб.)"
         else:
             state = process_loss(state)
-            text = f"❌ *ПРОИГРЫШ!*\n-{state.get('current_stake', 0):.2f} руб."
-        day_advanced_count = 0
-        while check_and_advance_day(state):
-            day_advanced_count += 1
-        state['current_stake'] = 0
-        state['current_coeff'] = 0
-        state['awaiting_bet_result'] = False
+            text = f"❌ *ПРОИГРЫШ!*\n-{format_rubles(state.current_stake)} руб."
+        day_advanced_count = check_and_advance_day(state)
+        state.current_stake = 0
+        state.current_coeff = 0.0
+        state.awaiting_bet_result = False
         save_user_state(state)
-        initial = state.get('initial_balance', 0)
-        current_bank = state.get('bank', 0)
-        current_day = state.get('day', 1)
+        initial = state.initial_balance
+        current_bank = state.bank
+        current_day = state.day
         target_bank = calculate_target_bank(initial, current_day)
         daily_goal = calculate_daily_goal(current_bank, target_bank)
-        progress = f"\n\n💵 *Текущий банк:* {current_bank:.2f} руб.\n"
-        progress += f"🎯 *Цель дня:* +{daily_goal:.2f} руб.\n"
+        progress = f"\n\n💵 *Текущий банк:* {format_rubles(current_bank)} руб.\n"
+        progress += f"🎯 *Цель дня:* +{format_rubles(daily_goal)} руб.\n"
         progress += f"📅 *День:* #{current_day}\n"
-        progress += f"🏆 *Целевой банк дня:* {target_bank:.2f} руб."
+        progress += f"🏆 *Целевой банк дня:* {format_rubles(target_bank)} руб."
         azamat_info = format_azamat_mode_info(state)
         if azamat_info:
             progress += f"\n\n{azamat_info}"
         if day_advanced_count > 0:
             progress += f"\n\n📈 *АВТОПЕРЕХОД! День #{current_day}*"
-        bot.edit_message_text(
+        outbox.edit_message_text(
             f"{get_bot_status_header()}\n\n{text}{progress}",
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=main_menu_keyboard_security(chat_id),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_bet_result: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при обработке результата")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при обработке результата")
         except Exception:
             pass
 
+@callback_router.route('change_goal')
+@observe_handler
 def handle_change_goal(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        if not state.get('bank_id'):
-            bot.edit_message_text(
+        if not state.bank_id:
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n❌ *Нет активного банка*\n\nСоздайте банк в разделе 'Мои Банки'",
                 chat_id=chat_id,
                 message_id=call.message.message_id,
                 reply_markup=main_menu_keyboard_security(chat_id),
                 parse_mode='Markdown'
             )
-            bot.answer_callback_query(call.id)
+            outbox.answer_callback_query(call.id)
             return
-        current_target = state.get('current_target', 0)
-        initial = state.get('initial_balance', 0)
-        current_day = state.get('day', 1)
+        current_target = state.current_target
+        initial = state.initial_balance
+        current_day = state.day
         target_bank = calculate_target_bank(initial, current_day)
         text = (
             f"{get_bot_status_header()}\n\n"
             f"🎰 *Изменение Цели*\n\n"
-            f"🏁 *Начальный банк:* **{initial:.2f} руб.**\n"
-            f"💵 *Текущий банк:* **{state.get('bank', 0):.2f} руб.**\n"
-            f"🎯 *Текущая цель:* **{current_target:.2f} руб.**\n"
+            f"🏁 *Начальный банк:* **{format_rubles(initial)} руб.**\n"
+            f"💵 *Текущий банк:* **{format_rubles(state.bank)} руб.**\n"
+            f"🎯 *Текущая цель:* **{format_rubles(current_target)} руб.**\n"
             f"📅 *День:* **#{current_day}**\n"
-            f"🏆 *Целевой банк дня:* **{target_bank:.2f} руб.**\n\n"
+            f"🏆 *Целевой банк дня:* **{format_rubles(target_bank)} руб.**\n\n"
             f"Выберите действие:"
         )
-        bot.edit_message_text(
+        outbox.edit_message_text(
             text,
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=change_goal_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_change_goal: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при загрузке меню")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при загрузке меню")
         except:
             pass
 
+@callback_router.route('modify_goal')
+@observe_handler
 def handle_modify_goal(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        if not state.get('bank_id'):
-            bot.answer_callback_query(call.id, "❌ Нет активного банка")
+        if not state.bank_id:
+            outbox.answer_callback_query(call.id, "❌ Нет активного банка")
             return
-        state['awaiting_input'] = 'modify_goal'
+        state.awaiting_input = 'modify_goal'
         save_user_state(state)
-        current_target = state.get('current_target', 0)
+        current_target = state.current_target
         text = (
             f"{get_bot_status_header()}\n\n"
             f"🔄 *Изменение цели дня*\n\n"
-            f"Текущая цель: **{current_target:.2f} руб.**\n\n"
+            f"Текущая цель: **{format_rubles(current_target)} руб.**\n\n"
             f"Введите новую цель дня (сумма в рублях):"
         )
-        bot.edit_message_text(
+        outbox.edit_message_text(
             text,
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=back_to_menu_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_modify_goal: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при изменении цели")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при изменении цели")
         except:
             pass
 
+@callback_router.route('edit_bet')
+@observe_handler
 def handle_edit_bet(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        current_coeff = state.get('current_coeff', 0)
-        current_stake = state.get('current_stake', 0)
-        current_target = state.get('current_target', 0)
-        state['awaiting_input'] = 'edit_coeff'
-        state['edit_original_coeff'] = current_coeff
-        state['edit_original_stake'] = current_stake
+        current_coeff = state.current_coeff
+        current_stake = state.current_stake
+        current_target = state.current_target
+        state.awaiting_input = 'edit_coeff'
+        state.edit_original_coeff = current_coeff
+        state.edit_original_stake = current_stake
         save_user_state(state)
-        potential_profit = current_stake * (current_coeff - 1)
+        potential_profit = calculate_profit(current_stake, current_coeff)
         edit_text = (
             f"{get_bot_status_header()}\n\n"
             f"✏️ *РЕДАКТИРОВАНИЕ СТАВКИ*\n\n"
             f"📊 *Текущие параметры:*\n"
             f"• Коэффициент: **{current_coeff:.2f}**\n"
-            f"• Сумма ставки: **{current_stake:.2f} руб.**\n"
-            f"• Потенциальная прибыль: **+{potential_profit:.2f} руб.**\n\n"
-            f"🎯 *Цель:* **{current_target:.2f} руб.**\n\n"
+            f"• Сумма ставки: **{format_rubles(current_stake)} руб.**\n"
+            f"• Потенциальная прибыль: **+{format_rubles(potential_profit)} руб.**\n\n"
+            f"🎯 *Цель:* **{format_rubles(current_target)} руб.**\n\n"
             f"✍️ *Введите новый коэффициент:*\n"
             f"_Текущий: {current_coeff:.2f}_"
         )
-        bot.edit_message_text(
+        outbox.edit_message_text(
             edit_text,
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=edit_bet_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_edit_bet: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при редактировании ставки")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при редактировании ставки")
         except:
             pass
 
+@callback_router.route('back_to_bet')
+@observe_handler
 def handle_back_to_bet(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        state['awaiting_input'] = ''
+        state.awaiting_input = ''
         save_user_state(state)
-        stake = state.get('current_stake', 0)
-        coeff = state.get('current_coeff', 0)
-        potential_profit = stake * (coeff - 1)
+        stake = state.current_stake
+        coeff = state.current_coeff
+        potential_profit = calculate_profit(stake, coeff)
         confirmation_text = (
             f"{get_bot_status_header()}\n\n"
             f"✅ *СТАВКА ПОДТВЕРЖДЕНА!*\n\n"
-            f"💰 *Сумма:* **{stake:.2f} руб.**\n"
+            f"💰 *Сумма:* **{format_rubles(stake)} руб.**\n"
             f"⚙️ *Коэффициент:* **{coeff:.2f}**\n"
-            f"🎯 *Цель:* **{state.get('current_target', 0):.2f} руб.**\n"
-            f"💵 *Прибыль:* **+{potential_profit:.2f} руб.**\n\n"
+            f"🎯 *Цель:* **{format_rubles(state.current_target)} руб.**\n"
+            f"💵 *Прибыль:* **+{format_rubles(potential_profit)} руб.**\n\n"
             f"🎲 *Зафиксируйте результат события:*"
         )
-        bot.edit_message_text(
+        outbox.edit_message_text(
             confirmation_text,
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=bet_confirmation_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_back_to_bet: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при возврате к ставке")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при возврате к ставке")
         except:
             pass
 
+@callback_router.route('split_goal_azamat')
+@observe_handler
 def handle_split_goal_azamat(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        if not state.get('in_azamat_mode') or not state.get('loss_record'):
-            bot.answer_callback_query(call.id, "❌ Нет проигрышей для разделения")
+        if not state.in_azamat_mode or not state.loss_record:
+            outbox.answer_callback_query(call.id, "❌ Нет проигрышей для разделения")
             return
-        loss_record = state.get('loss_record', [])
-        markup = types.InlineKeyboardMarkup()
-        for i, goal in enumerate(loss_record):
-            markup.row(types.InlineKeyboardButton(
-                f"Цель {i+1}: {goal:.2f} руб.", 
-                callback_data=f'select_goal_{i}'
-            ))
-        markup.row(types.InlineKeyboardButton("↩️ Назад", callback_data='change_goal'))
-        bot.edit_message_text(
+        outbox.edit_message_text(
             f"{get_bot_status_header()}\n\n"
             f"✂️ *Разделение цели в режиме Азамата*\n\n"
             f"Выберите цель для разделения:",
             chat_id=chat_id,
             message_id=call.message.message_id,
-            reply_markup=markup,
+            reply_markup=loss_goals_keyboard(state.loss_record),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_split_goal_azamat: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при разделении цели")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при разделении цели")
         except:
             pass
 
+@callback_router.prefix('select_goal_')
+@observe_handler
 def handle_select_goal(call):
     try:
         chat_id = call.message.chat.id
         goal_index = int(call.data.replace('select_goal_', ''))
         state = get_user_state(chat_id)
-        loss_record = state.get('loss_record', [])
+        loss_record = state.loss_record
         if goal_index >= len(loss_record):
-            bot.answer_callback_query(call.id, "❌ Неверный выбор цели")
+            outbox.answer_callback_query(call.id, "❌ Неверный выбор цели")
             return
         selected_goal = loss_record[goal_index]
-        bot.edit_message_text(
+        outbox.edit_message_text(
             f"{get_bot_status_header()}\n\n"
             f"✂️ *Разделение цели*\n\n"
-            f"Выбранная цель: **{selected_goal:.2f} руб.**\n\n"
+            f"Выбранная цель: **{format_rubles(selected_goal)} руб.**\n\n"
             f"На сколько частей разделить?",
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=split_goal_parts_keyboard(goal_index),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_select_goal: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при выборе цели")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при выборе цели")
         except:
             pass
 
+@callback_router.prefix('split_parts_')
+@observe_handler
 def handle_split_parts(call):
     try:
         chat_id = call.message.chat.id
@@ -1739,127 +3523,121 @@ def handle_split_parts(call):
         goal_index = int(parts_data[0])
         num_parts = int(parts_data[1])
         state = get_user_state(chat_id)
-        loss_record = state.get('loss_record', [])
+        loss_record = state.loss_record
         if goal_index >= len(loss_record):
-            bot.answer_callback_query(call.id, "❌ Неверный выбор цели")
+            outbox.answer_callback_query(call.id, "❌ Неверный выбор цели")
             return
         original_goal = loss_record[goal_index]
-        part_value = round(original_goal / num_parts, 2)
-        parts = [part_value] * (num_parts - 1)
-        last_part = original_goal - sum(parts)
-        parts.append(round(last_part, 2))
+        parts = split_amount(original_goal, num_parts)
         new_loss_record = (loss_record[:goal_index] + parts + loss_record[goal_index+1:])
-        state['loss_record'] = new_loss_record
-        state['current_target'] = calculate_azamat_target(state)
+        state.loss_record = new_loss_record
+        state.current_target = calculate_azamat_target(state)
         save_user_state(state)
-        parts_text = "\n".join([f"• Часть {i+1}: **{part:.2f} руб.**" for i, part in enumerate(parts)])
-        bot.edit_message_text(
+        parts_text = "\n".join([f"• Часть {i+1}: **{format_rubles(part)} руб.**" for i, part in enumerate(parts)])
+        outbox.edit_message_text(
             f"{get_bot_status_header()}\n\n"
             f"✅ *Цель успешно разделена!*\n\n"
-            f"✂️ Исходная цель: **{original_goal:.2f} руб.**\n"
+            f"✂️ Исходная цель: **{format_rubles(original_goal)} руб.**\n"
             f"Разделена на {num_parts} частей:\n{parts_text}\n\n"
-            f"🎯 *Текущая цель:* **{state['current_target']:.2f} руб.**",
+            f"🎯 *Текущая цель:* **{format_rubles(state.current_target)} руб.**",
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=change_goal_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_split_parts: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при разделении цели")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при разделении цели")
         except:
             pass
 
+@callback_router.route('split_goal')
+@observe_handler
 def handle_split_goal(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        if not state.get('bank_id'):
-            bot.answer_callback_query(call.id, "❌ Сначала создайте банк")
+        if not state.bank_id:
+            outbox.answer_callback_query(call.id, "❌ Сначала создайте банк")
             return
-        if state.get('in_azamat_mode') and state.get('loss_record'):
+        if state.in_azamat_mode and state.loss_record:
             handle_split_goal_azamat(call)
             return
-        if state.get('current_target', 0) <= 0:
-            bot.answer_callback_query(call.id, "❌ Нет активной цели для разделения")
+        if state.current_target <= 0:
+            outbox.answer_callback_query(call.id, "❌ Нет активной цели для разделения")
             return
-        if state.get('sub_goals'):
-            bot.answer_callback_query(call.id, "❌ Цель уже разделена")
+        if state.sub_goals:
+            outbox.answer_callback_query(call.id, "❌ Цель уже разделена")
             return
-        if state.get('in_azamat_mode'):
-            bot.answer_callback_query(call.id, "❌ Используйте разделение через список проигрышей")
+        if state.in_azamat_mode:
+            outbox.answer_callback_query(call.id, "❌ Используйте разделение через список проигрышей")
             return
-        current_target = state.get('current_target', 0)
-        one_fourth = round(current_target / 4, 2)
-        bot.edit_message_text(
+        current_target = state.current_target
+        part = split_amount(current_target, SPLIT_GOAL_PARTS)[0]
+        outbox.edit_message_text(
             f"{get_bot_status_header()}\n\n"
             f"✂️ *Подтверждение разделения цели*\n\n"
-            f"Текущая цель: **{current_target:.2f} руб.**\n"
-            f"После разделения на 4 части:\n"
-            f"• Каждая часть: **{one_fourth:.2f} руб.**\n"
-            f"• Всего частей: **4**\n\n"
+            f"Текущая цель: **{format_rubles(current_target)} руб.**\n"
+            f"После разделения на {format_parts(SPLIT_GOAL_PARTS)}:\n"
+            f"• Каждая часть: **{format_rubles(part)} руб.**\n"
+            f"• Всего частей: **{SPLIT_GOAL_PARTS}**\n\n"
             f"*Вы уверены, что хотите разделить цель?*",
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=confirm_split_goal_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_split_goal: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при разделении цели")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при разделении цели")
         except:
             pass
 
+@callback_router.route('confirm_split')
+@observe_handler
 def handle_confirm_split(call):
     try:
         chat_id = call.message.chat.id
         state = get_user_state(chat_id)
-        current_target = state.get('current_target', 0)
-        one_fourth = round(current_target / 4, 2)
-        sub_goals = [one_fourth] * 3
-        last_part = current_target - (one_fourth * 3)
-        sub_goals.append(round(last_part, 2))
-        if 'loss_record' not in state or state['loss_record'] is None:
-            state['loss_record'] = []
-        state['loss_record'].extend(sub_goals)
-        state['in_azamat_mode'] = True
-        state['current_target'] = calculate_azamat_target(state)
-        state['sub_goals'] = sub_goals
-        state['original_goal'] = current_target
-        state['awaiting_input'] = ''
+        current_target = state.current_target
+        state = split_goal(state)
+        sub_goals = state.sub_goals
+        state.awaiting_input = ''
         save_user_state(state)
-        goals_text = "\n".join([f"• Часть {i+1}: **{goal:.2f} руб.**" for i, goal in enumerate(sub_goals)])
-        bot.edit_message_text(
+        goals_text = "\n".join([f"• Часть {i+1}: **{format_rubles(goal)} руб.**" for i, goal in enumerate(sub_goals)])
+        outbox.edit_message_text(
             f"{get_bot_status_header()}\n\n"
             f"✅ *Цель успешно разделена!*\n\n"
-            f"✂️ Исходная цель: **{current_target:.2f} руб.**\n"
-            f"Разделена на 4 части:\n{goals_text}\n\n"
+            f"✂️ Исходная цель: **{format_rubles(current_target)} руб.**\n"
+            f"Разделена на {format_parts(SPLIT_GOAL_PARTS)}:\n{goals_text}\n\n"
             f"🛡️ *Активирован режим Азамата*\n"
-            f"🎯 *Текущая цель:* **{state['current_target']:.2f} руб.**",
+            f"🎯 *Текущая цель:* **{format_rubles(state.current_target)} руб.**",
             chat_id=chat_id,
             message_id=call.message.message_id,
             reply_markup=change_goal_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_confirm_split: {e}", exc_info=True)
         try:
-            bot.answer_callback_query(call.id, "❌ Ошибка при подтверждении разделения")
+            outbox.answer_callback_query(call.id, "❌ Ошибка при подтверждении разделения")
         except:
             pass
 
+@callback_router.route('manage_users')
+@observe_handler
 def handle_manage_users(call):
     try:
         chat_id = call.message.chat.id
         if chat_id != ADMIN_ID:
-            bot.answer_callback_query(call.id, "❌ Недостаточно прав")
+            outbox.answer_callback_query(call.id, "❌ Недостаточно прав")
             return
-        bot.edit_message_text(
+        outbox.edit_message_text(
             f"{get_bot_status_header()}\n\n"
             "👥 *Управление пользователями*\n\n"
             "Добавление и удаление пользователей из белого списка:",
@@ -1868,20 +3646,22 @@ def handle_manage_users(call):
             reply_markup=users_management_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_manage_users: {e}", exc_info=True)
 
+@callback_router.route('add_user')
+@observe_handler
 def handle_add_user(call):
     try:
         chat_id = call.message.chat.id
         if chat_id != ADMIN_ID:
-            bot.answer_callback_query(call.id, "❌ Недостаточно прав")
+            outbox.answer_callback_query(call.id, "❌ Недостаточно прав")
             return
         state = get_user_state(chat_id)
-        state['awaiting_input'] = 'add_user'
+        state.awaiting_input = 'add_user'
         save_user_state(state)
-        bot.edit_message_text(
+        outbox.edit_message_text(
             f"{get_bot_status_header()}\n\n"
             "➕ *Добавление пользователя*\n\n"
             "Введите ID пользователя для добавления в белый список:",
@@ -1890,19 +3670,21 @@ def handle_add_user(call):
             reply_markup=back_to_menu_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_add_user: {e}", exc_info=True)
 
+@callback_router.route('remove_user')
+@observe_handler
 def handle_remove_user(call):
     try:
         chat_id = call.message.chat.id
         if chat_id != ADMIN_ID:
-            bot.answer_callback_query(call.id, "❌ Недостаточно прав")
+            outbox.answer_callback_query(call.id, "❌ Недостаточно прав")
             return
         users_list = "\n".join([f"• {user_id}" for user_id in AUTHORIZED_USERS if user_id != ADMIN_ID])
         if not users_list:
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n"
                 "❌ *Нет пользователей для удаления*\n\nВ белом списке только вы.",
                 chat_id=chat_id,
@@ -1912,9 +3694,9 @@ def handle_remove_user(call):
             )
         else:
             state = get_user_state(chat_id)
-            state['awaiting_input'] = 'remove_user'
+            state.awaiting_input = 'remove_user'
             save_user_state(state)
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 f"{get_bot_status_header()}\n\n"
                 f"➖ *Удаление пользователя*\n\n"
                 f"Текущие пользователи:\n{users_list}\n\n"
@@ -1924,20 +3706,22 @@ def handle_remove_user(call):
                 reply_markup=back_to_menu_keyboard(),
                 parse_mode='Markdown'
             )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_remove_user: {e}", exc_info=True)
 
+@callback_router.route('list_users')
+@observe_handler
 def handle_list_users(call):
     try:
         chat_id = call.message.chat.id
         if chat_id != ADMIN_ID:
-            bot.answer_callback_query(call.id, "❌ Недостаточно прав")
+            outbox.answer_callback_query(call.id, "❌ Недостаточно прав")
             return
         users_count = len(AUTHORIZED_USERS)
         users_list = "\n".join([f"• {user_id} {'(Владелец)' if user_id == ADMIN_ID else ''}" 
                               for user_id in AUTHORIZED_USERS])
-        bot.edit_message_text(
+        outbox.edit_message_text(
             f"{get_bot_status_header()}\n\n"
             f"📋 *Список пользователей*\n\n"
             f"Всего пользователей: {users_count}\n\n"
@@ -1947,71 +3731,72 @@ def handle_list_users(call):
             reply_markup=users_management_keyboard(),
             parse_mode='Markdown'
         )
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     except Exception as e:
         log_error(f"Ошибка в handle_list_users: {e}", exc_info=True)
 
 @bot.message_handler(func=lambda message: True)
+@observe_handler
 def handle_input(message):
     chat_id = message.chat.id
     update_bot_status()
     if not security_check(chat_id):
-        bot.send_message(chat_id, "🚫 *ДОСТУП ЗАПРЕЩЕН*\n\nБот недоступен для вашего аккаунта.", parse_mode='Markdown')
+        outbox.send_message(chat_id, "🚫 *ДОСТУП ЗАПРЕЩЕН*\n\nБот недоступен для вашего аккаунта.", parse_mode='Markdown')
         return
     try:
         text = (message.text or '').strip()
         state = get_user_state(chat_id)
-        if not state.get('awaiting_input'):
-            bot.send_message(chat_id, "Используйте кнопки меню для управления", 
+        if not state.awaiting_input:
+            outbox.send_message(chat_id, "Используйте кнопки меню для управления", 
                            reply_markup=main_menu_keyboard_security(chat_id))
             return
-        if state['awaiting_input'] == 'add_user':
+        if state.awaiting_input == 'add_user':
             if chat_id != ADMIN_ID:
-                bot.send_message(chat_id, "❌ Недостаточно прав")
+                outbox.send_message(chat_id, "❌ Недостаточно прав")
                 return
             try:
                 new_user_id = int(text)
                 if add_authorized_user(new_user_id):
-                    bot.send_message(
+                    outbox.send_message(
                         chat_id,
                         f"{get_bot_status_header()}\n\n✅ *Пользователь добавлен!*\n\nID: {new_user_id}",
                         reply_markup=main_menu_keyboard_security(chat_id),
                         parse_mode='Markdown'
                     )
-                    state['awaiting_input'] = ''
+                    state.awaiting_input = ''
                     save_user_state(state)
                 else:
-                    bot.send_message(chat_id, "❌ Ошибка при добавлении пользователя")
+                    outbox.send_message(chat_id, "❌ Ошибка при добавлении пользователя")
             except ValueError:
-                bot.send_message(chat_id, "❌ Неверный формат ID. Введите числовой ID.")
-        elif state['awaiting_input'] == 'remove_user':
+                outbox.send_message(chat_id, "❌ Неверный формат ID. Введите числовой ID.")
+        elif state.awaiting_input == 'remove_user':
             if chat_id != ADMIN_ID:
-                bot.send_message(chat_id, "❌ Недостаточно прав")
+                outbox.send_message(chat_id, "❌ Недостаточно прав")
                 return
             try:
                 remove_user_id = int(text)
                 if remove_authorized_user(remove_user_id):
-                    bot.send_message(
+                    outbox.send_message(
                         chat_id,
                         f"{get_bot_status_header()}\n\n✅ *Пользователь удален!*\n\nID: {remove_user_id}",
                         reply_markup=main_menu_keyboard_security(chat_id),
                         parse_mode='Markdown'
                     )
                 else:
-                    bot.send_message(chat_id, "❌ Не удалось удалить пользователя")
-                state['awaiting_input'] = ''
+                    outbox.send_message(chat_id, "❌ Не удалось удалить пользователя")
+                state.awaiting_input = ''
                 save_user_state(state)
             except ValueError:
-                bot.send_message(chat_id, "❌ Неверный формат ID. Введите числовой ID.")
-        elif state['awaiting_input'] == 'bank_name':
+                outbox.send_message(chat_id, "❌ Неверный формат ID. Введите числовой ID.")
+        elif state.awaiting_input == 'bank_name':
             if not text:
-                bot.send_message(chat_id, "❌ Введите название банка!")
+                outbox.send_message(chat_id, "❌ Введите название банка!")
                 return
             bank_id, result_msg = create_bank(chat_id, text)
             if bank_id:
                 state = get_user_state(chat_id)
-                bot.send_message(chat_id, f"{get_bot_status_header()}\n\n{result_msg}", reply_markup=main_menu_keyboard_security(chat_id))
-                state['awaiting_input'] = 'set_bank'
+                outbox.send_message(chat_id, f"{get_bot_status_header()}\n\n{result_msg}", reply_markup=main_menu_keyboard_security(chat_id))
+                state.awaiting_input = 'set_bank'
                 save_user_state(state)
                 bank_text = (
                     f"{get_bot_status_header()}\n\n"
@@ -2020,62 +3805,62 @@ def handle_input(message):
                     f"_Диапазон: {MIN_BANK_AMOUNT}-{MAX_BANK_AMOUNT} руб._"
                     f"{format_input_prompt('set_bank')}"
                 )
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
                     bank_text,
                     reply_markup=simple_input_keyboard(),
                     parse_mode='Markdown'
                 )
             else:
-                bot.send_message(chat_id, f"{get_bot_status_header()}\n\n{result_msg}", reply_markup=main_menu_keyboard_security(chat_id))
-        elif state['awaiting_input'] == 'set_bank':
+                outbox.send_message(chat_id, f"{get_bot_status_header()}\n\n{result_msg}", reply_markup=main_menu_keyboard_security(chat_id))
+        elif state.awaiting_input == 'set_bank':
             try:
-                amount = float(text.replace(',', '.'))
+                amount = to_kopecks(text.replace(',', '.'))
             except Exception:
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
                     f"{get_bot_status_header()}\n\n❌ *Неверный формат суммы!*\n\nПожалуйста, введите число.{format_input_prompt('set_bank')}",
                     reply_markup=simple_input_keyboard(),
                     parse_mode='Markdown'
                 )
                 return
-            if amount < MIN_BANK_AMOUNT or amount > MAX_BANK_AMOUNT:
-                bot.send_message(
+            if amount < MIN_BANK_KOPECKS or amount > MAX_BANK_KOPECKS:
+                outbox.send_message(
                     chat_id,
                     f"{get_bot_status_header()}\n\n❌ *Сумма вне диапазона!*\n\nДопустимый диапазон: {MIN_BANK_AMOUNT}-{MAX_BANK_AMOUNT} руб.{format_input_prompt('set_bank')}",
                     reply_markup=simple_input_keyboard(),
                     parse_mode='Markdown'
                 )
                 return
-            state['bank'] = round(amount, 2)
-            state['initial_balance'] = round(amount, 2)
-            current_day = state.get('day', 1)
+            state.bank = amount
+            state.initial_balance = amount
+            current_day = state.day
             target_bank = calculate_target_bank(amount, current_day)
-            state['current_target'] = calculate_daily_goal(amount, target_bank)
-            state['daily_goal'] = state['current_target']
-            state['awaiting_input'] = ''
+            state.current_target = calculate_daily_goal(amount, target_bank)
+            state.daily_goal = state.current_target
+            state.awaiting_input = ''
             save_user_state(state)
             target_bank_day1 = calculate_target_bank(amount, 1)
             success_text = (
                 f"{get_bot_status_header()}\n\n"
                 f"✅ *БАНК УСТАНОВЛЕН!*\n\n"
-                f"🏁 *Начальный банк:* **{amount:.2f} руб.**\n"
-                f"🎯 *Цель дня:* **+{calculate_daily_goal(amount, target_bank_day1):.2f} руб.**\n"
+                f"🏁 *Начальный банк:* **{format_rubles(amount)} руб.**\n"
+                f"🎯 *Цель дня:* **+{format_rubles(calculate_daily_goal(amount, target_bank_day1))} руб.**\n"
                 f"📅 *День:* **#1**\n"
-                f"🏆 *Целевой банк дня:* **{target_bank_day1:.2f} руб.**\n\n"
+                f"🏆 *Целевой банк дня:* **{format_rubles(target_bank_day1)} руб.**\n\n"
                 f"Теперь можно заключать пари!"
             )
-            bot.send_message(
+            outbox.send_message(
                 chat_id,
                 success_text,
                 reply_markup=main_menu_keyboard_security(chat_id),
                 parse_mode='Markdown'
             )
-        elif state['awaiting_input'] == 'set_coeff':
+        elif state.awaiting_input == 'set_coeff':
             try:
                 coeff = float(text.replace(',', '.'))
             except Exception:
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
                     f"{get_bot_status_header()}\n\n❌ *Неверный формат коэффициента!*\n\nПожалуйста, введите число от 1.1 до 9.9.{format_input_prompt('set_coeff')}",
                     reply_markup=simple_input_keyboard(),
@@ -2083,91 +3868,91 @@ def handle_input(message):
                 )
                 return
             if coeff < MIN_COEFF or coeff > MAX_COEFF:
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
                     f"{get_bot_status_header()}\n\n❌ *Коэффициент вне диапазона!*\n\nДопустимый диапазон: {MIN_COEFF}-{MAX_COEFF}.{format_input_prompt('set_coeff')}",
                     reply_markup=simple_input_keyboard(),
                     parse_mode='Markdown'
                 )
                 return
-            state['current_coeff'] = coeff
-            stake = calculate_stake(state.get('current_target', 0), coeff)
-            state['current_stake'] = stake
-            state['awaiting_input'] = 'set_stake'
+            state.current_coeff = coeff
+            stake = calculate_stake(state.current_target, coeff)
+            state.current_stake = stake
+            state.awaiting_input = 'set_stake'
             save_user_state(state)
-            potential_profit = stake * (coeff - 1)
-            max_stake = float(state.get('bank', 0)) * MAX_STAKE_PERCENTAGE
+            potential_profit = calculate_profit(stake, coeff)
+            max_stake = calculate_max_stake(state.bank)
             bet_text = (
                 f"{get_bot_status_header()}\n\n"
                 f"🧮 *КАЛЬКУЛЯТОР СТАВКИ*\n"
-                f"• Цель: {state.get('current_target', 0):.2f} руб.\n"
-                f"• Коэффициент: {state.get('current_coeff', 0):.2f}\n"
-                f"• 💵 Потенциальная прибыль: +{potential_profit:.2f} руб.\n\n"
+                f"• Цель: {format_rubles(state.current_target)} руб.\n"
+                f"• Коэффициент: {state.current_coeff:.2f}\n"
+                f"• 💵 Потенциальная прибыль: +{format_rubles(potential_profit)} руб.\n\n"
                 f"💳 *Информация о банке:*\n"
-                f"• Текущий банк: {state.get('bank', 0):.2f} руб.\n"
-                f"• Макс. ставка: {max_stake:.2f} руб.\n\n"
-                f"💰 *РЕКОМЕНДУЕМАЯ СУММА СТАВКИ: {stake:.2f} руб.*\n\n"
+                f"• Текущий банк: {format_rubles(state.bank)} руб.\n"
+                f"• Макс. ставка: {format_rubles(max_stake)} руб.\n\n"
+                f"💰 *РЕКОМЕНДУЕМАЯ СУММА СТАВКИ: {format_rubles(stake)} руб.*\n\n"
                 f"{format_input_prompt('set_stake')}"
             )
-            bot.send_message(
+            outbox.send_message(
                 chat_id,
                 bet_text,
                 reply_markup=simple_input_keyboard(),
                 parse_mode='Markdown'
             )
-        elif state['awaiting_input'] == 'set_stake':
+        elif state.awaiting_input == 'set_stake':
             try:
-                stake = float(text.replace(',', '.'))
+                stake = to_kopecks(text.replace(',', '.'))
             except Exception:
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
                     f"{get_bot_status_header()}\n\n❌ *Неверный формат суммы!*\n\nПожалуйста, введите число.{format_input_prompt('set_stake')}",
                     reply_markup=simple_input_keyboard(),
                     parse_mode='Markdown'
                 )
                 return
-            max_stake = float(state.get('bank', 0)) * MAX_STAKE_PERCENTAGE
+            max_stake = calculate_max_stake(state.bank)
             if stake > max_stake:
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
-                    f"{get_bot_status_header()}\n\n❌ *Сумма превышает максимальную!*\n\nМаксимальная ставка: {max_stake:.2f} руб.{format_input_prompt('set_stake')}",
+                    f"{get_bot_status_header()}\n\n❌ *Сумма превышает максимальную!*\n\nМаксимальная ставка: {format_rubles(max_stake)} руб.{format_input_prompt('set_stake')}",
                     reply_markup=simple_input_keyboard(),
                     parse_mode='Markdown'
                 )
                 return
             if stake <= 0:
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
                     f"{get_bot_status_header()}\n\n❌ *Сумма должна быть положительной!*{format_input_prompt('set_stake')}",
                     reply_markup=simple_input_keyboard(),
                     parse_mode='Markdown'
                 )
                 return
-            state['current_stake'] = round(stake, 2)
-            state['awaiting_input'] = ''
-            state['awaiting_bet_result'] = True
+            state.current_stake = stake
+            state.awaiting_input = ''
+            state.awaiting_bet_result = True
             save_user_state(state)
-            potential_profit = stake * (state.get('current_coeff', 0) - 1)
+            potential_profit = calculate_profit(stake, state.current_coeff)
             confirmation_text = (
                 f"{get_bot_status_header()}\n\n"
                 f"✅ *СТАВКА ПОДТВЕРЖДЕНА!*\n\n"
-                f"💰 *Сумма:* **{stake:.2f} руб.**\n"
-                f"⚙️ *Коэффициент:* **{state.get('current_coeff', 0):.2f}**\n"
-                f"🎯 *Цель:* **{state.get('current_target', 0):.2f} руб.**\n"
-                f"💵 *Прибыль:* **+{potential_profit:.2f} руб.**\n\n"
+                f"💰 *Сумма:* **{format_rubles(stake)} руб.**\n"
+                f"⚙️ *Коэффициент:* **{state.current_coeff:.2f}**\n"
+                f"🎯 *Цель:* **{format_rubles(state.current_target)} руб.**\n"
+                f"💵 *Прибыль:* **+{format_rubles(potential_profit)} руб.**\n\n"
                 f"🎲 *Зафиксируйте результат события:*"
             )
-            bot.send_message(
+            outbox.send_message(
                 chat_id,
                 confirmation_text,
                 reply_markup=bet_confirmation_keyboard(),
                 parse_mode='Markdown'
             )
-        elif state['awaiting_input'] == 'modify_goal':
+        elif state.awaiting_input == 'modify_goal':
             try:
-                new_goal = float(text.replace(',', '.'))
+                new_goal = to_kopecks(text.replace(',', '.'))
             except Exception:
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
                     f"{get_bot_status_header()}\n\n❌ *Неверный формат суммы!*\n\nПожалуйста, введите число.",
                     reply_markup=back_to_menu_keyboard(),
@@ -2175,33 +3960,33 @@ def handle_input(message):
                 )
                 return
             if new_goal <= 0:
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
                     f"{get_bot_status_header()}\n\n❌ *Цель должна быть положительной!*",
                     reply_markup=back_to_menu_keyboard(),
                     parse_mode='Markdown'
                 )
                 return
-            state['current_target'] = round(new_goal, 2)
-            state['awaiting_input'] = ''
+            state.current_target = new_goal
+            state.awaiting_input = ''
             save_user_state(state)
             success_text = (
                 f"{get_bot_status_header()}\n\n"
                 f"✅ *Цель успешно изменена!*\n\n"
-                f"🎯 *Новая цель дня:* **{new_goal:.2f} руб.**\n\n"
+                f"🎯 *Новая цель дня:* **{format_rubles(new_goal)} руб.**\n\n"
                 f"Теперь можно заключать пари с новой целью."
             )
-            bot.send_message(
+            outbox.send_message(
                 chat_id,
                 success_text,
                 reply_markup=main_menu_keyboard_security(chat_id),
                 parse_mode='Markdown'
             )
-        elif state['awaiting_input'] == 'edit_coeff':
+        elif state.awaiting_input == 'edit_coeff':
             try:
                 coeff = float(text.replace(',', '.'))
             except Exception:
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
                     f"{get_bot_status_header()}\n\n❌ *Неверный формат коэффициента!*\n\nПожалуйста, введите число от 1.1 до 9.9.",
                     reply_markup=edit_bet_keyboard(),
@@ -2209,77 +3994,77 @@ def handle_input(message):
                 )
                 return
             if coeff < MIN_COEFF or coeff > MAX_COEFF:
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
                     f"{get_bot_status_header()}\n\n❌ *Коэффициент вне диапазона!*\n\nДопустимый диапазон: {MIN_COEFF}-{MAX_COEFF}.",
                     reply_markup=edit_bet_keyboard(),
                     parse_mode='Markdown'
                 )
                 return
-            state['current_coeff'] = coeff
-            state['awaiting_input'] = 'edit_stake'
+            state.current_coeff = coeff
+            state.awaiting_input = 'edit_stake'
             save_user_state(state)
-            current_target = state.get('current_target', 0)
+            current_target = state.current_target
             stake = calculate_stake(current_target, coeff)
             edit_stake_text = (
                 f"{get_bot_status_header()}\n\n"
                 f"✏️ *РЕДАКТИРОВАНИЕ СТАВКИ*\n\n"
                 f"✅ *Новый коэффициент:* **{coeff:.2f}**\n\n"
-                f"💰 *РЕКОМЕНДУЕМАЯ СУММА:* **{stake:.2f} руб.**\n\n"
+                f"💰 *РЕКОМЕНДУЕМАЯ СУММА:* **{format_rubles(stake)} руб.**\n\n"
                 f"✍️ *Введите новую сумму ставки:*\n"
-                f"_Текущая: {state.get('edit_original_stake', 0):.2f} руб._"
+                f"_Текущая: {format_rubles(state.edit_original_stake)} руб._"
             )
-            bot.send_message(
+            outbox.send_message(
                 chat_id,
                 edit_stake_text,
                 reply_markup=edit_bet_keyboard(),
                 parse_mode='Markdown'
             )
-        elif state['awaiting_input'] == 'edit_stake':
+        elif state.awaiting_input == 'edit_stake':
             try:
-                stake = float(text.replace(',', '.'))
+                stake = to_kopecks(text.replace(',', '.'))
             except Exception:
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
                     f"{get_bot_status_header()}\n\n❌ *Неверный формат суммы!*\n\nПожалуйста, введите число.",
                     reply_markup=edit_bet_keyboard(),
                     parse_mode='Markdown'
                 )
                 return
-            max_stake = float(state.get('bank', 0)) * MAX_STAKE_PERCENTAGE
+            max_stake = calculate_max_stake(state.bank)
             if stake > max_stake:
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
-                    f"{get_bot_status_header()}\n\n❌ *Сумма превышает максимальную!*\n\nМаксимальная ставка: {max_stake:.2f} руб.",
+                    f"{get_bot_status_header()}\n\n❌ *Сумма превышает максимальную!*\n\nМаксимальная ставка: {format_rubles(max_stake)} руб.",
                     reply_markup=edit_bet_keyboard(),
                     parse_mode='Markdown'
                 )
                 return
             if stake <= 0:
-                bot.send_message(
+                outbox.send_message(
                     chat_id,
                     f"{get_bot_status_header()}\n\n❌ *Сумма должна быть положительной!*",
                     reply_markup=edit_bet_keyboard(),
                     parse_mode='Markdown'
                 )
                 return
-            state['current_stake'] = round(stake, 2)
-            state['awaiting_input'] = ''
-            state['awaiting_bet_result'] = True
+            state.current_stake = stake
+            state.awaiting_input = ''
+            state.awaiting_bet_result = True
             save_user_state(state)
-            coeff = state.get('current_coeff', 0)
-            potential_profit = stake * (coeff - 1)
+            coeff = state.current_coeff
+            potential_profit = calculate_profit(stake, coeff)
             updated_text = (
                 f"{get_bot_status_header()}\n\n"
                 f"✅ *СТАВКА ОБНОВЛЕНА!*\n\n"
                 f"📊 *Новые параметры:*\n"
                 f"• Коэффициент: **{coeff:.2f}**\n"
-                f"• Сумма ставки: **{stake:.2f} руб.**\n"
-                f"• Потенциальная прибыль: **+{potential_profit:.2f} руб.**\n\n"
-                f"🎯 *Цель:* **{state.get('current_target', 0):.2f} руб.**\n\n"
+                f"• Сумма ставки: **{format_rubles(stake)} руб.**\n"
+                f"• Потенциальная прибыль: **+{format_rubles(potential_profit)} руб.**\n\n"
+                f"🎯 *Цель:* **{format_rubles(state.current_target)} руб.**\n\n"
                 f"🎲 *Зафиксируйте результат события:*"
             )
-            bot.send_message(
+            outbox.send_message(
                 chat_id,
                 updated_text,
                 reply_markup=bet_confirmation_keyboard(),
@@ -2288,22 +4073,46 @@ def handle_input(message):
     except Exception as e:
         log_error(f"Ошибка в handle_input: {e}", exc_info=True)
         try:
-            bot.send_message(chat_id, "❌ Произошла ошибка при обработке запроса")
+            outbox.send_message(chat_id, "❌ Произошла ошибка при обработке запроса")
         except Exception:
             pass
 
 # === ЗАПУСК ДЛЯ СЕРВЕРА ===
-if __name__ == '__main__':
+register_runtime_gauges()
+
+# Точка входа сервиса: логирование, база, фоновые потоки, веб-сервер и
+# получение апдейтов. До вызова main() модуль ничего не запускает.
+def main():
+    global log_listener
+    check_startup_config()
+    log_listener = setup_logging()
+    print("✅ Бот инициализирован")
     print("🤖 Бот запускается на Railway...")
+    start_web_server()
     init_db()
+    start_state_flusher()
+    bot.dispatcher.start()
+    outbox.start()
+    simulations.start()
+    start_health_prober()
+    signal.signal(signal.SIGTERM, handle_sigterm)
     try:
-        while True:
+        if BOT_MODE == 'webhook':
+            run_webhook_mode()
+        while BOT_MODE == 'polling':
             try:
                 print("🔄 Запуск бота...")
                 bot.infinity_polling(timeout=60, long_polling_timeout=60)
             except Exception as e:
                 print(f"❌ Ошибка: {e}")
+                flush_state_cache()
                 print("🔄 Перезапуск через 10 секунд...")
                 time.sleep(10)
     except KeyboardInterrupt:
         print("\n🛑 Бот остановлен")
+    finally:
+        outbox.join(timeout=10)
+        shutdown_state_cache()
+
+if __name__ == '__main__':
+    main()